@@ -44,10 +44,10 @@ class ConsistentHash:
     consistent hashing algorithm.
     """
 
-    def __init__(self):
+    def __init__(self, total_slots=50):
         self._keys = []           # indices taken up in the ring
         self.nodes = []           # nodes present in the ring. nodes[i] is present at index keys[i]
-        self.total_slots = 50     # total slots in the ring
+        self.total_slots = total_slots     # total slots in the ring
 
     def add_node(self, node: StorageNode) -> int:
         """add_node function adds a new node in the system and returns the key
@@ -116,24 +116,25 @@ class ConsistentHash:
         return self.nodes[index]
 
 
-ch = ConsistentHash()
-for node in storage_nodes:
-    ch.add_node(node)
+if __name__ == '__main__':
+    ch = ConsistentHash()
+    for node in storage_nodes:
+        ch.add_node(node)
 
 
-for file in ['f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'f5.txt']:
-    print(f"file {file} (shown in green) resides on node {ch.assign(file).name} (shown in red)")
-    # ch.plot(file, ch.assign(file))
+    for file in ['f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'f5.txt']:
+        print(f"file {file} (shown in green) resides on node {ch.assign(file).name} (shown in red)")
+        # ch.plot(file, ch.assign(file))
 
-print('add another node and reassign files...')
+    print('add another node and reassign files...')
 
-new_node = StorageNode(name='H', host='239.67.52.52')
-ch.add_node(new_node)
-for file in ['f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'f5.txt']:
-    print(f"file {file} (shown in green) resides on node {ch.assign(file).name} (shown in red)")
+    new_node = StorageNode(name='H', host='239.67.52.52')
+    ch.add_node(new_node)
+    for file in ['f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'f5.txt']:
+        print(f"file {file} (shown in green) resides on node {ch.assign(file).name} (shown in red)")
 
-# if remove a node, what will happen??
-# print('remove a node and reassign files...')
-# ch.remove_node(new_node)
-# for file in ['f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'f5.txt']:
-#     print(f"file {file} (shown in green) resides on node {ch.assign(file).name} (shown in red)")
+    # if remove a node, what will happen??
+    # print('remove a node and reassign files...')
+    # ch.remove_node(new_node)
+    # for file in ['f1.txt', 'f2.txt', 'f3.txt', 'f4.txt', 'f5.txt']:
+    #     print(f"file {file} (shown in green) resides on node {ch.assign(file).name} (shown in red)")
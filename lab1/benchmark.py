@@ -0,0 +1,368 @@
+# -*- coding:utf-8 -*-
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from framing import FRAME_MAGIC, FrameReader, encode_frame
+from heartbeat import PING, PONG
+
+
+#Load generator for the lab1 chat server.
+#Thousands of simulated clients live on one asyncio loop, each speaking the framed protocol so every
+#server reply is one frame. Every client sends commands on a fixed schedule (open loop, so a slow
+#server shows up as latency instead of as fewer requests) drawn from a weighted mix of
+#  message   "<uuid>: bench <timestamp>" to a random other client, the receiver measures delivery latency
+#  list      "list 0 <list-limit>"
+#  history   "history <uuid>" of a random other client
+#and times the server's reply to each. Results go out as JSON for regression runs, e.g.
+#  python benchmark.py --spawn-server thread --clients 2000 --output thread.json
+#  python benchmark.py --spawn-server eventloop --clients 2000 --output eventloop.json
+COMMANDS = ("message", "list", "history")
+
+
+#Per-kind latency samples in seconds and counters, shared by all simulated clients
+class Results:
+    def __init__(self):
+        self.latency = {kind: [] for kind in ("delivery", "message_ack", "list", "history")}
+        self.sent = {kind: 0 for kind in COMMANDS}
+        self.delivered = 0
+        self.errors = {}
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+#p50/p99/p999 and friends of one list of samples, in milliseconds
+def summarize(samples):
+    if not samples:
+        return {"count": 0}
+    samples = sorted(samples)
+
+    def percentile(p):
+        return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 3)
+
+    return {"count": len(samples), "mean": round(sum(samples) / len(samples) * 1000, 3),
+            "p50": percentile(0.50), "p99": percentile(0.99), "p999": percentile(0.999),
+            "max": round(samples[-1] * 1000, 3)}
+
+
+#Resident set size in KiB of a process and all its children (--workers), None where /proc is missing
+def process_tree_rss(pid):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            rss = next((int(line.split()[1]) for line in status if line.startswith("VmRSS:")), 0)
+        children = []
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(child) for child in f.read().split()]
+    except (OSError, ValueError):
+        return None
+    for child in children:
+        rss += process_tree_rss(child) or 0
+    return rss
+
+
+#Tracks the server's RSS while the benchmark runs
+class RssSampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+
+    def sample(self):
+        rss = process_tree_rss(self.pid) if self.pid else None
+        if rss is not None:
+            self.samples.append(rss)
+
+    async def run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def report(self):
+        if not self.samples:
+            return None
+        return {"start_kib": self.samples[0], "peak_kib": max(self.samples), "end_kib": self.samples[-1]}
+
+
+class SimulatedClient:
+    def __init__(self, results):
+        self.results = results
+        self.uid = None
+        self.reader = None
+        self.writer = None
+        #Send times of requests still waiting for their reply, the server answers each kind in order
+        self.pending = {kind: [] for kind in ("message_ack", "list", "history")}
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(FRAME_MAGIC)
+        pending = b""
+        while FRAME_MAGIC not in pending:
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConnectionError("server closed the connection during the greeting")
+            pending += data
+        greeting, rest = pending.split(FRAME_MAGIC, 1)
+        #"Your assigned UIUD is: <uuid> "
+        self.uid = greeting.decode().split(":", 1)[1].strip()
+        self.frames = FrameReader()
+        return self.frames.feed(rest)
+
+    def send(self, kind, command):
+        self.results.sent[kind] += 1
+        pending_kind = "message_ack" if kind == "message" else kind
+        self.pending[pending_kind].append(time.perf_counter())
+        self.writer.write(encode_frame(command))
+
+    #Reads server frames until the connection closes, timing every reply
+    async def receive(self, first_frames):
+        for frame in first_frames:
+            self.on_frame(frame)
+        while True:
+            data = await self.reader.read(256 * 1024)
+            if not data:
+                return
+            for frame in self.frames.feed(data):
+                self.on_frame(frame)
+
+    def on_frame(self, frame):
+        now = time.perf_counter()
+        if frame.startswith("Message from "):
+            #"Message from <uuid>: bench <send time>"
+            try:
+                sent_at = float(frame.rsplit("bench ", 1)[1])
+            except (IndexError, ValueError):
+                return
+            self.results.latency["delivery"].append(now - sent_at)
+            self.results.delivered += 1
+            return
+        if frame == PING:
+            self.writer.write(encode_frame(PONG))
+            return
+        if frame == "server had received your msg":
+            kind = "message_ack"
+        elif frame.startswith("\n\nYour history is:"):
+            kind = "history"
+        elif frame.startswith("\n UUID:") or frame.startswith("\n(clients"):
+            kind = "list"
+        elif frame.startswith("Error: message to"):
+            self.results.error("dropped")
+            return
+        elif ": rate limit, " in frame:
+            #"Error: <command>: rate limit, ...", the refused command gets no other reply
+            command = frame[len("Error: "):].split(":", 1)[0]
+            pending_kind = "message_ack" if command == "message" else command
+            if self.pending.get(pending_kind):
+                self.pending[pending_kind].pop(0)
+            self.results.error("rate limit")
+            return
+        elif frame.startswith("Error"):
+            self.results.error(frame.split(" for ")[0].split(" to ")[0])
+            return
+        else:
+            self.results.error("unexpected reply")
+            return
+        if self.pending[kind]:
+            self.results.latency[kind].append(now - self.pending[kind].pop(0))
+
+    def outstanding(self):
+        return sum(len(times) for times in self.pending.values())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def run_benchmark(args):
+    results = Results()
+    rss = RssSampler(args.server_pid)
+    rss_task = asyncio.ensure_future(rss.run())
+
+    #Connect everybody first, a few at a time so a small listen backlog keeps up
+    clients = [SimulatedClient(results) for _ in range(args.clients)]
+    gate = asyncio.Semaphore(args.connect_concurrency)
+    receivers = []
+
+    async def connect(client):
+        async with gate:
+            #A connection the server's listen queue dropped would otherwise hang here
+            first_frames = await asyncio.wait_for(client.connect(args.host, args.port), args.connect_timeout)
+        receivers.append(asyncio.ensure_future(client.receive(first_frames)))
+
+    connect_start = time.perf_counter()
+    outcomes = await asyncio.gather(*(connect(client) for client in clients), return_exceptions=True)
+    connect_time = time.perf_counter() - connect_start
+    failed = [client for client, outcome in zip(clients, outcomes) if isinstance(outcome, Exception)]
+    for client in failed:
+        results.error("connect failed")
+        client.close()
+    clients = [client for client in clients if client.uid is not None]
+    if len(clients) < 2:
+        raise SystemExit("fewer than two clients connected, is the server running?")
+    uids = [client.uid for client in clients]
+    rss.sample()
+    idle_rss = rss.samples[-1] if rss.samples else None
+
+    weights = [args.mix[kind] for kind in COMMANDS]
+    interval = 1 / args.rate
+    deadline = time.perf_counter() + args.duration
+
+    async def drive(client):
+        rng = random.Random()
+        await asyncio.sleep(rng.random() * interval)  # spread the clients over one interval
+        next_send = time.perf_counter()
+        while next_send < deadline:
+            kind = rng.choices(COMMANDS, weights)[0]
+            peer = rng.choice(uids)
+            while peer == client.uid:
+                peer = rng.choice(uids)
+            if kind == "message":
+                client.send(kind, f"{peer}: bench {time.perf_counter()!r}")
+            elif kind == "list":
+                client.send(kind, f"list 0 {args.list_limit}")
+            else:
+                client.send(kind, f"history {peer}")
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+
+    run_start = time.perf_counter()
+    await asyncio.gather(*(drive(client) for client in clients))
+    send_time = time.perf_counter() - run_start
+
+    #Let the replies still in flight arrive
+    drain_deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < drain_deadline and any(client.outstanding() for client in clients):
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - run_start
+    rss.sample()
+
+    for client in clients:
+        client.close()
+    rss_task.cancel()
+    for receiver in receivers:
+        receiver.cancel()
+
+    replies = sum(len(results.latency[kind]) for kind in ("message_ack", "list", "history"))
+    server_rss = rss.report()
+    if server_rss is not None:
+        server_rss["idle_kib"] = idle_rss
+    return {
+        "label": args.label,
+        "server": f"{args.host}:{args.port}",
+        "config": {"clients": args.clients, "duration_s": args.duration, "rate_per_client": args.rate,
+                   "mix": args.mix, "list_limit": args.list_limit},
+        "connected": len(clients),
+        "connect_time_s": round(connect_time, 3),
+        "elapsed_s": round(elapsed, 3),
+        "sent": dict(results.sent),
+        "delivered": results.delivered,
+        "unanswered": sum(client.outstanding() for client in clients),
+        "throughput_per_s": {"commands": round(sum(results.sent.values()) / send_time, 1),
+                             "replies": round(replies / elapsed, 1),
+                             "deliveries": round(results.delivered / elapsed, 1)},
+        "latency_ms": {kind: summarize(samples) for kind, samples in results.latency.items()},
+        "errors": results.errors,
+        "server_rss": server_rss,
+    }
+
+
+#"message=80,list=10,history=10" -> {"message": 80, "list": 10, "history": 10}
+def parse_mix(text):
+    mix = {kind: 0 for kind in COMMANDS}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in mix:
+            raise argparse.ArgumentTypeError(f"unknown command {kind!r}, use {', '.join(COMMANDS)}")
+        mix[kind.strip()] = float(weight)
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("the mix needs at least one command with a weight above 0")
+    return mix
+
+
+#Starts socket_server.py next to this file and waits until it accepts connections
+def spawn_server(args):
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "socket_server.py"),
+               "--engine", args.spawn_server, "--host", args.host, "--port", str(args.port)]
+    command += ["--backlog", str(args.server_backlog)]
+    server = subprocess.Popen(command + args.server_args, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    for _ in range(100):
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                raise SystemExit(f"server exited with code {server.returncode}")
+            time.sleep(0.1)
+    server.kill()
+    raise SystemExit("server did not start listening")
+
+
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lab1 chat server load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--clients', type=int, default=1000, help='simulated clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of sending')
+    parser.add_argument('--rate', type=float, default=1, help='commands per second per client')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix('message=80,list=10,history=10'),
+                        help='weights of the commands, e.g. message=80,list=10,history=10')
+    parser.add_argument('--list-limit', type=int, default=100, help='page size of the list commands')
+    parser.add_argument('--connect-concurrency', type=int, default=100,
+                        help='connections opened at the same time during ramp-up')
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help='seconds until a connection without a greeting counts as failed')
+    parser.add_argument('--drain', type=float, default=5, help='seconds to wait for replies after sending')
+    parser.add_argument('--server-pid', type=int, default=None, help='report the RSS of this server process')
+    parser.add_argument('--spawn-server', choices=['thread', 'eventloop'], default=None,
+                        help='start socket_server.py with this engine for the run (and measure its RSS)')
+    parser.add_argument('--server-backlog', type=int, default=4096,
+                        help='--backlog of the spawned server, the threaded default of 5 drops connections on ramp-up')
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help='further arguments for the spawned server, must come last')
+    parser.add_argument('--label', default=None, help='name of this run in the JSON, e.g. the engine')
+    parser.add_argument('--output', default=None, help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+
+    raise_file_limit()
+    server = None
+    if args.spawn_server:
+        server = spawn_server(args)
+        args.server_pid = server.pid
+        args.label = args.label or args.spawn_server
+    try:
+        report = asyncio.run(run_benchmark(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        latency = report["latency_ms"]["delivery"]
+        print(f"{report['connected']} clients, {report['throughput_per_s']['commands']} commands/s, "
+              f"delivery p50 {latency.get('p50')} ms p99 {latency.get('p99')} ms p999 {latency.get('p999')} ms, "
+              f"written to {args.output}")
+    else:
+        print(text)
@@ -0,0 +1,330 @@
+# -*- coding:utf-8 -*-
+
+import asyncio
+import collections
+import os
+
+from file_transfer import announced_address, download_file, upload_file
+from framing import FRAME_MAGIC, FrameReader, encode_frame
+from heartbeat import PING, PONG
+
+
+#asyncio client library for the lab1 chat server, the importable counterpart of socket_client.py.
+#One ChatClient drives any number of sessions on one event loop. Every session is one connection and
+#one UUID on the server (the protocol has one UUID per connection) and speaks the framed protocol:
+#  - commands are queued and written once per loop iteration, so a burst of sends costs one write
+#  - list(), history(), room_history() and search() return futures resolved with the server's reply
+#  - everything else the server pushes (messages, room messages, presence deltas, errors) lands
+#    in session.messages, an asyncio.Queue
+#  - a lost connection is reopened with backoff and the session resumed under the same UUID
+#    ("session" / "resume <uuid> <token>"), rooms are joined again and unanswered list/history
+#    requests are sent again. Messages in flight while the connection was down may be lost.
+#  - send_file() and receive_file() move files over the server's file port (--file-port) in a thread
+#    of the default executor, resuming from where an earlier attempt stopped
+#Example:
+#  client = ChatClient('127.0.0.1', 9999)
+#  alice, bob = await client.open_sessions(2)
+#  alice.send(bob.uid, "hi")
+#  print(await bob.messages.get())
+#  print(await alice.history(bob.uid))
+#  await client.close()
+
+#Commands answered by a future, the server answers each of them in order
+REQUEST_KINDS = ("list", "history", "roomhistory", "search", "sendfile")
+#How the server's reply to some of them starts
+REPLY_TITLES = {"history": "\n\nYour history is:\n", "roomhistory": "\n\nRoom ", "search": "\n\nSearch results for "}
+TRANSFER_READY = "File transfer "
+ACK = "server had received your msg"
+
+
+class SessionClosed(ConnectionError):
+    pass
+
+
+#The server answered a list/history request with an error
+class ChatError(Exception):
+    pass
+
+
+#Which kind of request an error reply belongs to, None for errors about anything else.
+#Errors answering a command start with "Error: <command>: ", also when the rate limit refused it.
+def request_failed(frame):
+    if not frame.startswith("Error: "):
+        return None
+    command = frame[len("Error: "):].split(":", 1)[0]
+    return command if command in REQUEST_KINDS else None
+
+
+class ChatSession:
+    def __init__(self, host, port, reconnect_delay=0.5, max_reconnect_delay=10.0):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.uid = None
+        self.token = None
+        self.messages = asyncio.Queue()
+        self.rooms = set()  # joined again after a reconnect
+        self.acks = 0
+
+        self.reader = None
+        self.writer = None
+        self.frames = None
+        self.connected = asyncio.Event()
+        self.outgoing = []      # encoded frames waiting for the next flush
+        self.flush_scheduled = False
+        #Futures waiting for a reply, with the command to send again after a reconnect.
+        #The server answers each kind in order.
+        self.pending = {kind: collections.deque() for kind in REQUEST_KINDS}
+        self.handshake = None   # future of the "session" / "resume" reply while connecting
+        self.closing = False
+        self.task = None
+
+    #Connects and returns once the session has its UUID and resume token
+    async def open(self):
+        await self._connect(resume=False)
+        self.task = asyncio.ensure_future(self._run())
+        return self
+
+    # ---- commands ----
+
+    #Queue one raw command, it goes out with the next flush
+    def command(self, text):
+        if self.closing:
+            raise SessionClosed(f"session {self.uid} is closed")
+        self.outgoing.append(encode_frame(text))
+        if not self.flush_scheduled and self.connected.is_set():
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def send(self, receiver, text):
+        self.command(f"{receiver}: {text}")
+
+    def join(self, room):
+        self.rooms.add(room)
+        self.command(f"join {room}")
+
+    def leave(self, room):
+        self.rooms.discard(room)
+        self.command(f"leave {room}")
+
+    def send_room(self, room, text):
+        self.command(f"room {room}: {text}")
+
+    #Future of one page of online UUIDs
+    def list(self, offset=0, limit=None):
+        command = f"list {offset}" if limit is None else f"list {offset} {limit}"
+        return self._request("list", command)
+
+    #Future of one page of the conversation with 'receiver', the text under the server's title
+    def history(self, receiver, offset=0, limit=None):
+        command = f"history {receiver} {offset}" if limit is None else f"history {receiver} {offset} {limit}"
+        return self._request("history", command)
+
+    def room_history(self, room, offset=0, limit=None):
+        command = f"roomhistory {room} {offset}" if limit is None else f"roomhistory {room} {offset} {limit}"
+        return self._request("roomhistory", command)
+
+    #Future of the newest messages of the conversation with 'receiver' containing all the terms
+    def search(self, receiver, terms):
+        return self._request("search", f"search {receiver} {terms}")
+
+    #Sends the file at 'path' to 'receiver', returns the transfer id once the server has all of it.
+    #The receiver gets a "File <id> from ..." message to pass to receive_file().
+    async def send_file(self, receiver, path):
+        reply = await self._request("sendfile", f"sendfile {receiver} {os.path.basename(path)} {os.path.getsize(path)}")
+        transfer_id = reply.split()[2]
+        await asyncio.get_running_loop().run_in_executor(None, upload_file, announced_address(reply), transfer_id, path)
+        return transfer_id
+
+    #Downloads the file of a "File <id> from ..." notice to 'path', continuing a partial download
+    async def receive_file(self, notice, path):
+        transfer_id = notice.split()[1]
+        return await asyncio.get_running_loop().run_in_executor(
+            None, download_file, announced_address(notice), transfer_id, path)
+
+    def _request(self, kind, command):
+        future = asyncio.get_running_loop().create_future()
+        self.pending[kind].append((future, command))
+        self.command(command)
+        return future
+
+    #Say "exit" and wait for the server to close the connection
+    async def close(self):
+        if self.closing:
+            return
+        if self.connected.is_set():
+            self.command("exit")
+        self.closing = True
+        if self.task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.task), 5)
+            except asyncio.TimeoutError:
+                self.task.cancel()
+        self._fail_pending(SessionClosed(f"session {self.uid} is closed"))
+
+    # ---- connection ----
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.outgoing and self.connected.is_set():
+            self.writer.write(b"".join(self.outgoing))
+            self.outgoing.clear()
+
+    async def _connect(self, resume):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.writer.write(FRAME_MAGIC)
+        pending = b""
+        while FRAME_MAGIC not in pending:
+            data = await self.reader.read(4096)
+            if not data:
+                raise ConnectionError("server closed the connection during the greeting")
+            pending += data
+        greeting, rest = pending.split(FRAME_MAGIC, 1)
+        new_uid = greeting.decode().split(":", 1)[1].strip()  # "Your assigned UIUD is: <uuid> "
+        self.frames = FrameReader()
+
+        self._dispatch_all(self.frames.feed(rest))
+
+        if not (resume and self.token is not None and await self._handshake(f"resume {self.uid} {self.token}")):
+            if resume:
+                #The session expired or lives in another process, carry on under the new UUID
+                self.messages.put_nowait(f"Error: could not resume session {self.uid}, now {new_uid}")
+            self.uid, self.token = new_uid, None
+            await self._handshake("session")
+
+        #Restore what the server forgot with the old connection, ahead of anything queued
+        if resume:
+            replay = [encode_frame(f"join {room}") for room in sorted(self.rooms)]
+            for requests in self.pending.values():
+                replay += [encode_frame(command) for _, command in requests]
+            self.outgoing[:0] = replay
+        self.connected.set()
+        self._flush()
+
+    #Sends "session" or "resume" and reads until its reply arrived, returns whether it succeeded
+    async def _handshake(self, command):
+        self.handshake = asyncio.get_running_loop().create_future()
+        self.writer.write(encode_frame(command))
+        while not self.handshake.done():
+            data = await self.reader.read(256 * 1024)
+            if not data:
+                raise ConnectionError("server closed the connection during the handshake")
+            self._dispatch_all(self.frames.feed(data))
+        result, self.handshake = self.handshake.result(), None
+        return result
+
+    async def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                while True:
+                    data = await self.reader.read(256 * 1024)
+                    if not data:
+                        break
+                    self._dispatch_all(self.frames.feed(data))
+                    delay = self.reconnect_delay
+            except ConnectionError:
+                pass
+            self.connected.clear()
+            self.writer.close()
+            if self.closing:
+                return
+            #Reconnect with exponential backoff and resume the session
+            while True:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                try:
+                    await self._connect(resume=True)
+                    break
+                except OSError:
+                    continue
+
+    def _dispatch_all(self, frames):
+        for frame in frames:
+            self._dispatch(frame)
+
+    def _dispatch(self, frame):
+        if self.handshake is not None and not self.handshake.done():
+            if frame.startswith("Session "):
+                self.token = frame.split()[2]
+                self.handshake.set_result(True)
+                return
+            if frame.startswith("Resumed session "):
+                self.handshake.set_result(True)
+                return
+            #The resume was refused, or the rate limit did not run "session"
+            if frame.startswith("Error: resume: ") or frame.startswith("Error: session: "):
+                self.handshake.set_result(False)
+                return
+        if frame == ACK:
+            self.acks += 1
+            return
+        #Heartbeat of a server that has not heard from this session for a while
+        if frame == PING:
+            if not self.closing:
+                self.command(PONG)
+            return
+        for kind, title in REPLY_TITLES.items():
+            if frame.startswith(title) and self.pending[kind]:
+                #The page under the title line
+                self._resolve(kind, frame.split("\n", 3)[3])
+                return
+        if frame.startswith(TRANSFER_READY) and self.pending["sendfile"]:
+            self._resolve("sendfile", frame)
+            return
+        kind = request_failed(frame)
+        if kind is not None and self.pending[kind]:
+            self._resolve(kind, error=ChatError(frame))
+            return
+        #"list" replies are "\n UUID: <uuid> \n" lines plus an optional "(clients a-b of n ...)" footer
+        if self.pending["list"] and (frame == "" or frame.startswith("\n UUID:") or frame.startswith("\n(clients")):
+            self._resolve("list", [line.split()[1] for line in frame.splitlines() if line.startswith(" UUID:")])
+            return
+        self.messages.put_nowait(frame)
+
+    def _resolve(self, kind, result=None, error=None):
+        future, _ = self.pending[kind].popleft()
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def _fail_pending(self, error):
+        for requests in self.pending.values():
+            while requests:
+                future, _ = requests.popleft()
+                if not future.done():
+                    future.set_exception(error)
+
+
+class ChatClient:
+    #Opens and tracks the sessions of one server address
+    def __init__(self, host='127.0.0.1', port=9999, reconnect_delay=0.5, max_reconnect_delay=10.0):
+        self.host = host
+        self.port = port
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.sessions = []
+
+    async def open_session(self):
+        session = ChatSession(self.host, self.port, self.reconnect_delay, self.max_reconnect_delay)
+        await session.open()
+        self.sessions.append(session)
+        return session
+
+    #Opens 'count' sessions, at most 'concurrency' connecting at the same time
+    async def open_sessions(self, count, concurrency=100):
+        gate = asyncio.Semaphore(concurrency)
+
+        async def open_one():
+            async with gate:
+                return await self.open_session()
+
+        return await asyncio.gather(*(open_one() for _ in range(count)))
+
+    async def close(self):
+        await asyncio.gather(*(session.close() for session in self.sessions))
+        self.sessions.clear()
@@ -0,0 +1,348 @@
+# -*- coding:utf-8 -*-
+
+import asyncio
+import functools
+import itertools
+import json
+import os
+import sys
+import uuid
+
+from framing import FrameReader, encode_frame
+from registry import uid_key
+from workers import CHANNEL_MAX_FRAME_SIZE, PeerChannel
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'hash', 'consistent-hash'))
+from consistent_hash import ConsistentHash, StorageNode  # noqa: E402
+
+
+#Several lab1 servers run as one chat service. Every node is named by its cluster address "host:port"
+#and sits on a ConsistentHash ring that maps
+#  client UUIDs      a node only hands out UUIDs that hash to itself, so any node finds the node holding
+#                    a client with one ring lookup and the message arrives with one extra hop
+#  conversation ids  the node that keeps the history of the conversation
+#Nodes talk over TCP with length-prefixed JSON frames (like the worker channel):
+#  hello / members   first frame of every peer connection; a node joins through a seed, learns the
+#                    members and connects to each of them. Every node adds or removes the ring
+#                    entries of one node at a time, the ring is never rebuilt
+#  leave             a node shuts down after handing its conversations to their new owners
+#  migrate           records of a conversation moving to its new owner, in chunks
+#  hold / release    a client stays on its node when a ring change maps its UUID elsewhere,
+#                    the new owner is told where it is and forwards (a second hop) until it leaves
+#  deliver / undeliverable, room, append, history / search / page   as in workers.py
+RING_SLOTS = 2 ** 32
+VIRTUAL_NODES = 32  # ring positions per node, so a few nodes still get even shares
+MIGRATE_CHUNK = 1000  # records per migrate frame
+
+
+class ClusterLink:
+    #Stands in for a client held by another node: send() hands the bytes to the node owning its UUID
+    def __init__(self, cluster, uid, sender):
+        self.cluster = cluster
+        self.uid = uid
+        self.sender = sender
+
+    def send(self, data):
+        self.cluster.route(self.uid, data.decode(), self.sender, self.cluster.node_id)
+        return True
+
+    def sendall(self, data):
+        self.send(data)
+
+
+class ClusterNode:
+    #Cluster membership, routing and history ownership of one node. The server passes in
+    #  store                                  its history (MemoryHistory or HistoryStore)
+    #  clients                                SessionRegistry of the clients connected to this node
+    #  deliver / deliver_room / append_history / history_text / search_text   as for WorkerCluster
+    def __init__(self, node_id, seeds, store, clients, deliver, deliver_room, append_history, history_text,
+                 search_text=None):
+        self.node_id = node_id
+        self.seeds = [seed for seed in seeds if seed != node_id]
+        self.store = store
+        self.clients = clients
+        self.deliver = deliver
+        self.deliver_room = deliver_room
+        self.append_history_local = append_history
+        self.history_text = history_text
+        self.search_text = search_text
+
+        self.ring = ConsistentHash(RING_SLOTS)
+        self.ring_nodes = {}  # node id: its StorageNodes on the ring
+        self._add_to_ring(node_id)
+        self.peers = {}       # node id: PeerChannel to that node
+        self.held_elsewhere = {}  # UUID hashing to this node: node still holding that client
+        self.staged = {}      # conversation id: records received so far by an unfinished migration
+        self.request_ids = itertools.count()
+        self.waiting = {}
+        self.tasks = []
+        self.server = None
+        self.leaving = False
+
+    async def start(self):
+        host, port = self.node_id.rsplit(":", 1)
+        self.server = await asyncio.start_server(self._serve_peer, host, int(port))
+        for seed in self.seeds:
+            self._connect(seed)
+        print(f"Cluster node {self.node_id} started, seeds: {', '.join(self.seeds) or 'none'}")
+
+    # ---- ring ----
+
+    def _add_to_ring(self, node_id):
+        nodes = [StorageNode(name=node_id, host=f"{node_id}#{i}") for i in range(VIRTUAL_NODES)]
+        for node in nodes:
+            self.ring.add_node(node)
+        self.ring_nodes[node_id] = nodes
+
+    def _remove_from_ring(self, node_id):
+        for node in self.ring_nodes.pop(node_id):
+            self.ring.remove_node(node)
+
+    def owner(self, key):
+        if not self.ring.nodes:
+            #Every other node left while this one was leaving too
+            return self.node_id
+        return self.ring.assign(str(key)).name
+
+    def owns(self, conversation):
+        return self.owner(conversation) == self.node_id
+
+    @property
+    def count(self):
+        return len(self.ring_nodes)
+
+    #A fresh client UUID that hashes to this node, about one try per node in the ring
+    def mint_client_id(self):
+        while True:
+            client_id = str(uuid.uuid4())
+            if self.owns(client_id):
+                return client_id
+
+    # ---- peers ----
+
+    def _connect(self, node_id):
+        if node_id in self.peers:
+            return
+        host, port = node_id.rsplit(":", 1)
+        peer = PeerChannel(functools.partial(asyncio.open_connection, host, int(port)), retries=100)
+        self.peers[node_id] = peer
+        self.send_to(node_id, {"t": "hello", "node": self.node_id})
+        self.tasks.append(asyncio.ensure_future(self._run_peer(node_id, peer)))
+
+    async def _run_peer(self, node_id, peer):
+        try:
+            await peer.connect()
+        except OSError:
+            print(f"Cluster node {node_id} is not reachable")
+            self._node_gone(node_id)
+
+    def send_to(self, node_id, message):
+        peer = self.peers.get(node_id)
+        if peer is not None:
+            peer.send(encode_frame(json.dumps(message), CHANNEL_MAX_FRAME_SIZE))
+
+    def broadcast(self, message):
+        frame = encode_frame(json.dumps(message), CHANNEL_MAX_FRAME_SIZE)
+        for peer in self.peers.values():
+            peer.send(frame)
+
+    # ---- the interface socket_server uses, shared with WorkerCluster ----
+
+    def remote_link(self, uid, sender=None):
+        if not self.knows_remote(uid):
+            return None
+        return ClusterLink(self, uid, sender)
+
+    #Whether a UUID that is not connected here may be connected to another node, never for text
+    #that is not a UUID
+    def knows_remote(self, uid):
+        if uid_key(uid) is None:
+            return False
+        return not self.owns(uid) or uid in self.held_elsewhere
+
+    def announce_join(self, uid):
+        pass
+
+    def announce_leave(self, uid):
+        if self.leaving:
+            return
+        owner = self.owner(uid)
+        if owner != self.node_id:
+            self.send_to(owner, {"t": "release", "uid": uid, "node": self.node_id})
+
+    def broadcast_room(self, name, exclude_uid, data):
+        self.broadcast({"t": "room", "name": name, "exclude": exclude_uid, "data": data.decode()})
+
+    def append_history(self, conversation, sender, message):
+        self.send_to(self.owner(conversation), {"t": "append", "conv": conversation, "sender": sender, "msg": message})
+
+    def request_history(self, conversation, offset, limit, reply):
+        request_id = next(self.request_ids)
+        self.waiting[request_id] = reply
+        self.send_to(self.owner(conversation), {"t": "history", "req": request_id, "from": self.node_id,
+                                                 "conv": conversation, "offset": offset, "limit": limit})
+
+    def request_search(self, conversation, query, reply):
+        request_id = next(self.request_ids)
+        self.waiting[request_id] = reply
+        self.send_to(self.owner(conversation), {"t": "search", "req": request_id, "from": self.node_id,
+                                                 "conv": conversation, "query": query})
+
+    #Deliver to a client here, or pass the message to the node that owns or holds it
+    def route(self, uid, data, sender, origin):
+        holder = self.held_elsewhere.get(uid)
+        if holder is not None:
+            self.send_to(holder, {"t": "deliver", "uid": uid, "data": data, "from": sender, "origin": origin})
+            return
+        owner = self.owner(uid)
+        if owner != self.node_id:
+            self.send_to(owner, {"t": "deliver", "uid": uid, "data": data, "from": sender, "origin": origin})
+        elif not self.deliver(uid, data.encode()) and sender is not None:
+            self.send_to(origin, {"t": "undeliverable", "uid": uid, "to": sender})
+
+    # ---- rebalancing ----
+
+    #After every ring change: hand conversations to their new owners and tell new owners
+    #of local clients where those clients are. Only keys whose owner changed move.
+    def _rebalance(self):
+        for conversation in self.store.conversation_ids():
+            if not self.owns(conversation):
+                self._migrate(conversation)
+        for uid in self.clients.uids():
+            owner = self.owner(uid)
+            if owner != self.node_id:
+                self.send_to(owner, {"t": "hold", "uid": uid, "node": self.node_id})
+        for uid in [uid for uid in self.held_elsewhere if not self.owns(uid)]:
+            del self.held_elsewhere[uid]
+
+    def _migrate(self, conversation):
+        owner = self.owner(conversation)
+        log = self.store.conversation(conversation)
+        total = len(log) if log is not None else 0
+        for offset in range(0, max(total, 1), MIGRATE_CHUNK):
+            records = log.read(offset, MIGRATE_CHUNK) if log is not None else []
+            self.send_to(owner, {"t": "migrate", "conv": conversation, "records": records,
+                                 "last": offset + MIGRATE_CHUNK >= total})
+        self.store.drop(conversation)
+        print(f"Conversation {conversation} ({total} messages) moved to {owner}")
+
+    #Migrated records go in front of anything appended here while they were in flight
+    def _import(self, conversation, records, last):
+        self.staged.setdefault(conversation, []).extend(records)
+        if not last:
+            return
+        records = self.staged.pop(conversation)
+        existing = self.store.conversation(conversation)
+        if existing is not None and len(existing):
+            records.extend(existing.read(0, len(existing)))
+            self.store.drop(conversation)
+        log = self.store.conversation(conversation, create=True)
+        for sender, message in records:
+            log.append(sender, message)
+        #The ring may have changed again while the records were in flight
+        if not self.owns(conversation):
+            self._migrate(conversation)
+
+    def _node_joined(self, node_id):
+        if self.leaving or node_id == self.node_id or node_id in self.ring_nodes:
+            return
+        self._connect(node_id)
+        self._add_to_ring(node_id)
+        print(f"Cluster node {node_id} joined, {self.count} nodes")
+        self._rebalance()
+
+    def _node_gone(self, node_id):
+        peer = self.peers.pop(node_id, None)
+        if peer is not None and peer.writer is not None:
+            peer.writer.close()
+        for uid in [uid for uid, holder in self.held_elsewhere.items() if holder == node_id]:
+            del self.held_elsewhere[uid]
+        if node_id in self.ring_nodes and not self.leaving:
+            self._remove_from_ring(node_id)
+            print(f"Cluster node {node_id} left, {self.count} nodes")
+            self._rebalance()
+
+    #Graceful shutdown: tell the others, then hand over every conversation.
+    #The leave goes first on every channel so no node sends migrated records back here.
+    async def leave(self):
+        self.leaving = True
+        if self.count > 1:
+            self.broadcast({"t": "leave", "node": self.node_id})
+            self._remove_from_ring(self.node_id)
+            for conversation in self.store.conversation_ids():
+                self._migrate(conversation)
+        for peer in self.peers.values():
+            if peer.writer is not None:
+                await peer.writer.drain()
+                peer.writer.close()
+
+    # ---- inbound ----
+
+    async def _serve_peer(self, reader, writer):
+        frames = FrameReader(max_size=CHANNEL_MAX_FRAME_SIZE)
+        node_id = None
+        while True:
+            try:
+                data = await reader.read(256 * 1024)
+            except (ConnectionError, asyncio.CancelledError):
+                #Peer reset, or this node is shutting down
+                break
+            if not data:
+                break
+            for frame in frames.feed(data):
+                message = json.loads(frame)
+                if message["t"] == "hello":
+                    node_id = message["node"]
+                try:
+                    self._handle(message)
+                except ConnectionError:
+                    pass
+        writer.close()
+        #The sender of a hello went away without a leave: treat it as failed
+        if node_id is not None and node_id in self.ring_nodes:
+            self._node_gone(node_id)
+
+    def _handle(self, message):
+        kind = message["t"]
+        if kind == "deliver":
+            if message["uid"] in self.clients:
+                self.deliver(message["uid"], message["data"].encode())
+            else:
+                self.route(message["uid"], message["data"], message["from"], message["origin"])
+        elif kind == "undeliverable":
+            self.deliver(message["to"], f"Error: No socket found for UID {message['uid']}".encode())
+        elif kind == "room":
+            self.deliver_room(message["name"], message["exclude"], message["data"].encode())
+        elif kind == "append":
+            if self.owns(message["conv"]):
+                self.append_history_local(message["conv"], message["sender"], message["msg"])
+            else:
+                self.append_history(message["conv"], message["sender"], message["msg"])
+        elif kind in ("history", "search"):
+            if self.owns(message["conv"]) or message["conv"] in self.staged:
+                if kind == "history":
+                    text = self.history_text(message["conv"], message["offset"], message["limit"])
+                else:
+                    text = self.search_text(message["conv"], message["query"])
+                self.send_to(message["from"], {"t": "page", "req": message["req"], "text": text})
+            else:
+                self.send_to(self.owner(message["conv"]), message)
+        elif kind == "page":
+            reply = self.waiting.pop(message["req"], None)
+            if reply is not None:
+                reply(message["text"])
+        elif kind == "migrate":
+            self._import(message["conv"], [tuple(record) for record in message["records"]], message["last"])
+        elif kind == "hold":
+            self.held_elsewhere[message["uid"]] = message["node"]
+        elif kind == "release":
+            if self.held_elsewhere.get(message["uid"]) == message["node"]:
+                del self.held_elsewhere[message["uid"]]
+        elif kind == "hello":
+            self._node_joined(message["node"])
+            self.send_to(message["node"], {"t": "members", "nodes": list(self.ring_nodes)})
+        elif kind == "members":
+            for node_id in message["nodes"]:
+                self._node_joined(node_id)
+        elif kind == "leave":
+            self._node_gone(message["node"])
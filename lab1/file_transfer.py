@@ -0,0 +1,244 @@
+# -*- coding:utf-8 -*-
+
+import os
+import re
+import secrets
+import select
+import socket
+import threading
+import time
+
+
+#File transfers between chat clients.
+#"sendfile <uuid> <name> <size>" on the chat connection registers a transfer, the bytes themselves go over
+#separate connections to the file port so chat traffic on either side never waits behind a file:
+#  upload <id>\n               server answers "offset <n>\n" (bytes it already has), the client sends the
+#                              rest, the server answers "done <size>\n" once the file is complete
+#  download <id> <offset>\n    server answers "size <size>\n" and sends the file from <offset> on
+#Errors are answered with "error <reason>\n" and the connection is closed.
+#Uploads are spooled to a file with os.splice (socket -> pipe -> file in the kernel) where available,
+#else recv_into one reusable buffer; downloads use socket.sendfile. The data never becomes a Python string.
+#Both directions resume from an offset, so a broken transfer continues where it stopped.
+
+FILE_NAME = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+MAX_FILE_SIZE = 1 << 32  # 4 GiB
+TRANSFER_TTL = 3600  # seconds a transfer and its spool file are kept
+HEADER_LIMIT = 512
+CHUNK_SIZE = 1 << 20
+DATA_TIMEOUT = 60  # seconds a data connection may stay silent
+
+
+class Transfer:
+    def __init__(self, transfer_id, sender, receiver, name, size, path):
+        self.id = transfer_id
+        self.sender = sender
+        self.receiver = receiver
+        self.name = name
+        self.size = size
+        self.path = path
+        self.created = time.monotonic()
+        self.uploading = False
+
+    #Bytes spooled so far, the file on disk is the only state so a restart of the upload picks it up
+    @property
+    def received(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+
+class FileTransfers:
+    #Registry of transfers and the file port serving them.
+    #'notify(uid, text)' tells a chat client about its transfer, from a transfer thread.
+    def __init__(self, spool_dir, address, notify, ttl=TRANSFER_TTL):
+        self.spool_dir = spool_dir
+        self.address = address  # (host, port) of the file port, as announced to clients
+        self.notify = notify
+        self.ttl = ttl
+        self.transfers = {}  # transfer id: Transfer
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def create(self, sender, receiver, name, size):
+        self.expire()
+        transfer_id = secrets.token_hex(8)
+        transfer = Transfer(transfer_id, sender, receiver, name, size, os.path.join(self.spool_dir, transfer_id))
+        open(transfer.path, "wb").close()
+        with self.lock:
+            self.transfers[transfer_id] = transfer
+        return transfer
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [transfer for transfer in self.transfers.values() if now - transfer.created > self.ttl]
+            for transfer in expired:
+                del self.transfers[transfer.id]
+        for transfer in expired:
+            self._remove_spool(transfer)
+
+    def _remove_spool(self, transfer):
+        try:
+            os.remove(transfer.path)
+        except FileNotFoundError:
+            pass
+
+    #Accepts data connections on a background thread, one thread per transfer
+    def serve(self, ip_port):
+        sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sk.bind(ip_port)
+        sk.listen(64)
+
+        def accept_loop():
+            while True:
+                conn, _ = sk.accept()
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=accept_loop, name="file-port", daemon=True).start()
+        return sk
+
+    def _handle(self, conn):
+        conn.settimeout(DATA_TIMEOUT)
+        try:
+            parts = read_header(conn).split()
+            transfer = self.transfers.get(parts[1]) if len(parts) > 1 else None
+            if transfer is None:
+                conn.sendall(b"error unknown transfer\n")
+            elif parts[0] == "upload" and len(parts) == 2:
+                self._upload(conn, transfer)
+            elif parts[0] == "download" and len(parts) == 3 and parts[2].isdigit():
+                self._download(conn, transfer, int(parts[2]))
+            else:
+                conn.sendall(b"error use 'upload <id>' or 'download <id> <offset>'\n")
+        except (OSError, ValueError):
+            pass
+        finally:
+            conn.close()
+
+    def _upload(self, conn, transfer):
+        with self.lock:
+            if transfer.uploading:
+                conn.sendall(b"error the transfer is being uploaded on another connection\n")
+                return
+            transfer.uploading = True
+        try:
+            offset = transfer.received
+            conn.sendall(f"offset {offset}\n".encode())
+            if offset < transfer.size:
+                with open(transfer.path, "r+b") as spool:
+                    receive_into_file(conn, spool, offset, transfer.size - offset)
+        finally:
+            transfer.uploading = False
+        if transfer.complete:
+            conn.sendall(f"done {transfer.size}\n".encode())
+            host, port = self.address
+            self.notify(transfer.receiver, f"File {transfer.id} from {transfer.sender}: {transfer.name} "
+                                           f"({transfer.size} bytes), download it from {host}:{port}")
+            self.notify(transfer.sender, f"File {transfer.id} ({transfer.name}) uploaded, {transfer.receiver} was told")
+
+    def _download(self, conn, transfer, offset):
+        if not transfer.complete:
+            conn.sendall(b"error the upload is not complete yet\n")
+            return
+        if offset > transfer.size:
+            conn.sendall(b"error offset is past the end of the file\n")
+            return
+        conn.sendall(f"size {transfer.size}\n".encode())
+        with open(transfer.path, "rb") as spool:
+            conn.sendfile(spool, offset, transfer.size - offset)
+        #Delivered to the end: the spool is not needed any more
+        with self.lock:
+            self.transfers.pop(transfer.id, None)
+        self._remove_spool(transfer)
+
+
+#One "\n" terminated header line, peeked first so no file bytes after it are consumed
+def read_header(conn):
+    data = conn.recv(HEADER_LIMIT, socket.MSG_PEEK)
+    end = data.find(b"\n")
+    if end < 0:
+        raise ValueError("no header line")
+    return conn.recv(end + 1).decode().strip()
+
+
+#Moves up to 'count' bytes from a socket into a file at 'offset' without Python bytes objects in between
+def receive_into_file(conn, spool, offset, count):
+    if hasattr(os, "splice"):
+        read_end, write_end = os.pipe()
+        try:
+            while count > 0:
+                try:
+                    moved = os.splice(conn.fileno(), write_end, min(count, CHUNK_SIZE))
+                except BlockingIOError:
+                    #A socket with a timeout is non-blocking underneath, wait for data like recv would
+                    if not select.select([conn], [], [], conn.gettimeout())[0]:
+                        raise TimeoutError("data connection timed out")
+                    continue
+                if moved == 0:
+                    return
+                count -= moved
+                while moved > 0:
+                    written = os.splice(read_end, spool.fileno(), moved, offset_dst=offset)
+                    offset += written
+                    moved -= written
+        finally:
+            os.close(read_end)
+            os.close(write_end)
+    else:
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        spool.seek(offset)
+        while count > 0:
+            n = conn.recv_into(view[:min(count, CHUNK_SIZE)])
+            if n == 0:
+                return
+            spool.write(view[:n])
+            count -= n
+
+
+#"host:port" at the end of a "File transfer ... ready" reply or a "File ... from" notice
+def announced_address(text):
+    host, port = text.rsplit(None, 1)[1].rsplit(":", 1)
+    return host, int(port)
+
+
+#Client side, blocking: upload 'path' for transfer 'transfer_id', resuming from what the server already has
+def upload_file(address, transfer_id, path):
+    with socket.create_connection(address) as conn:
+        conn.sendall(f"upload {transfer_id}\n".encode())
+        reply = conn.makefile("rb")
+        kind, value = reply.readline().decode().split(None, 1)
+        if kind != "offset":
+            raise ConnectionError(value.strip())
+        with open(path, "rb") as f:
+            conn.sendfile(f, int(value))
+        kind, value = reply.readline().decode().split(None, 1)
+        if kind != "done":
+            raise ConnectionError(value.strip())
+        return int(value)
+
+
+#Client side, blocking: download transfer 'transfer_id' into 'path', resuming a partial file
+def download_file(address, transfer_id, path):
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    with socket.create_connection(address) as conn:
+        conn.sendall(f"download {transfer_id} {offset}\n".encode())
+        reply = conn.makefile("rb")
+        kind, value = reply.readline().decode().split(None, 1)
+        if kind != "size":
+            raise ConnectionError(value.strip())
+        size = int(value)
+        with open(path, "ab") as f:
+            while offset < size:
+                data = reply.read1(CHUNK_SIZE)
+                if not data:
+                    raise ConnectionError(f"connection closed at {offset} of {size} bytes")
+                f.write(data)
+                offset += len(data)
+        return size
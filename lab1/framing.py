@@ -0,0 +1,158 @@
+# -*- coding:utf-8 -*-
+
+import struct
+
+
+#Length-prefixed framing for the lab1 chat protocol
+#A frame is a 4 byte big-endian payload length followed by the utf-8 payload.
+#A client switches a connection to frames by sending FRAME_MAGIC as its very first bytes,
+#the server echoes FRAME_MAGIC back and frames everything it sends after that.
+#Clients that never send the magic keep the old one-recv-per-command text protocol.
+FRAME_MAGIC = b"\x00FRM"
+HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 1 << 20  # 1 MiB, larger frames close the connection
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+#Encode one payload (str or bytes) as a frame
+def encode_frame(payload, max_size=MAX_FRAME_SIZE):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(payload) > max_size:
+        raise FrameTooLarge(f"frame of {len(payload)} bytes is over the {max_size} byte limit")
+    return HEADER.pack(len(payload)) + payload
+
+
+#Encode several payloads into one buffer so they go out with a single send
+def encode_frames(payloads):
+    return b"".join(encode_frame(payload) for payload in payloads)
+
+
+class FrameReader:
+    #Reads frames into one reusable bytearray.
+    #Bytes land in the free tail of the buffer (recv_into / BufferedProtocol.get_buffer),
+    #and every wakeup drains all complete frames in it, so pipelined commands cost one syscall.
+    #A read that fills the buffer makes it grow for the next one, and a grown buffer goes back to
+    #'size' once it is drained after a read that did not fill it, so idle connections stay small.
+    #keep=False goes further and lets go of a drained buffer until the next read (servers with many
+    #idle connections trade a small allocation per read for no buffer at all while idle).
+    __slots__ = ("buffer", "size", "keep", "max_size", "start", "end", "received", "full")
+
+    def __init__(self, size=64 * 1024, max_size=MAX_FRAME_SIZE, keep=True):
+        self.buffer = bytearray(size) if keep else b""
+        self.size = size
+        self.keep = keep
+        self.max_size = max_size
+        self.start = 0  # first unread byte
+        self.end = 0    # one past the last received byte
+        self.received = 0  # bytes received over the reader's lifetime
+        self.full = False  # the last read filled the buffer, more is probably waiting
+
+    #Free space at the tail of the buffer, compacting or growing it first if it is short
+    def get_buffer(self, min_free=4096):
+        if not self.buffer:
+            self.buffer = bytearray(max(self.size, min_free))
+        if self.full:
+            self.full = False
+            min_free = max(min_free, len(self.buffer))
+        if len(self.buffer) - self.end < min_free:
+            pending = self.end - self.start
+            if self.start:
+                self.buffer[:pending] = self.buffer[self.start:self.end]
+                self.start, self.end = 0, pending
+            if len(self.buffer) - self.end < min_free:
+                #A memoryview handed out earlier may still be alive (asyncio keeps it during
+                #buffer_updated), so grow into a new bytearray instead of resizing this one
+                grown = bytearray(len(self.buffer) + max(len(self.buffer), min_free))
+                grown[:pending] = self.buffer[:pending]
+                self.buffer = grown
+        return memoryview(self.buffer)[self.end:]
+
+    #Record that n bytes were written into the buffer returned by get_buffer
+    def buffer_updated(self, n):
+        self.end += n
+        self.received += n
+        self.full = self.end == len(self.buffer)
+
+    #Copy already received bytes into the buffer, e.g. what followed FRAME_MAGIC in the first read
+    def feed(self, data):
+        self.get_buffer(len(data))[:len(data)] = data
+        self.buffer_updated(len(data))
+        return self.frames()
+
+    #One recv_into on a blocking socket, returns the complete frames or None once the peer closed
+    def recv_into(self, sock):
+        n = sock.recv_into(self.get_buffer())
+        if n == 0:
+            return None
+        self.buffer_updated(n)
+        return self.frames()
+
+    #Pop every complete frame out of the buffer as a decoded command
+    def frames(self):
+        frames = []
+        buffer = self.buffer
+        while self.end - self.start >= HEADER.size:
+            (length,) = HEADER.unpack_from(buffer, self.start)
+            if length > self.max_size:
+                raise FrameTooLarge(f"peer announced a frame of {length} bytes")
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                #Make sure the whole frame fits before the next read
+                self.get_buffer(frame_end - self.end)
+                break
+            frames.append(bytes(buffer[self.start + HEADER.size:frame_end]).decode())
+            self.start = frame_end
+        if self.start == self.end:
+            self._drained()
+        return frames
+
+    #Hand back everything received so far as raw bytes (text protocol connections)
+    def take_raw(self):
+        data = bytes(self.buffer[self.start:self.end])
+        self._drained()
+        return data
+
+    def _drained(self):
+        self.start = self.end = 0
+        if self.full:
+            return
+        if not self.keep:
+            self.buffer = b""  # get_buffer allocates a fresh one for the next read
+        elif len(self.buffer) > self.size:
+            self.buffer = bytearray(self.size)
+
+
+class FramedLink:
+    #Wraps a client's outbound queue so every send to a framed client goes out as one frame
+    def __init__(self, link):
+        self.link = link
+
+    def send(self, data, policy=None):
+        return self.link.send(encode_frame(data), policy)
+
+    def sendall(self, data):
+        self.link.sendall(encode_frame(data))
+
+    def close(self):
+        self.link.close()
+
+
+#Send one payload to many links, encoding it once as text and at most once as a frame.
+#Returns how many links accepted it.
+def send_to_all(links, payload):
+    framed_payload = None
+    delivered = 0
+    for link in links:
+        if isinstance(link, FramedLink):
+            if framed_payload is None:
+                framed_payload = encode_frame(payload)
+            sent = link.link.send(framed_payload)
+        else:
+            sent = link.send(payload)
+        if sent:
+            delivered += 1
+    return delivered
@@ -0,0 +1,44 @@
+# -*- coding:utf-8 -*-
+
+import time
+
+
+#A client that sent nothing for HEARTBEAT_INTERVAL seconds gets a "ping", which clients answer with "pong".
+#One that stays silent for IDLE_TIMEOUT seconds is taken for dead and disconnected.
+HEARTBEAT_INTERVAL = 30
+IDLE_TIMEOUT = 120
+MIN_SWEEP_PERIOD = 0.1  # the reapers never sweep more often than this
+PING = "ping"
+PONG = "pong"
+
+
+class IdleTracker:
+    #Pings and drops silent clients. When a client was last heard from lives in its Session record
+    #(last_seen, pinged), so marking a client is one attribute store. The reaper walks all sessions once
+    #per sweep and hands back the ones to ping and the ones to drop, so a burst of dead connections is
+    #removed together instead of one timer per client.
+    def __init__(self, interval=HEARTBEAT_INTERVAL, timeout=IDLE_TIMEOUT):
+        self.interval = interval
+        self.timeout = timeout  # 0: never disconnect idle clients
+
+    def seen(self, session):
+        session.last_seen = time.monotonic()
+        session.pinged = False
+
+    #(sessions to ping, sessions to disconnect)
+    def sweep(self, sessions, now=None):
+        now = time.monotonic() if now is None else now
+        to_ping, to_reap = [], []
+        for session in sessions:
+            idle = now - session.last_seen
+            if self.timeout and idle >= self.timeout:
+                to_reap.append(session)
+            elif idle >= self.interval and not session.pinged:
+                session.pinged = True
+                to_ping.append(session)
+        return to_ping, to_reap
+
+    #Seconds between sweeps, often enough that a client is dropped soon after its timeout
+    @property
+    def period(self):
+        return max(min(self.interval, self.timeout or self.interval) / 2, MIN_SWEEP_PERIOD)
@@ -0,0 +1,86 @@
+# -*- coding:utf-8 -*-
+
+import threading
+
+
+#Number of messages per segment, a full segment is never copied or resized again
+SEGMENT_SIZE = 1024
+
+#Page size used when "history <uuid>" has no limit
+DEFAULT_PAGE_SIZE = 100
+
+
+class ConversationLog:
+    #Append-only message log of one conversation.
+    #Records are (sender, message) tuples kept in fixed-size segments, so an append is O(1)
+    #and a page read only touches the segments that hold the requested range.
+    #Both clients' threads append to a conversation on the threaded engine, so appends take the lock:
+    #two of them starting a segment at once would leave a short one and shift every later position.
+    __slots__ = ("segments", "count", "lock", "__weakref__")
+
+    def __init__(self):
+        self.segments = [[]]
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    #Add one message to the end of the conversation
+    def append(self, sender, message):
+        with self.lock:
+            segment = self.segments[-1]
+            if len(segment) == SEGMENT_SIZE:
+                segment = []
+                self.segments.append(segment)
+            segment.append((sender, message))
+            self.count += 1
+
+    #Return up to 'limit' records starting at 'offset' (negative offsets count from the end)
+    def read(self, offset=0, limit=DEFAULT_PAGE_SIZE):
+        if offset < 0:
+            offset = max(self.count + offset, 0)
+        end = min(offset + limit, self.count)
+
+        records = []
+        position = offset
+        while position < end:
+            segment = self.segments[position // SEGMENT_SIZE]
+            start = position % SEGMENT_SIZE
+            stop = min(SEGMENT_SIZE, start + end - position)
+            records.extend(segment[start:stop])
+            position += stop - start
+        return records
+
+
+#Render records the way the history string always looked: one "sender: message" per line
+def format_records(records):
+    return "\n".join(f"{sender}: {message}" for sender, message in records)
+
+
+class MemoryHistory(dict):
+    #Conversation id -> ConversationLog kept in process memory, lost on restart.
+    #With 'ids' (registry.ClientIds) conversations are kept under their interned ids, and the string
+    #names other processes use are accepted too and handed out by conversation_ids().
+    def __init__(self, ids=None):
+        super().__init__()
+        self.ids = ids
+
+    def conversation(self, conversation_id, create=False):
+        if self.ids is not None:
+            conversation_id = self.ids.key(conversation_id)
+        conversation = self.get(conversation_id)
+        if conversation is None and create:
+            conversation = self.setdefault(conversation_id, ConversationLog())
+        return conversation
+
+    def conversation_ids(self):
+        if self.ids is not None:
+            return [self.ids.name(conversation_id) for conversation_id in list(self.keys())]
+        return list(self.keys())
+
+    #Forget a conversation, e.g. after it moved to another cluster node
+    def drop(self, conversation_id):
+        if self.ids is not None:
+            conversation_id = self.ids.key(conversation_id)
+        self.pop(conversation_id, None)
@@ -0,0 +1,198 @@
+# -*- coding:utf-8 -*-
+
+import mmap
+import os
+import struct
+import threading
+import weakref
+from collections import OrderedDict
+
+from history_log import DEFAULT_PAGE_SIZE
+
+
+#On-disk chat history: every conversation is a pair of files in the history directory
+#  <conversation id>.log  records back to back: 2 byte sender length, sender, message (utf-8)
+#  <conversation id>.idx  one 8 byte end offset per record, record i is log[end[i-1]:end[i]]
+#A restart only lists the directory, the record count of a conversation is the index size / 8,
+#and history pages are sliced out of the memory-mapped files without loading the rest.
+INDEX_ENTRY = struct.Struct("<Q")
+SENDER_LENGTH = struct.Struct("<H")
+
+
+class DiskConversationLog:
+    #Append-only log of one conversation, same append/read/len interface as ConversationLog
+    def __init__(self, path_prefix, fsync=False):
+        self.data_path = path_prefix + ".log"
+        self.index_path = path_prefix + ".idx"
+        self.fsync = fsync  # fsync after every append, otherwise writes survive a crash of this process only
+        self.lock = threading.Lock()
+        self.data_fd = None
+        self.index_fd = None
+        self.data_map = None
+        self.index_map = None
+        self.count = 0
+        self.data_end = 0
+
+    def __len__(self):
+        with self.lock:
+            self._ensure_open()
+            return self.count
+
+    #Open the files and drop anything a crash left behind the last complete index entry
+    def _ensure_open(self):
+        if self.index_fd is not None:
+            return
+        flags = os.O_RDWR | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+        self.data_fd = os.open(self.data_path, flags, 0o644)
+        self.index_fd = os.open(self.index_path, flags, 0o644)
+
+        index_size = os.fstat(self.index_fd).st_size
+        if index_size % INDEX_ENTRY.size:
+            index_size -= index_size % INDEX_ENTRY.size
+            os.ftruncate(self.index_fd, index_size)
+        self.count = index_size // INDEX_ENTRY.size
+        if self.count:
+            (self.data_end,) = INDEX_ENTRY.unpack(os.pread(self.index_fd, INDEX_ENTRY.size, index_size - INDEX_ENTRY.size))
+        else:
+            self.data_end = 0
+        if os.fstat(self.data_fd).st_size > self.data_end:
+            os.ftruncate(self.data_fd, self.data_end)
+
+    #Add one message to the end of the conversation
+    def append(self, sender, message):
+        sender = str(sender).encode()
+        record = SENDER_LENGTH.pack(len(sender)) + sender + message.encode()
+        with self.lock:
+            self._ensure_open()
+            #Record first, index entry second: an index entry always points at a complete record
+            os.write(self.data_fd, record)
+            self.data_end += len(record)
+            os.write(self.index_fd, INDEX_ENTRY.pack(self.data_end))
+            self.count += 1
+            if self.fsync:
+                os.fsync(self.data_fd)
+                os.fsync(self.index_fd)
+
+    #Return up to 'limit' records starting at 'offset' (negative offsets count from the end)
+    def read(self, offset=0, limit=DEFAULT_PAGE_SIZE):
+        with self.lock:
+            self._ensure_open()
+            if offset < 0:
+                offset = max(self.count + offset, 0)
+            end = min(offset + limit, self.count)
+            if offset >= end:
+                return []
+            self._map_files()
+
+            #End offsets of the page plus the one before it, where the first record starts
+            first = offset - 1 if offset else 0
+            ends = struct.unpack_from(f"<{end - first}Q", self.index_map, first * INDEX_ENTRY.size)
+            if not offset:
+                ends = (0,) + ends
+
+            records = []
+            data = self.data_map
+            for start, stop in zip(ends, ends[1:]):
+                (sender_length,) = SENDER_LENGTH.unpack_from(data, start)
+                body = start + SENDER_LENGTH.size + sender_length
+                records.append((data[start + SENDER_LENGTH.size:body].decode(), data[body:stop].decode()))
+            return records
+
+    #(Re)map both files when they grew past the current mappings
+    def _map_files(self):
+        if self.index_map is None or len(self.index_map) < self.count * INDEX_ENTRY.size:
+            if self.index_map is not None:
+                self.index_map.close()
+            self.index_map = mmap.mmap(self.index_fd, 0, access=mmap.ACCESS_READ)
+        if self.data_map is None or len(self.data_map) < self.data_end:
+            if self.data_map is not None:
+                self.data_map.close()
+            self.data_map = mmap.mmap(self.data_fd, 0, access=mmap.ACCESS_READ)
+
+    def __del__(self):
+        self.close()
+
+    #Release the maps and file descriptors, the next append or read opens them again
+    def close(self):
+        with self.lock:
+            for mapped in (self.data_map, self.index_map):
+                if mapped is not None:
+                    mapped.close()
+            for fd in (self.data_fd, self.index_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.data_map = self.index_map = None
+            self.data_fd = self.index_fd = None
+
+
+class HistoryStore:
+    #Conversation id -> DiskConversationLog under one directory.
+    #At most 'max_open' conversations keep their files open, the least recently used ones are closed.
+    def __init__(self, directory, fsync=False, max_open=1024, ids=None):
+        self.directory = directory
+        self.ids = ids  # registry.ClientIds, files are named after the string form of interned ids
+        self.fsync = fsync
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        #Every live log object, so a conversation never has two writers even after it was evicted
+        self.logs = weakref.WeakValueDictionary()
+        self.open_logs = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+        #Conversations that already exist on disk, nothing is read until one is requested
+        self.known = {name[:-4] for name in os.listdir(directory) if name.endswith(".idx")}
+        print(f"History store {directory}: {len(self.known)} conversations on disk")
+
+    def __contains__(self, conversation_id):
+        return self._name(conversation_id) in self.known
+
+    def __len__(self):
+        return len(self.known)
+
+    #Same lookup MemoryHistory offers: the log of a conversation, or None if it has no history yet
+    def conversation(self, conversation_id, create=False):
+        name = self._name(conversation_id)
+        with self.lock:
+            log = self.open_logs.get(name)
+            if log is not None:
+                self.open_logs.move_to_end(name)
+                return log
+            if name not in self.known and not create:
+                return None
+
+            log = self.logs.get(name)
+            if log is None:
+                log = self.logs[name] = DiskConversationLog(os.path.join(self.directory, name), self.fsync)
+            self.known.add(name)
+            self.open_logs[name] = log
+            while len(self.open_logs) > self.max_open:
+                _, evicted = self.open_logs.popitem(last=False)
+                evicted.close()
+            return log
+
+    def conversation_ids(self):
+        with self.lock:
+            return list(self.known)
+
+    #Delete a conversation and its files, e.g. after it moved to another cluster node
+    def drop(self, conversation_id):
+        name = self._name(conversation_id)
+        with self.lock:
+            log = self.logs.pop(name, None) or DiskConversationLog(os.path.join(self.directory, name))
+            self.open_logs.pop(name, None)
+            self.known.discard(name)
+            log.close()
+            for path in (log.data_path, log.index_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _name(self, conversation_id):
+        return str(self.ids.name(conversation_id) if self.ids is not None else conversation_id)
+
+    def close(self):
+        with self.lock:
+            for log in self.open_logs.values():
+                log.close()
+            self.open_logs.clear()
@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+
+import argparse
+import gc
+import json
+import tracemalloc
+
+import socket_server
+
+
+#Memory benchmark for the lab1 chat server's per-client and per-conversation state.
+#Clients are opened through the event-loop engine's own code (ChatProtocol.connection_made) on
+#in-memory transports, so 100k sessions fit in one process without 100k sockets, then conversations
+#are logged through document_message the way "<uuid>: msg" logs them. Reports bytes per idle session,
+#per conversation and per further message as JSON, e.g.
+#  python memory_benchmark.py --clients 100000 --output memory.json
+#Socket buffers live in the kernel and are not counted, neither is the threaded engine's stack per client.
+
+
+class MemoryTransport:
+    #Just enough of an asyncio transport for a protocol that is never read from: writes are dropped
+    def __init__(self, index):
+        self.peername = ("127.0.0.1", 1024 + index % 60000)
+        self.closing = False
+
+    def get_extra_info(self, name, default=None):
+        return self.peername if name == 'peername' else default
+
+    def write(self, data):
+        pass
+
+    def is_closing(self):
+        return self.closing
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def close(self):
+        self.closing = True
+
+    abort = close
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/status") as status:
+            return next(int(line.split()[1]) * 1024 for line in status if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+
+
+class Meter:
+    #Python heap (tracemalloc) and RSS growth between two calls of measure()
+    def __init__(self):
+        gc.collect()
+        self.heap = tracemalloc.get_traced_memory()[0]
+        self.rss = rss_bytes()
+
+    def measure(self, count):
+        gc.collect()
+        heap = tracemalloc.get_traced_memory()[0]
+        rss = rss_bytes()
+        result = {"count": count, "heap_bytes_each": round((heap - self.heap) / count, 1)}
+        if rss is not None and self.rss is not None:
+            result["rss_bytes_each"] = round((rss - self.rss) / count, 1)
+        self.heap, self.rss = heap, rss
+        return result
+
+
+def run(args):
+    socket_server.VERBOSE = False
+    tracemalloc.start()
+
+    meter = Meter()
+    protocols = []
+    for index in range(args.clients):
+        protocol = socket_server.ChatProtocol()
+        protocol.connection_made(MemoryTransport(index))
+        protocols.append(protocol)
+    report = {"clients": args.clients, "idle_session": meter.measure(args.clients)}
+
+    uids = [protocol.current_uid for protocol in protocols]
+    conversations = min(args.conversations, len(uids) - 1) if len(uids) > 1 else 0
+    message = "x" * args.message_size
+    meter = Meter()
+    for index in range(conversations):
+        socket_server.document_message(uids[index], uids[index + 1], message)
+    if conversations:
+        report["conversation"] = meter.measure(conversations)
+        report["conversation"]["messages"] = 1
+
+        meter = Meter()
+        for _ in range(args.messages - 1):
+            for index in range(conversations):
+                socket_server.document_message(uids[index + 1], uids[index], message)
+        if args.messages > 1:
+            report["message"] = meter.measure(conversations * (args.messages - 1))
+    report["message_size"] = args.message_size
+    report["traced_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lab1 chat server memory benchmark')
+    parser.add_argument('--clients', type=int, default=100000, help='idle sessions to open')
+    parser.add_argument('--conversations', type=int, default=100000,
+                        help='conversations between neighbouring clients (at most clients - 1)')
+    parser.add_argument('--messages', type=int, default=3, help='messages per conversation')
+    parser.add_argument('--message-size', type=int, default=32, help='characters per message')
+    parser.add_argument('--output', default=None, help='write the JSON here instead of stdout')
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"{args.clients} clients: {report['idle_session']['heap_bytes_each']} bytes per idle session, "
+              f"{report.get('conversation', {}).get('heap_bytes_each')} bytes per conversation, "
+              f"written to {args.output}")
+    else:
+        print(text)
@@ -0,0 +1,138 @@
+# -*- coding:utf-8 -*-
+
+import bisect
+import json
+import socket
+import threading
+import time
+
+
+#Upper bounds (seconds) of the latency buckets, the last bucket takes everything slower
+LATENCY_BUCKETS = (50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3,
+                   100e-3, 250e-3, 500e-3, 1.0, 2.5)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.0f}us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.1f}ms"
+    return f"{seconds:.2f}s"
+
+
+class LatencyHistogram:
+    #Counts per fixed bucket plus count/sum/max, so recording is a bisect and three additions
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    #Upper bound of the bucket holding the p-th quantile, capped at the largest value recorded
+    def quantile(self, p):
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else None,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "p999": self.quantile(0.999),
+                "max": self.max, "buckets": list(self.buckets)}
+
+
+class ServerStats:
+    #Counters and per-command latency histograms of one server process.
+    #Recording takes one uncontended lock, cheap next to the command itself, so it stays on.
+    #'gauges' is called on every snapshot for values read from the server's state (queue depths...).
+    def __init__(self, gauges=None):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {}  # command kind: LatencyHistogram
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.gauges = gauges
+
+    def record(self, kind, seconds):
+        with self.lock:
+            histogram = self.commands.get(kind)
+            if histogram is None:
+                histogram = self.commands[kind] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def count_bytes_in(self, n):
+        with self.lock:
+            self.bytes_in += n
+
+    def count_bytes_out(self, n):
+        with self.lock:
+            self.bytes_out += n
+
+    def connection_opened(self):
+        with self.lock:
+            self.connections += 1
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {"uptime": time.time() - self.started, "connections_accepted": self.connections,
+                        "bytes_in": self.bytes_in, "bytes_out": self.bytes_out,
+                        "commands": {kind: histogram.snapshot() for kind, histogram in sorted(self.commands.items())}}
+        if self.gauges is not None:
+            snapshot.update(self.gauges())
+        return snapshot
+
+    #Human readable report for the "stats" command
+    def report(self):
+        snapshot = self.snapshot()
+        lines = [f"Uptime {snapshot['uptime']:.0f}s, {snapshot.get('active_connections', '-')} connections "
+                 f"({snapshot['connections_accepted']} accepted)",
+                 f"Bytes in {snapshot['bytes_in']}, out {snapshot['bytes_out']}"]
+        if "queued" in snapshot:
+            lines.append(f"Outbound queues: {snapshot['queued']} messages queued, deepest {snapshot['deepest_queue']}, "
+                         f"{snapshot['dropped']} dropped")
+        if snapshot.get("reaped_idle"):
+            lines.append(f"Idle clients disconnected: {snapshot['reaped_idle']}")
+        if snapshot.get("throttled"):
+            top = ", ".join(f"{uid} {count}" for uid, count in snapshot["throttled_clients"].items())
+            lines.append(f"Rate limit: {snapshot['throttled']} commands refused" + (f", connected: {top}" if top else ""))
+        lines.append("Command        count     mean      p50      p99     p999      max")
+        for kind, histogram in snapshot["commands"].items():
+            lines.append(f"{kind:<12}{histogram['count']:>8} " + " ".join(
+                f"{format_seconds(histogram[key]):>8}" for key in ("mean", "p50", "p99", "p999", "max")))
+        return "\n".join(lines)
+
+
+#Side port: every connection gets one JSON snapshot and is closed, e.g. "nc 127.0.0.1 9998"
+def serve_stats(stats, ip_port):
+    sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sk.bind(ip_port)
+    sk.listen(16)
+
+    def accept_loop():
+        while True:
+            conn, _ = sk.accept()
+            try:
+                conn.sendall(json.dumps(stats.snapshot()).encode() + b"\n")
+            except OSError:
+                pass
+            finally:
+                conn.close()
+
+    threading.Thread(target=accept_loop, name="stats-port", daemon=True).start()
+    return sk
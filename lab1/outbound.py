@@ -0,0 +1,219 @@
+# -*- coding:utf-8 -*-
+
+import collections
+import socket
+import threading
+
+
+#What a full outbound queue does with one more message
+#  drop        the message is not queued and the sender is told
+#  block       the sender waits until the receiver catches up, on the threaded engine for at most
+#              BLOCK_TIMEOUT seconds, then the slow receiver is disconnected
+#  disconnect  the slow receiver is disconnected
+BACKPRESSURE_POLICIES = ('drop', 'block', 'disconnect')
+BLOCK_TIMEOUT = 5.0
+
+
+class OutboundQueue:
+    #Bounded queue of pending sends for one client of the threaded engine.
+    #A single writer thread owns the socket, so senders never block on someone else's
+    #TCP buffer (unless the policy is 'block') and writes to one socket never interleave.
+    #'block' waits at most block_timeout seconds, so one reader that stopped reading cannot hold up
+    #every sender for good: it is disconnected instead.
+    def __init__(self, sock, max_depth=1024, policy='block', name=None, stats=None, block_timeout=BLOCK_TIMEOUT):
+        self.sock = sock
+        self.stats = stats  # ServerStats counting the bytes written, optional
+        self.max_depth = max_depth
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+        self.writer = threading.Thread(target=self._write_loop, name=name, daemon=True)
+        self.writer.start()
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    #Queue data for the writer, returns False if it was dropped or the client is gone
+    def send(self, data, policy=None):
+        policy = policy or self.policy
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.pending) >= self.max_depth:
+                if policy == 'drop':
+                    self.dropped += 1
+                    return False
+                if policy == 'disconnect':
+                    self.dropped += 1
+                    self._disconnect()
+                    return False
+                if not self.cond.wait_for(lambda: len(self.pending) < self.max_depth or self.closed,
+                                          self.block_timeout):
+                    self.dropped += 1
+                    self._disconnect()
+                    return False
+                if self.closed:
+                    return False
+            self.pending.append(data)
+            self.cond.notify_all()
+            return True
+
+    #Replies to the client itself always wait for room: only the client's own reader thread
+    #is held up, the same backpressure TCP would apply. Raises like a dead socket once closed
+    #(also when the client did not make room within block_timeout).
+    def sendall(self, data):
+        if not self.send(data, 'block'):
+            raise BrokenPipeError("client connection is closed")
+
+    #Stop accepting data, let the writer flush what is queued and wait up to 'timeout' for it
+    def close(self, timeout=5):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if threading.current_thread() is not self.writer:
+            self.writer.join(timeout)
+
+    #Drop the connection without flushing, e.g. a client that stopped answering heartbeats.
+    #Its reader thread sees the shut down socket and unregisters the client.
+    def abort(self):
+        with self.cond:
+            self._disconnect()
+
+    #Slow consumer: drop its queue and shut the socket down so its reader thread ends too
+    def _disconnect(self):
+        self.closed = True
+        self.pending.clear()
+        self.cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                #Everything queued so far goes out with one sendall
+                batch = b"".join(self.pending)
+                self.pending.clear()
+                self.cond.notify_all()
+            try:
+                self.sock.sendall(batch)
+                if self.stats is not None:
+                    self.stats.count_bytes_out(len(batch))
+            except OSError:
+                with self.cond:
+                    self.closed = True
+                    self.pending.clear()
+                    self.cond.notify_all()
+                return
+
+
+class AsyncOutboundQueue:
+    #Outbound queue of one event-loop client.
+    #Data goes straight to the transport until asyncio pauses writing, then it waits here.
+    #'block' cannot stall the loop, so the connection whose command is being handled
+    #(current_reader) stops reading until this client has drained its queue.
+    #current_reader is the connection's protocol: its transport, 'blocked' (how many queues hold it)
+    #and 'waiting_turn' (the FairScheduler holds it), reading resumes once neither does.
+    #One per connection, so it is kept small: slots, a list for the pending data (only ever appended
+    #and joined as a whole) and no set of blocked readers until one is blocked.
+    current_reader = None
+    __slots__ = ("transport", "stats", "max_depth", "policy", "pending", "paused", "closed", "dropped",
+                 "blocked_readers")
+
+    def __init__(self, transport, max_depth=1024, policy='block', stats=None):
+        self.transport = transport
+        self.stats = stats
+        self.max_depth = max_depth
+        self.policy = policy
+        self.pending = []
+        self.paused = False
+        self.closed = False
+        self.dropped = 0
+        self.blocked_readers = None
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def send(self, data, policy=None):
+        policy = policy or self.policy
+        if self.closed:
+            return False
+        if not self.paused:
+            self._write(data)
+            return True
+        if len(self.pending) >= self.max_depth:
+            if policy == 'drop':
+                self.dropped += 1
+                return False
+            if policy == 'disconnect':
+                self.dropped += 1
+                self.closed = True
+                self.pending.clear()
+                self.transport.abort()
+                return False
+            reader = AsyncOutboundQueue.current_reader
+            if reader is not None:
+                if self.blocked_readers is None:
+                    self.blocked_readers = set()
+                if reader not in self.blocked_readers:
+                    self.blocked_readers.add(reader)
+                    reader.blocked += 1
+                    reader.transport.pause_reading()
+        self.pending.append(data)
+        return True
+
+    #Replies to the client itself: when its queue is full the client stops being read instead
+    def sendall(self, data):
+        if not self.send(data, 'block'):
+            raise BrokenPipeError("client connection is closed")
+
+    #Called from the protocol's pause_writing/resume_writing
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        if self.pending:
+            self._write(b"".join(self.pending))
+            self.pending.clear()
+        self._release_readers()
+
+    #flush=True hands what is still queued to the transport first (e.g. "Goodbye" before closing)
+    def close(self, flush=False):
+        self.closed = True
+        if flush and self.pending:
+            self._write(b"".join(self.pending))
+        self.pending.clear()
+        self._release_readers()
+
+    #Drop the connection without flushing, connection_lost unregisters the client
+    def abort(self):
+        self.closed = True
+        self.pending.clear()
+        self._release_readers()
+        self.transport.abort()
+
+    def _write(self, data):
+        self.transport.write(data)
+        if self.stats is not None:
+            self.stats.count_bytes_out(len(data))
+
+    def _release_readers(self):
+        if not self.blocked_readers:
+            return
+        for reader in self.blocked_readers:
+            reader.blocked -= 1
+            #A connection still waiting for its FairScheduler turn resumes at the end of that turn
+            if not reader.blocked and not reader.waiting_turn and not reader.transport.is_closing():
+                reader.transport.resume_reading()
+        self.blocked_readers = None
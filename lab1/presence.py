@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+
+import threading
+
+
+#Page size used when "list" has no limit
+DEFAULT_LIST_PAGE = 1000
+
+
+class Presence:
+    #Who is online, kept so that every operation is O(1) or O(page):
+    #  order     list of online UUIDs, a leaving client is swapped with the last one and popped
+    #  position  UUID -> index in 'order', for O(1) membership checks and removal
+    #Clients that subscribed get a delta pushed on every join/leave instead of polling "list".
+    def __init__(self):
+        self.order = []
+        self.position = {}
+        self.subscribers = set()
+        self.lock = threading.Lock()
+
+    def __contains__(self, uid):
+        return uid in self.position
+
+    def __len__(self):
+        return len(self.order)
+
+    def add(self, uid):
+        with self.lock:
+            if uid not in self.position:
+                self.position[uid] = len(self.order)
+                self.order.append(uid)
+
+    def remove(self, uid):
+        with self.lock:
+            self.subscribers.discard(uid)
+            index = self.position.pop(uid, None)
+            if index is None:
+                return
+            last = self.order.pop()
+            if last != uid:
+                self.order[index] = last
+                self.position[last] = index
+
+    #Up to 'limit' online UUIDs starting at 'offset', plus the number of clients online
+    def page(self, offset=0, limit=DEFAULT_LIST_PAGE):
+        with self.lock:
+            return self.order[offset:offset + limit], len(self.order)
+
+    def subscribe(self, uid):
+        with self.lock:
+            self.subscribers.add(uid)
+
+    def unsubscribe(self, uid):
+        with self.lock:
+            self.subscribers.discard(uid)
+
+    #Snapshot of the subscribers, safe to iterate while clients come and go
+    def subscriber_snapshot(self):
+        with self.lock:
+            return tuple(self.subscribers)
@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+
+import threading
+import uuid
+
+
+#16 byte key of a UUID given as text, None if the text is not a UUID
+def uid_key(uid):
+    try:
+        key = bytes.fromhex(uid.replace("-", ""))
+    except (ValueError, AttributeError):
+        return None
+    return key if len(key) == 16 else None
+
+
+#Whether text is a UUID in the protocol's form, 8-4-4-4-12 hex digits
+def is_uid(text):
+    try:
+        return str(uuid.UUID(text)) == text.lower()
+    except (ValueError, AttributeError, TypeError):
+        return False
+
+
+class Session:
+    #Everything the server keeps per connected client in one record, instead of one entry per client
+    #in a dict per concern. 'uid' is the text form the protocol uses, the same str object presence and
+    #rooms hold, the registry is keyed by the 16 byte form.
+    __slots__ = ("key", "uid", "link", "out_queue", "last_seen", "pinged", "tokens", "refilled", "throttled")
+
+    def __init__(self, uid, link, out_queue, now):
+        self.key = uid_key(uid)
+        self.uid = uid
+        self.link = link            # what others send to, FramedLink(out_queue) for framed clients
+        self.out_queue = out_queue  # OutboundQueue / AsyncOutboundQueue writing to the client
+        self.last_seen = now        # heartbeat.IdleTracker
+        self.pinged = False
+        self.tokens = None          # throttle.RateLimiter token bucket, filled on the first command
+        self.refilled = now
+        self.throttled = 0
+
+
+class SessionRegistry:
+    #16 byte UUID -> Session of every client connected to this process.
+    #Lookups take the protocol's text UUIDs, anything that is not a UUID is simply not found.
+    def __init__(self):
+        self.sessions = {}
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, uid):
+        return uid_key(uid) in self.sessions
+
+    def add(self, session):
+        self.sessions[session.key] = session
+
+    def remove(self, uid):
+        return self.sessions.pop(uid_key(uid), None)
+
+    def get(self, uid):
+        return self.sessions.get(uid_key(uid))
+
+    #The link to send to a client, None if it is not connected here
+    def link(self, uid):
+        session = self.sessions.get(uid_key(uid))
+        return session.link if session is not None else None
+
+    #Snapshot of the sessions, safe to iterate while clients come and go
+    def values(self):
+        return list(self.sessions.values())
+
+    def uids(self):
+        return [session.uid for session in list(self.sessions.values())]
+
+
+class ClientIds:
+    #Interns client UUIDs as small ints, so the id of a conversation between two clients is a tuple of
+    #two ints (lower first) instead of a 72 character string built on every message.
+    #Tuples only mean something inside this process: files on disk and other workers or cluster nodes
+    #get the old string form from name(), and key() turns such a name back into the tuple.
+    def __init__(self):
+        self.numbers = {}  # 16 byte UUID: number
+        self.keys = []     # number: 16 byte UUID
+        self.lock = threading.Lock()
+
+    #Raises ValueError if 'uid' is not a UUID, only clients get a number
+    def number(self, uid):
+        key = uid_key(uid)
+        if key is None:
+            raise ValueError(f"not a client UUID: {uid!r}")
+        number = self.numbers.get(key)
+        if number is None:
+            with self.lock:
+                number = self.numbers.get(key)
+                if number is None:
+                    number = self.numbers[key] = len(self.keys)
+                    self.keys.append(key)
+        return number
+
+    def uid(self, number):
+        return str(uuid.UUID(bytes=self.keys[number]))
+
+    def conversation(self, first_uid, second_uid):
+        first, second = self.number(first_uid), self.number(second_uid)
+        return (first, second) if first < second else (second, first)
+
+    #String form of a conversation id, the larger UUID first as conversation ids always were.
+    #Room history ids and names pass through unchanged.
+    def name(self, conversation):
+        if not isinstance(conversation, tuple):
+            return conversation
+        first, second = self.uid(conversation[0]), self.uid(conversation[1])
+        return first + second if first > second else second + first
+
+    #Conversation id of a name from name(), anything else passes through unchanged
+    def key(self, conversation):
+        if (isinstance(conversation, str) and len(conversation) == 72
+                and is_uid(conversation[:36]) and is_uid(conversation[36:])):
+            return self.conversation(conversation[:36], conversation[36:])
+        return conversation
@@ -0,0 +1,75 @@
+# -*- coding:utf-8 -*-
+
+import re
+import threading
+
+
+#Room names are one token so "room <name>: msg" can be told apart from "<uuid>: msg"
+ROOM_NAME = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+#History id of a room, a room's messages are logged once under it instead of once per pair
+def room_history_id(name):
+    return f"room-{name}"
+
+
+class RoomRegistry:
+    #Room name -> member UUIDs, plus the reverse map so a disconnecting client leaves all its rooms.
+    #Membership changes take a lock because the threaded engine runs them from many threads.
+    def __init__(self):
+        self.rooms = {}        # room name: set of member UUIDs
+        self.memberships = {}  # client UUID: set of room names
+        self.lock = threading.Lock()
+
+    #Add a client to a room (created on first join), returns False if it already was a member
+    def join(self, name, uid):
+        with self.lock:
+            members = self.rooms.setdefault(name, set())
+            if uid in members:
+                return False
+            members.add(uid)
+            self.memberships.setdefault(uid, set()).add(name)
+            return True
+
+    #Remove a client from a room (deleted once empty), returns False if it was not a member
+    def leave(self, name, uid):
+        with self.lock:
+            members = self.rooms.get(name)
+            if not members or uid not in members:
+                return False
+            self._remove(name, uid)
+            return True
+
+    #Remove a client from every room it joined, returns the names of those rooms
+    def leave_all(self, uid):
+        with self.lock:
+            names = self.memberships.pop(uid, ())
+            for name in names:
+                members = self.rooms[name]
+                members.discard(uid)
+                if not members:
+                    del self.rooms[name]
+            return list(names)
+
+    def _remove(self, name, uid):
+        members = self.rooms[name]
+        members.discard(uid)
+        if not members:
+            del self.rooms[name]
+        names = self.memberships[uid]
+        names.discard(name)
+        if not names:
+            del self.memberships[uid]
+
+    def is_member(self, name, uid):
+        return uid in self.rooms.get(name, ())
+
+    #Snapshot of the members, safe to iterate while other clients join or leave
+    def members(self, name):
+        with self.lock:
+            return tuple(self.rooms.get(name, ()))
+
+    #Room name -> member count of every room
+    def summary(self):
+        with self.lock:
+            return {name: len(members) for name, members in self.rooms.items()}
@@ -0,0 +1,171 @@
+# -*- coding:utf-8 -*-
+
+import array
+import bisect
+import re
+import threading
+import weakref
+
+
+#Words are runs of letters, digits and _, matched case-insensitively
+WORD = re.compile(r"\w+")
+
+#Postings per compacted chunk, a new message's postings wait uncompressed in the tail until a chunk is full
+CHUNK_SIZE = 128
+
+#Matches returned by one search
+SEARCH_LIMIT = 20
+
+
+def words(text):
+    return set(WORD.findall(text.lower()))
+
+
+def encode_deltas(positions, previous):
+    #Positions as varint-encoded gaps, most gaps between messages with a word fit in one byte
+    out = bytearray()
+    for position in positions:
+        gap = position - previous
+        previous = position
+        while gap >= 0x80:
+            out.append((gap & 0x7F) | 0x80)
+            gap >>= 7
+        out.append(gap)
+    return bytes(out)
+
+
+def decode_deltas(data, previous):
+    positions = array.array("I")
+    gap = shift = 0
+    for byte in data:
+        gap |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            previous += gap
+            positions.append(previous)
+            gap = shift = 0
+    return positions
+
+
+class PostingList:
+    #Message positions containing one word, ascending.
+    #Full chunks are compacted to varint gaps (about a byte per posting instead of a 28 byte int in a list)
+    #and 'firsts' holds the first position of every chunk, so a lookup decodes at most one chunk.
+    #Most words of most conversations never fill a chunk, so 'firsts' and 'chunks' only exist once one is full.
+    __slots__ = ("firsts", "chunks", "tail", "count")
+
+    def __init__(self):
+        self.firsts = ()
+        self.chunks = ()
+        self.tail = array.array("I")
+        self.count = 0
+
+    def add(self, position):
+        self.tail.append(position)
+        self.count += 1
+        if len(self.tail) == CHUNK_SIZE:
+            if not self.chunks:
+                self.firsts = array.array("I")
+                self.chunks = []
+            self.firsts.append(self.tail[0])
+            self.chunks.append(encode_deltas(self.tail[1:], self.tail[0]))
+            self.tail = array.array("I")
+
+    def chunk(self, index, decoded):
+        positions = decoded.get(index)
+        if positions is None:
+            positions = decoded[index] = array.array("I", [self.firsts[index]])
+            positions.extend(decode_deltas(self.chunks[index], self.firsts[index]))
+        return positions
+
+    #Newest first, decoding one chunk at a time, so a search for the latest matches stops early
+    def descending(self):
+        yield from reversed(self.tail)
+        decoded = {}
+        for index in range(len(self.chunks) - 1, -1, -1):
+            yield from reversed(self.chunk(index, decoded))
+
+    #'decoded' caches the chunks decoded by earlier calls of the same search
+    def contains(self, position, decoded):
+        if self.tail and position >= self.tail[0]:
+            positions = self.tail
+        else:
+            index = bisect.bisect_right(self.firsts, position) - 1
+            if index < 0:
+                return False
+            positions = self.chunk(index, decoded)
+        found = bisect.bisect_left(positions, position)
+        return found < len(positions) and positions[found] == position
+
+
+class ConversationIndex:
+    #Inverted index of one conversation: word -> PostingList of message positions in its log
+    __slots__ = ("postings", "indexed", "lock")
+
+    def __init__(self):
+        self.postings = {}
+        self.indexed = 0  # messages of the log covered so far
+        self.lock = threading.Lock()
+
+    #Index the messages appended to 'log' since the last call, in log order
+    def update(self, log):
+        with self.lock:
+            count = len(log)
+            if count <= self.indexed:
+                return
+            for position, (sender, message) in enumerate(log.read(self.indexed, count - self.indexed), self.indexed):
+                for word in words(message):
+                    posting = self.postings.get(word)
+                    if posting is None:
+                        posting = self.postings[word] = PostingList()
+                    posting.add(position)
+            self.indexed = count
+
+    #Positions of the newest messages containing every term, newest first
+    def search(self, terms, limit=SEARCH_LIMIT):
+        with self.lock:
+            postings = [self.postings.get(term) for term in terms]
+            if not postings or None in postings:
+                return []
+            #Walk the rarest word's postings and probe the others
+            postings.sort(key=lambda posting: posting.count)
+            rarest, others = postings[0], postings[1:]
+            caches = [{} for _ in others]
+            matches = []
+            for position in rarest.descending():
+                if all(other.contains(position, cache) for other, cache in zip(others, caches)):
+                    matches.append(position)
+                    if len(matches) == limit:
+                        break
+            return matches
+
+
+class SearchIndexes:
+    #The index of every conversation log, dropped together with its log (e.g. a HistoryStore log
+    #leaving the open-file LRU) and rebuilt from the log by the next search
+    def __init__(self):
+        self.indexes = weakref.WeakKeyDictionary()
+        self.lock = threading.Lock()
+
+    #Called after every append: keeps an existing index current. A new conversation gets its index
+    #right away, an older log without one (reopened from disk) is only indexed once someone searches it.
+    def message_logged(self, log):
+        index = self.indexes.get(log)
+        if index is None:
+            if len(log) > 1:
+                return
+            with self.lock:
+                index = self.indexes.setdefault(log, ConversationIndex())
+        index.update(log)
+
+    #Up to 'limit' newest (position, sender, message) records of 'log' containing all words of 'query'
+    def search(self, log, query, limit=SEARCH_LIMIT):
+        with self.lock:
+            index = self.indexes.setdefault(log, ConversationIndex())
+        index.update(log)
+        matches = []
+        for position in index.search(sorted(words(query)), limit):
+            sender, message = log.read(position, 1)[0]
+            matches.append((position, sender, message))
+        return matches
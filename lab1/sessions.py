@@ -0,0 +1,71 @@
+# -*- coding:utf-8 -*-
+
+import collections
+import hmac
+import secrets
+import threading
+import time
+
+
+#How long a disconnected client's UUID stays resumable
+RESUME_WINDOW = 300
+
+
+class SessionTokens:
+    #Resume tokens of client sessions.
+    #"session" hands a client a secret token for its UUID, and a new connection that opens with
+    #"resume <uuid> <token>" takes that UUID over once the old connection is gone. UUIDs are public
+    #(list, presence, message headers), the token is what proves the session is yours.
+    #Tokens of disconnected clients expire after RESUME_WINDOW seconds, oldest first.
+    def __init__(self, window=RESUME_WINDOW):
+        self.window = window
+        self.tokens = {}  # UUID: token
+        self.released = collections.OrderedDict()  # UUID of a disconnected client: expiry time
+        self.lock = threading.Lock()
+
+    #The token of a connected client's session, created on first use
+    def token(self, uid):
+        with self.lock:
+            token = self.tokens.get(uid)
+            if token is None:
+                token = self.tokens[uid] = secrets.token_hex(16)
+            return token
+
+    #The client disconnected, its session stays resumable for a while
+    def release(self, uid):
+        with self.lock:
+            if uid in self.tokens:
+                self.released[uid] = time.monotonic() + self.window
+            self._expire()
+
+    #Forget a session for good, e.g. the throwaway UUID of a connection that resumed another one
+    def discard(self, uid):
+        with self.lock:
+            self.tokens.pop(uid, None)
+            self.released.pop(uid, None)
+
+    #Claim a released session, True if the token matches and it has not expired
+    def resume(self, uid, token):
+        with self.lock:
+            self._expire()
+            expected = self.tokens.get(uid)
+            #As bytes: compare_digest refuses str with non-ASCII characters
+            if (uid not in self.released or expected is None
+                    or not hmac.compare_digest(expected.encode(), token.encode())):
+                return False
+            del self.released[uid]
+            return True
+
+    #Drop expired sessions now rather than at the next release or resume
+    def expire(self):
+        with self.lock:
+            self._expire()
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.released:
+            uid, expiry = next(iter(self.released.items()))
+            if expiry > now:
+                break
+            del self.released[uid]
+            del self.tokens[uid]
@@ -1,8 +1,18 @@
 # -*- coding:utf-8 -*-
 
+import argparse
 import socket
 import threading
 
+from file_transfer import download_file, upload_file
+from framing import FRAME_MAGIC, FrameReader, encode_frame
+from heartbeat import PING, PONG
+
+parser = argparse.ArgumentParser(description='lab1 chat client')
+parser.add_argument('--framed', action='store_true',
+                    help='use length-prefixed frames instead of one send per command')
+args = parser.parse_args()
+
 # Define the IP address and port number of the server
 ip_port = ('127.0.0.1', 9999)
 stop_receiving = False
@@ -13,6 +23,15 @@ def receive_messages(sock):
         
             # Receive up to 1024 bytes of data from the server and decode it
             server_reply = sock.recv(1024).decode()
+
+            # An empty read means the server closed the connection
+            if not server_reply:
+                break
+
+            # Answer the server's heartbeat so an idle session is not disconnected
+            if server_reply == PING:
+                sock.sendall(PONG.encode())
+                continue
             
             # If a message is received from the server, print it
             print(f"Server Message: {server_reply}")
@@ -28,6 +47,49 @@ def receive_messages(sock):
         # Catch any errors that occur while receiving messages
         
 
+# Framed variant: text until the server echoes FRAME_MAGIC, then every frame is one server message
+def receive_frames(sock):
+    pending = b""
+    while FRAME_MAGIC not in pending:
+        data = sock.recv(1024)
+        if not data:
+            return
+        pending += data
+    greeting, rest = pending.split(FRAME_MAGIC, 1)
+    print(f"Server Message: {greeting.decode()}")
+    print("input msg: ", end="", flush=True)
+
+    reader = FrameReader()
+    frames = reader.feed(rest)
+    while not stop_receiving:
+        for server_reply in frames:
+            if server_reply == PING:
+                sock.sendall(encode_frame(PONG))
+                continue
+            print(f"Server Message: {server_reply}")
+            if server_reply != "Goodbye":
+                print("input msg: ", end="", flush=True)
+        frames = reader.recv_into(sock)
+        if frames is None:
+            break
+
+
+# "upload <host:port> <id> <path>" / "download <host:port> <id> <path>" move a file of a "sendfile"
+# transfer over the server's file port, in the background so chatting goes on meanwhile
+def transfer_file(inp):
+    command, address, transfer_id, path = inp.split(None, 3)
+    host, port = address.rsplit(":", 1)
+    try:
+        if command == "upload":
+            size = upload_file((host, int(port)), transfer_id, path)
+        else:
+            size = download_file((host, int(port)), transfer_id, path)
+        print(f"\nFile {transfer_id}: {command} of {size} bytes done, {path}")
+    except (OSError, ValueError) as e:
+        print(f"\nFile {transfer_id}: {command} stopped ({e}), run it again to resume")
+    print("input msg: ", end="", flush=True)
+
+
 # Create a socket object for communication
 s = socket.socket()
 
@@ -38,8 +100,12 @@ s.connect(ip_port)
 # server_reply = s.recv(1024).decode()
 # print(server_reply)
 
+# A framed client announces itself before anything else
+if args.framed:
+    s.sendall(FRAME_MAGIC)
+
 # Start a separate thread to handle receiving messages from the server
-receive_thread = threading.Thread(target=receive_messages, args=(s,))
+receive_thread = threading.Thread(target=receive_frames if args.framed else receive_messages, args=(s,))
 receive_thread.daemon = True  # Set the thread as a daemon, allowing it to exit when the main program ends
 receive_thread.start()
 
@@ -56,8 +122,12 @@ while True:
     if not inp:
         continue
 
+    if (inp.startswith("upload ") or inp.startswith("download ")) and len(inp.split(None, 3)) == 4:
+        threading.Thread(target=transfer_file, args=(inp,), daemon=True).start()
+        continue
+
     # Send the user's input as a message to the server
-    s.sendall(inp.encode())
+    s.sendall(encode_frame(inp) if args.framed else inp.encode())
 
     # If the user types 'exit', end the communication and break the loop
     if inp.lower() == "exit":
@@ -1,100 +1,560 @@
 # -*- coding:utf-8 -*-
 
+import argparse
+import asyncio
+import multiprocessing
+import shutil
+import signal
 import socket
+import tempfile
 import threading
+import time
 import uuid
 
-
-# Dictionaries to store current clients and their message history
-current_clients = {}  # Holds connected clients and their UUIDs
-#Format:    Client UUID: Client Link
-history = {}  # Keeps track of message exchanges between clients
-#Format:   Client1UIUDClient2UIUD: messages
+from cluster import ClusterNode
+from file_transfer import FILE_NAME, MAX_FILE_SIZE, FileTransfers
+from framing import FRAME_MAGIC, FrameReader, FramedLink, send_to_all
+from heartbeat import HEARTBEAT_INTERVAL, IDLE_TIMEOUT, PING, PONG, IdleTracker
+from history_log import DEFAULT_PAGE_SIZE, MemoryHistory, format_records
+from history_store import HistoryStore
+from metrics import ServerStats, serve_stats
+from outbound import BACKPRESSURE_POLICIES, AsyncOutboundQueue, OutboundQueue
+from presence import DEFAULT_LIST_PAGE, Presence
+from registry import ClientIds, Session, SessionRegistry, uid_key
+from rooms import ROOM_NAME, RoomRegistry, room_history_id
+from search_index import SearchIndexes
+from sessions import SessionTokens
+from throttle import RATE_BURST, RATE_LIMIT, FairScheduler, RateLimiter
+from workers import WorkerCluster, reuseport_socket
+
+
+# Registry of the current clients and their message history
+clients = SessionRegistry()  # Holds connected clients
+#Format:    16 byte client UUID: Session (text UUID, link, outbound queue, heartbeat and rate limit state)
+client_ids = ClientIds()  # Client UUIDs interned as ints, a conversation id is a pair of them
+history = MemoryHistory(client_ids)  # Keeps track of message exchanges between clients
+#Format:   (client number, client number): ConversationLog of (sender, message) records
+#Replaced by an on-disk HistoryStore when the server runs with --history-dir
+
+#Largest page a single history request may ask for
+MAX_PAGE_SIZE = 1000
+
+READ_BUFFER_SIZE = 4096  # first read buffer of an event-loop connection, grows while reads fill it
+QUEUE_SIZE = 1024  # messages a client may have queued before BACKPRESSURE applies
+BACKPRESSURE = 'block'  # one of BACKPRESSURE_POLICIES, see outbound.py
+BLOCK_TIMEOUT = 5.0  # seconds a threaded 'block' sender waits before the slow receiver is disconnected
+
+presence = Presence()  # Online UUIDs for O(1) membership checks and paged "list", plus delta subscribers
+rooms = RoomRegistry()  # Room name: member UUIDs, room history is kept in 'history' under room_history_id(name)
+search_indexes = SearchIndexes()  # Inverted index of every conversation log, for "search"
+sessions = SessionTokens()  # Resume tokens, so a reconnecting client can keep its UUID
+limiter = RateLimiter(RATE_LIMIT, RATE_BURST)  # Token bucket per client, None with --rate-limit 0
+scheduler = FairScheduler()  # Takes turns between event-loop connections with a long run of commands
+idle = IdleTracker(HEARTBEAT_INTERVAL, IDLE_TIMEOUT)  # Heartbeats and reaping of silent clients
+reaped = 0  # clients disconnected for being idle
+
+VERBOSE = True  # print a line per connection and command, --quiet turns it off
+
+
+#Console output of the per-connection and per-command events
+def log(*args):
+    if VERBOSE:
+        print(*args)
+
+
+#Values of the "stats" snapshot read from the server's state when it is taken
+def stats_gauges():
+    connected = clients.values()
+    depths = [session.out_queue.depth for session in connected]
+    gauges = {"active_connections": len(connected), "queued": sum(depths), "deepest_queue": max(depths, default=0),
+              "dropped": sum(session.out_queue.dropped for session in connected), "reaped_idle": reaped}
+    if limiter is not None:
+        gauges.update(limiter.snapshot(connected))
+    return gauges
+
+
+stats = ServerStats(stats_gauges)  # Per-command latency histograms and byte counters, see "stats" / --stats-port
+
+cluster = None  # WorkerCluster of this process with --workers, ClusterNode with --cluster-listen
+transfers = None  # FileTransfers serving --file-port, "sendfile" is off without it
+event_loop = None  # loop of the event-loop engines, other threads hand it their sends
 
 
 #Function to handle communication with a connected client
 #Run in a separate thread for each client
 def link_handler(link, client):
-    print('server start to receiving msg from [%s:%s]....' % (client[0], client[1]))
+    log('server start to receiving msg from [%s:%s]....' % (client[0], client[1]))
     
     #Generate unique identifier for the connected client
     client_id = uuid.uuid4()
 
-    #Store the client in the 'current_clients' dictionary with their UIUD
-
-    current_clients[str(client_id)] = link  # Store the client and its UUID
+    #Every write to this socket goes through one bounded queue and its writer thread
     current_uid = str(client_id)
-    print(f"New connection from {client}. Assigned UUID: {client_id}")
+    out_queue = OutboundQueue(link, QUEUE_SIZE, BACKPRESSURE, name=f"writer-{current_uid}", stats=stats,
+                              block_timeout=BLOCK_TIMEOUT)
+    stats.connection_opened()
+
+    #Store the client's session in the 'clients' registry under its UIUD
+
+    session = register_client(current_uid, out_queue, out_queue)  # Store the client and its UUID
+    log(f"New connection from {client}. Assigned UUID: {client_id}")
     
 
     # Send the UUID back to the client
-    link.sendall(f'Your assigned UIUD is: {client_id} '.encode())
+    out_queue.sendall(f'Your assigned UIUD is: {client_id} '.encode())
     
+    #Text clients are served one recv per command until they open with FRAME_MAGIC
+    reader = None
+    first_read = True
+    first_command = True
+
     #Continuously receive messages from the client
     while True:
         try:
-            #Receive and decode client message
-            client_data = link.recv(1024).decode()
-
-            #If client sends "exit", end communication
-            if client_data == "exit":
-                print('communication end with [%s:%s]...' % (client[0], client[1]))
-                link.sendall("Goodbye".encode()) #Send a goodbye
-                del current_clients[current_uid] #Remove client from 'current_clients'
-                break
-
-            #If client sends "list", return a list of active clients UIUD
-            if client_data == "list":
-                strr = ""
-                for client_id, client_socket in current_clients.items():
-                    strr += f"\n UUID: {client_id} \n"
-
-                link.sendall(strr.encode())
-                continue
-            #Check if the message is correctly formatted as "UIUD: Message"
-            if validate_message(client_data) == True:
-                
-                receiver_address, receiver_message = get_address(client_data)
-                
-                #Get the receiver's socket based on their UIUD
-                receiver_socket = current_clients.get(receiver_address)  # Use .get to avoid KeyError if uid does not exist
-
-                
-
-                #If the receiver exists, send the message to them
-                if receiver_socket:  
-                    receiver_socket.send(f"Message from {current_uid}: {receiver_message}".encode())
-                    document_message(current_uid, receiver_address, receiver_message)
-                    
+            if reader is None:
+                #Receive and decode client message
+                raw = link.recv(1024)
+                if not raw:
+                    log(f"Connection closed by client [{client[0]}:{client[1]}].")
+                    break
+                stats.count_bytes_in(len(raw))
+                if first_read and raw.startswith(FRAME_MAGIC):
+                    #Switch to length-prefixed frames for the rest of the connection
+                    out_queue.sendall(FRAME_MAGIC)
+                    session.link = FramedLink(out_queue)
+                    reader = FrameReader()
+                    commands = reader.feed(raw[len(FRAME_MAGIC):])
                 else:
-                    print(f"Error: No socket found for UID {receiver_address}")
-                    link.sendall(f"Error: No socket found for UID {receiver_address}".encode())
-            #If the client requests message history with another UUID
-            if validate_history_message(client_data):
-                receiver_id = get_history_id(client_data)
-                history_string = request_history_data(current_uid, receiver_id)
-                link.sendall(f"\n\nYour history is:\n{history_string}".encode())
-            
-                
-
+                    commands = [raw.decode()]
+                first_read = False
             else:
-                
-                print('client from [%s:%s] send a msg：%s' % (client[0], client[1], client_data))
-                link.sendall('server had received your msg'.encode())
-        except ConnectionResetError:
-            print(f"Connection lost with client [{client[0]}:{client[1]}].")
+                #Drain every complete frame of this read
+                received = reader.received
+                commands = reader.recv_into(link)
+                stats.count_bytes_in(reader.received - received)
+                if commands is None:
+                    log(f"Connection closed by client [{client[0]}:{client[1]}].")
+                    break
+            idle.seen(session)
+
+            #A connection may open with "resume <uuid> <token>" to take over an earlier session
+            if first_command and commands:
+                first_command = False
+                if commands[0].startswith("resume "):
+                    session = resume_session(session, commands.pop(0))
+
+            #Stop once the client said "exit"
+            if not all_commands_handled(session, client, commands):
+                break
+        except ValueError as e:
+            #FrameTooLarge, or a command that is not UTF-8
+            log(f"Closing [{client[0]}:{client[1]}]: {e}")
+            session.link.sendall(f"Error: {e}".encode())
             break
-    #Remove client from 'current_clients' after connection is closed
-    if current_uid in current_clients:
-        del current_clients[current_uid]
-        print(f"Client {current_uid} removed. Remaining clients: {list(current_clients.keys())}")
+        except OSError:
+            #Reset by the client, or shut down by the idle reaper
+            log(f"Connection lost with client [{client[0]}:{client[1]}].")
+            break
+    #Remove client from 'clients' after connection is closed
+    unregister_client(session.uid)
 
-    #Close the connection after communication ends
+    #Let the writer flush what is still queued (e.g. "Goodbye"), then close the connection
+    out_queue.close()
     link.close()
+
+
+#Makes a new client reachable: 'link' is what others send to, 'out_queue' the queue behind it
+#Returns the client's Session
+def register_client(current_uid, link, out_queue):
+    session = Session(current_uid, link, out_queue, time.monotonic())
+    clients.add(session)
+    presence.add(current_uid)
+    if cluster is not None:
+        cluster.announce_join(current_uid)
+    notify_presence(f"Presence: {current_uid} joined")
+    return session
+
+
+#Forgets a client whose connection ended, whichever engine served it
+def unregister_client(current_uid):
+    rooms.leave_all(current_uid)
+    presence.remove(current_uid)
+    if cluster is not None:
+        cluster.announce_leave(current_uid)
+    clients.remove(current_uid)
+    sessions.release(current_uid)
+    log(f"Client {current_uid} removed. Remaining clients: {len(presence)}")
+    notify_presence(f"Presence: {current_uid} left")
+
+
+#"resume <uuid> <token>": the connection of 'session' takes over the session of a client that
+#disconnected, returns the Session the connection has from now on
+def resume_session(session, command):
+    link = session.link
+    parts = command.split()
+    if len(parts) != 3:
+        link.sendall("Error: resume: use resume <uuid> <token>".encode())
+        return session
+    _, previous_uid, token = parts
+    if previous_uid in clients:
+        link.sendall(f"Error: resume: session {previous_uid} is still connected".encode())
+        return session
+    if not sessions.resume(previous_uid, token):
+        link.sendall(f"Error: resume: cannot resume session {previous_uid}".encode())
+        return session
+    unregister_client(session.uid)
+    sessions.discard(session.uid)
+    resumed = register_client(previous_uid, link, session.out_queue)
+    log(f"Client {session.uid} resumed session {previous_uid}")
+    link.sendall(f"Resumed session {previous_uid}".encode())
+    return resumed
+
+
+#Pushes one join/leave delta to every client that sent "presence on"
+def notify_presence(delta):
+    subscribers = presence.subscriber_snapshot()
+    if subscribers:
+        links = [clients.link(uid) for uid in subscribers]
+        send_to_all([link for link in links if link], delta.encode())
+
+
+#Runs the commands of one read in order, returns False as soon as one of them is "exit"
+#Every command's handling time goes into the histogram of its kind.
+#Commands beyond the client's rate limit are not run, each of them is answered with an error instead.
+def all_commands_handled(session, client, commands):
+    for client_data in commands:
+        if limiter is not None and client_data != "exit" and not limiter.allow(session):
+            report_throttled(session, command_kind(client_data))
+            continue
+        started = time.perf_counter()
+        handled = handle_command(session.link, session.uid, client, client_data)
+        stats.record(command_kind(client_data), time.perf_counter() - started)
+        if not handled:
+            return False
+    return True
+
+
+#Errors answering a command start with "Error: <command>: ", so a client can tell which request failed
+def report_throttled(session, kind):
+    session.link.sendall(f"Error: {kind}: rate limit, not run, the limit is {limiter.rate:g}/s with "
+                         f"bursts of {limiter.burst}, retry in {limiter.retry_after(session) * 1000:.0f}ms".encode())
+
+
+#Commands named by their first word, everything else with a ":" is a direct message
+COMMAND_KINDS = {"exit", "list", "presence", "queues", "stats", "session", "resume", "join", "leave",
+                 "rooms", "room", "roomhistory", "history", "search", "sendfile", "ping", "pong"}
+
+
+def command_kind(client_data):
+    first_word = client_data.split(None, 1)[0] if client_data else ""
+    if first_word in COMMAND_KINDS:
+        return first_word
+    return "message" if ":" in client_data else "other"
+
+
+#Runs one client command and sends the replies through 'link'
+#Shared by the threaded and the event-loop engine, returns False once the client said "exit"
+def handle_command(link, current_uid, client, client_data):
+    #If client sends "exit", end communication
+    if client_data == "exit":
+        log('communication end with [%s:%s]...' % (client[0], client[1]))
+        link.sendall("Goodbye".encode()) #Send a goodbye
+        clients.remove(current_uid) #Remove client from 'clients'
+        return False
+
+    #Heartbeats: "pong" answers the server's "ping" and needs no reply, a client may "ping" the server too
+    if client_data == PONG:
+        return True
+    if client_data == PING:
+        link.sendall(PONG.encode())
+        return True
+
+    #If client sends "list [offset] [limit]", return one page of active clients UIUD
+    if client_data == "list" or client_data.startswith("list "):
+        try:
+            page = [int(part) for part in client_data.split()[1:3]]
+        except ValueError:
+            link.sendall("Error: list: use list [offset] [limit]".encode())
+            return True
+        offset = max(page[0], 0) if page else 0
+        limit = max(page[1], 0) if len(page) > 1 else DEFAULT_LIST_PAGE
+        client_ids, online = presence.page(offset, limit)
+        strr = ""
+        for client_id in client_ids:
+            strr += f"\n UUID: {client_id} \n"
+        #Tell the client when the page does not cover everybody
+        if offset or offset + len(client_ids) < online:
+            strr += f"\n(clients {offset}-{offset + len(client_ids)} of {online}, use list <offset> <limit> for more)\n"
+
+        link.sendall(strr.encode())
+        return True
+    #"stats" reports the server's counters and per-command latency histograms
+    if client_data == "stats":
+        link.sendall(stats.report().encode())
+        return True
+    #"session" returns the token that lets a later connection resume this UUID
+    if client_data == "session":
+        link.sendall(f"Session {current_uid} {sessions.token(current_uid)}".encode())
+        return True
+    if client_data.startswith("resume "):
+        link.sendall("Error: resume: has to be the first command of a connection".encode())
+        return True
+    #"presence on" pushes a line to this client whenever someone joins or leaves, "presence off" stops it
+    if client_data in ("presence on", "presence off"):
+        if client_data == "presence on":
+            presence.subscribe(current_uid)
+            link.sendall(f"Presence updates on, {len(presence)} clients online".encode())
+        else:
+            presence.unsubscribe(current_uid)
+            link.sendall("Presence updates off".encode())
+        return True
+    #If client sends "queues", return how many messages wait in every client's outbound queue
+    if client_data == "queues":
+        strr = ""
+        for session in clients.values():
+            out_queue = session.out_queue
+            strr += (f"\n UUID: {session.uid} queued: {out_queue.depth}/{out_queue.max_depth} dropped: {out_queue.dropped}"
+                     f" throttled: {session.throttled} \n")
+
+        link.sendall(strr.encode())
+        return True
+    #Room commands: "join <room>", "leave <room>", "rooms", "room <room>: msg", "roomhistory <room> [offset] [limit]"
+    if is_room_command(client_data):
+        handle_room_command(link, current_uid, client_data)
+        return True
+    #"sendfile <uuid> <name> <size>" registers a file transfer, the bytes go over the file port
+    if client_data.startswith("sendfile "):
+        handle_sendfile(link, current_uid, client_data)
+        return True
+    #"search <uuid> <terms>" lists the newest messages of that conversation containing all the terms
+    if client_data.startswith("search "):
+        parts = client_data.split(None, 2)
+        if len(parts) < 3 or not is_known_client(parts[1]):
+            link.sendall("Error: search: use search <uuid> <terms> with the UUID of a known client".encode())
+        else:
+            send_search(link, conversation_id(current_uid, parts[1]), parts[2])
+        return True
+    #Check if the message is correctly formatted as "UIUD: Message"
+    if validate_message(client_data) == True:
+        
+        receiver_address, receiver_message = get_address(client_data)
+        
+        #Get the receiver's socket based on their UIUD, anything that is not a UUID is no client
+        receiver_socket = clients.link(receiver_address)  # None if the uid is not connected here
+        if receiver_socket is None and cluster is not None and uid_key(receiver_address) is not None:
+            #Held by another worker process or cluster node, the message goes there over the peer channel
+            receiver_socket = cluster.remote_link(receiver_address, current_uid)
+
+        
+
+        #If the receiver exists, queue the message for them
+        if receiver_socket:  
+            if receiver_socket.send(f"Message from {current_uid}: {receiver_message}".encode()):
+                document_message(current_uid, receiver_address, receiver_message)
+            else:
+                link.sendall(f"Error: message to {receiver_address} dropped, the receiver is not keeping up".encode())
+            
+        else:
+            log(f"Error: No socket found for UID {receiver_address}")
+            link.sendall(f"Error: No socket found for UID {receiver_address}".encode())
+    #If the client requests message history with another UUID
+    if validate_history_message(client_data):
+        receiver_id = get_history_id(client_data)
+        offset, limit = get_history_page(client_data)
+        send_history(link, "Your history is:", conversation_id(current_uid, receiver_id), offset, limit)
     
-    
-    
+        
+    #A history request that is not answered with a page gets an error instead of the plain ack
+    elif client_data.startswith("history "):
+        link.sendall("Error: history: use history <uuid> [offset] [limit] with the UUID of a known client".encode())
+    else:
+        
+        log('client from [%s:%s] send a msg：%s' % (client[0], client[1], client_data))
+        link.sendall('server had received your msg'.encode())
+    return True
+
+
+#Event-loop engine: every connection is a protocol object on one asyncio loop instead of a thread,
+#so idle clients only cost a transport and a few buffers
+class ChatProtocol(asyncio.BufferedProtocol):
+    #Slots instead of a __dict__, an idle connection should cost as little as possible
+    __slots__ = ("client", "transport", "session", "reader", "framed", "first_command", "backlog", "waiting_turn",
+                 "blocked")
+
+    def connection_made(self, transport):
+        self.client = transport.get_extra_info('peername')
+        self.transport = transport
+        #handle_command writes through the client's outbound queue, the transport is its writer
+        out_queue = AsyncOutboundQueue(transport, QUEUE_SIZE, BACKPRESSURE, stats=stats)
+        stats.connection_opened()
+        #Reads go straight into this buffer (BufferedProtocol), text or frames.
+        #It only exists while there is something to read, and grows while reads keep filling it.
+        self.reader = FrameReader(READ_BUFFER_SIZE, keep=False)
+        self.framed = None  # decided by the first read
+        self.first_command = True
+        #Commands read but not run yet, a long run of them is spread over turns of the FairScheduler
+        self.backlog = []
+        self.waiting_turn = False
+        self.blocked = 0  # outbound queues of full receivers this connection waits for ('block')
+
+        #Generate unique identifier for the connected client and register it like the threaded engine
+        current_uid = cluster.mint_client_id() if cluster is not None else str(uuid.uuid4())
+        self.session = register_client(current_uid, out_queue, out_queue)
+        log(f"New connection from {self.client}. Assigned UUID: {current_uid}")
+        out_queue.sendall(f'Your assigned UIUD is: {current_uid} '.encode())
+
+    @property
+    def current_uid(self):
+        return self.session.uid
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        stats.count_bytes_in(nbytes)
+        session = self.session
+        idle.seen(session)
+        try:
+            if self.framed is None:
+                raw = self.reader.take_raw()
+                self.framed = raw.startswith(FRAME_MAGIC)
+                if self.framed:
+                    #Switch to length-prefixed frames for the rest of the connection
+                    session.out_queue.sendall(FRAME_MAGIC)
+                    session.link = FramedLink(session.out_queue)
+                    commands = self.reader.feed(raw[len(FRAME_MAGIC):])
+                else:
+                    commands = [raw.decode()]
+            elif self.framed:
+                #Drain every complete frame of this wakeup
+                commands = self.reader.frames()
+            else:
+                #Each read is treated as one command, the same as one recv in link_handler
+                commands = [self.reader.take_raw().decode()]
+        except ValueError as e:
+            #FrameTooLarge, or a command that is not UTF-8
+            log(f"Closing {self.client}: {e}")
+            session.link.sendall(f"Error: {e}".encode())
+            session.out_queue.close(flush=True)
+            self.transport.close()
+            return
+
+        if self.first_command and commands:
+            self.first_command = False
+            if commands[0].startswith("resume "):
+                self.session = resume_session(session, commands.pop(0))
+        self.backlog += commands
+        #Up to one turn runs right away, the rest waits for the other connections' turns without reading more
+        if not self.waiting_turn and self.run_turn(scheduler.quantum):
+            self.waiting_turn = True
+            self.transport.pause_reading()
+            scheduler.schedule(self)
+
+    #Runs up to 'quantum' commands of the backlog, returns whether more are waiting
+    def run_turn(self, quantum):
+        if self.transport.is_closing():
+            self.backlog.clear()
+        commands = self.backlog[:quantum]
+        del self.backlog[:quantum]
+        #A 'block' backpressure stalls this connection if one of its receivers is full
+        AsyncOutboundQueue.current_reader = self
+        try:
+            if not all_commands_handled(self.session, self.client, commands):
+                self.backlog.clear()
+                self.session.out_queue.close(flush=True)
+                self.transport.close()
+        except ConnectionError:
+            self.backlog.clear()
+            self.transport.close()
+        finally:
+            AsyncOutboundQueue.current_reader = None
+        if self.backlog:
+            return True
+        if self.waiting_turn:
+            self.waiting_turn = False
+            #A full receiver's queue resumes it instead once it has drained
+            if not self.blocked and not self.transport.is_closing():
+                self.transport.resume_reading()
+        return False
 
+    def pause_writing(self):
+        self.session.out_queue.pause_writing()
+
+    def resume_writing(self):
+        self.session.out_queue.resume_writing()
+
+    def connection_lost(self, exc):
+        self.session.out_queue.close()
+        #Remove client from 'clients' after connection is closed
+        unregister_client(self.session.uid)
+
+
+#Check if the client sent one of the room commands
+def is_room_command(message):
+    command = message.split(" ", 1)[0]
+    return command in ("join", "leave", "room", "roomhistory") or message == "rooms"
+
+
+#Runs a room command, every reply goes back through 'link'
+def handle_room_command(link, current_uid, message):
+    if message == "rooms":
+        strr = ""
+        for name, member_count in sorted(rooms.summary().items()):
+            strr += f"\n Room: {name} members: {member_count} \n"
+        link.sendall((strr or "No rooms").encode())
+        return
+
+    command, _, rest = message.partition(" ")
+    if command == "room":
+        name, _, room_message = rest.partition(":")
+        name, room_message = name.strip(), room_message.strip()
+        if not ROOM_NAME.match(name) or not room_message:
+            link.sendall("Error: room: use room <room>: <message>".encode())
+        elif not rooms.is_member(name, current_uid):
+            link.sendall(f"Error: room: join room {name} before sending to it".encode())
+        else:
+            #The payload is built and encoded once for every member, and logged once for the room
+            payload = f"Message from {current_uid} in room {name}: {room_message}".encode()
+            receivers = [clients.link(uid) for uid in rooms.members(name) if uid != current_uid]
+            delivered = send_to_all([receiver for receiver in receivers if receiver], payload)
+            append_history(room_history_id(name), current_uid, room_message)
+            if cluster is not None:
+                #Members connected to other workers get it from their worker
+                cluster.broadcast_room(name, current_uid, payload)
+                link.sendall(f"Message sent to room {name}: delivered to {delivered} of {len(receivers)} members on this worker, "
+                             f"forwarded to {cluster.count - 1} other workers".encode())
+            else:
+                link.sendall(f"Message sent to room {name}: delivered to {delivered} of {len(receivers)} members".encode())
+        return
+
+    parts = rest.split()
+    if not parts or not ROOM_NAME.match(parts[0]):
+        link.sendall(f"Error: {command}: use {command} <room>, room names are letters, digits, - and _".encode())
+        return
+    name = parts[0]
+
+    if command == "join":
+        if rooms.join(name, current_uid):
+            link.sendall(f"Joined room {name}".encode())
+        else:
+            link.sendall(f"Already in room {name}".encode())
+    elif command == "leave":
+        if rooms.leave(name, current_uid):
+            link.sendall(f"Left room {name}".encode())
+        else:
+            link.sendall(f"Error: leave: not in room {name}".encode())
+    else:
+        #roomhistory <room> [offset] [limit], only for members like the pair history is only for the two clients
+        try:
+            offset, limit = get_history_page(message)
+        except ValueError:
+            link.sendall("Error: roomhistory: offset and limit have to be numbers".encode())
+            return
+        if not rooms.is_member(name, current_uid):
+            link.sendall(f"Error: roomhistory: join room {name} to read its history".encode())
+            return
+        send_history(link, f"Room {name} history is:", room_history_id(name), offset, limit)
 
 
 #Validates if a message is in the format "<UUID>:<Message>"
@@ -119,71 +579,409 @@ def get_address(data):
 def document_message(sender_address, receiver_address, msg):
     
 
-    #Generate unique message history id on ASCII
-    if str(sender_address) > str(receiver_address):
-        unique_id = str(sender_address) + str(receiver_address)
-    else:
-        unique_id = str(receiver_address) + str(sender_address)
-    
     #Append the message to the conversation history
-    if unique_id in history:
-        history[unique_id] += f"\n{sender_address}: {msg}"
+    append_history(conversation_id(sender_address, receiver_address), sender_address, msg)
+
+
+#Unique message history id of two clients: their interned numbers, lower first.
+#Other processes and the files of a HistoryStore know it as client_ids.name(id), the two UUIDs in ASCII order.
+def conversation_id(first_address, second_address):
+    return client_ids.conversation(first_address, second_address)
+
+
+#Appends to a conversation here, or at the worker that owns it when running with --workers
+def append_history(unique_id, sender_address, msg):
+    if cluster is not None and not cluster.owns(client_ids.name(unique_id)):
+        cluster.append_history(client_ids.name(unique_id), sender_address, msg)
     else:
-        history[unique_id] = f"{sender_address}: {msg}"
+        conversation = history.conversation(unique_id, create=True)
+        conversation.append(sender_address, msg)
+        search_indexes.message_logged(conversation)
     
 
-#Check if the client is requesting message history
+#Check if the client is requesting message history: "history <uuid> [offset] [limit]"
 def validate_history_message(message):
     if message.startswith("history "):
         
-        # Extract the UUID from the message and check if it's a valid client
-        id_str = message.split(" ", 1)[1]
-        if id_str not in list(current_clients.keys()):
+        parts = message.split()
+        if len(parts) < 2 or len(parts) > 4:
+            return False
+        #Offset and limit have to be numbers, offset may be negative to count from the end
+        try:
+            [int(part) for part in parts[2:]]
+        except ValueError:
             return False
-        else:
-            return True
+
+        # Extract the UUID from the message and check if it's a valid client
+        id_str = parts[1]
+        return is_known_client(id_str)
 
     else:
         return False
 
+#Whether a UUID belongs to a client online here, or one another worker or cluster node may hold
+def is_known_client(uid):
+    if uid_key(uid) is None:
+        return False
+    return uid in presence or (cluster is not None and cluster.knows_remote(uid))
+
 #Extracts UUID from history request message
 def get_history_id(message):
-    id_str = message.split(" ", 1)[1]
+    id_str = message.split()[1]
     return id_str
 
-#Retrieves message history between two clients
-def request_history_data(sender_id, receiver_id):
-    
-    #Generate unique history ID in int
-    if str(sender_id) > str(receiver_id):
-        unique_id = str(sender_id) + str(receiver_id)
-    else:
-        unique_id = str(receiver_id) + str(sender_id)
+#Extracts the optional page of a "history"/"roomhistory" request, defaults to the first DEFAULT_PAGE_SIZE messages
+def get_history_page(message):
+    parts = message.split()
+    offset = int(parts[2]) if len(parts) > 2 else 0
+    limit = int(parts[3]) if len(parts) > 3 else DEFAULT_PAGE_SIZE
+    return offset, max(0, min(limit, MAX_PAGE_SIZE))
+
+#Retrieves one page of message history between two clients
+def request_history_data(sender_id, receiver_id, offset=0, limit=DEFAULT_PAGE_SIZE):
+    return history_page_text(conversation_id(sender_id, receiver_id), offset, limit)
+
+
+#Retrieves one page of a conversation kept by this process
+def history_page_text(unique_id, offset=0, limit=DEFAULT_PAGE_SIZE):
     # Return the history if it exists, otherwise indicate that no history is available
-    if unique_id not in list(history.keys()):
+    conversation = history.conversation(unique_id)
+    if conversation is None:
         return "Not in the list"
     else:
-        return history[unique_id]
+        return format_history_page(conversation, offset, limit)
+
+
+#Sends one page of history to 'link' under 'title'
+#With --workers the page may live in another worker, then the reply goes out once that worker answers
+def send_history(link, title, unique_id, offset, limit):
+    def reply(history_string):
+        link.sendall(f"\n\n{title}\n{history_string}".encode())
+
+    if cluster is not None and not cluster.owns(client_ids.name(unique_id)):
+        cluster.request_history(client_ids.name(unique_id), offset, limit, reply)
+    else:
+        reply(history_page_text(unique_id, offset, limit))
+
+
+#Searches a conversation kept by this process, newest matches first
+def search_text(unique_id, query):
+    conversation = history.conversation(unique_id)
+    if conversation is None:
+        return "Not in the list"
+    matches = search_indexes.search(conversation, query)
+    lines = [f"({len(matches)} newest matches in {len(conversation)} messages, #n is the offset for history)"]
+    lines += [f"#{position} {sender}: {message}" for position, sender, message in matches]
+    return "\n".join(lines)
+
+
+#Sends the result of a search to 'link', asking the owning worker or node if the conversation lives elsewhere
+def send_search(link, unique_id, query):
+    def reply(result):
+        link.sendall(f"\n\nSearch results for '{query}':\n{result}".encode())
+
+    if cluster is not None and not cluster.owns(client_ids.name(unique_id)):
+        cluster.request_search(client_ids.name(unique_id), query, reply)
+    else:
+        reply(search_text(unique_id, query))
+
+
+#Registers a transfer and tells the sender where to upload it, the receiver hears of it once it is complete
+def handle_sendfile(link, current_uid, client_data):
+    parts = client_data.split()
+    if (len(parts) != 4 or not is_known_client(parts[1]) or not FILE_NAME.match(parts[2])
+            or not parts[3].isdigit() or not 0 < int(parts[3]) <= MAX_FILE_SIZE):
+        link.sendall(f"Error: sendfile: use sendfile <uuid> <name> <size> with the UUID of a known client, "
+                     f"a name of letters, digits, '.', '_' or '-' and 1 to {MAX_FILE_SIZE} bytes".encode())
+        return
+    if transfers is None:
+        link.sendall("Error: sendfile: file transfers are off, start the server with --file-port".encode())
+        return
+    transfer = transfers.create(current_uid, parts[1], parts[2], int(parts[3]))
+    host, port = transfers.address
+    link.sendall(f"File transfer {transfer.id} ready, upload {transfer.size} bytes of {transfer.name} "
+                 f"to {host}:{port}".encode())
+
+
+#Sends 'text' to a client from any thread, e.g. a file transfer thread.
+#The event-loop engines only touch their transports on the loop, so the send is handed to it.
+def notify_client(uid, text):
+    def deliver():
+        link = clients.link(uid)
+        if link is None and cluster is not None:
+            link = cluster.remote_link(uid)
+        if link:
+            link.send(text.encode())
+
+    if event_loop is None:
+        deliver()
+    else:
+        event_loop.call_soon_threadsafe(deliver)
+
+
+#Renders one page of a conversation under a "(messages a-b of n)" header
+def format_history_page(conversation, offset, limit):
+    #Only the requested page is copied, whatever the length of the conversation
+    records = conversation.read(offset, limit)
+    first = offset if offset >= 0 else max(len(conversation) + offset, 0)
+    page_info = f"(messages {first}-{first + len(records)} of {len(conversation)})"
+    return f"{page_info}\n{format_records(records)}"
         
 
 
+#Raise the open file limit so the event-loop engine can hold 10k+ sockets
+def raise_file_limit():
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
 
 
+#Threaded engine: one thread per connected client
+def run_threaded_server(ip_port, backlog):
+    sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # socket.SOCK_STREAM is tcp
+    sk.bind(ip_port)
+    sk.listen(backlog)
 
-ip_port = ('127.0.0.1', 9999)
-sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM) # socket.SOCK_STREAM is tcp
-sk.bind(ip_port)
-sk.listen(5)
+    #Is the first thing sent after the bind 
+    print('start socket server，waiting client...')
+    threading.Thread(target=run_reaper_thread, name="reaper", daemon=True).start()
 
-#Is the first thing sent after the bind 
-print('start socket server，waiting client...')
 
+    #Once connected to client, it asks to create a new thread waiting for messages from the client 
+    while True:
+        conn, address = sk.accept()
+        
+        log('create a new thread to receive msg from [%s:%s]' % (address[0], address[1]))
+        t = threading.Thread(target=link_handler, args=(conn, address))
+        t.start()
+
+
+#Pings quiet clients and disconnects the ones silent past the idle timeout, all of them in one pass.
+#Aborting a client's queue shuts its connection down, its reader (thread or protocol) then unregisters it.
+def sweep_idle_clients():
+    global reaped
+    to_ping, to_reap = idle.sweep(clients.values())
+    for session in to_ping:
+        #Never wait on a full queue here, a client with data pending is not idle anyway
+        session.link.send(PING.encode(), 'drop')
+    for session in to_reap:
+        session.out_queue.abort()
+    if to_reap:
+        reaped += len(to_reap)
+        log(f"Disconnected {len(to_reap)} idle clients")
+    sessions.expire()
+
+
+def run_reaper_thread():
+    while True:
+        time.sleep(idle.period)
+        sweep_idle_clients()
 
-#Once connected to client, it asks to create a new thread waiting for messages from the client 
-while True:
-    conn, address = sk.accept()
-    
-    print('create a new thread to receive msg from [%s:%s]' % (address[0], address[1]))
-    t = threading.Thread(target=link_handler, args=(conn, address))
-    t.start()
-''
\ No newline at end of file
+
+#The event-loop engines sweep on the loop, their queues and transports belong to it
+async def reap_idle_clients():
+    while True:
+        await asyncio.sleep(idle.period)
+        sweep_idle_clients()
+
+
+#Event-loop engine: all connections are served by one asyncio loop in this process
+def run_event_loop_server(ip_port, backlog):
+    raise_file_limit()
+
+    async def serve():
+        global event_loop
+        event_loop = asyncio.get_running_loop()
+        #Kept so the task is not garbage collected, the loop only holds a weak reference to it
+        reaper = event_loop.create_task(reap_idle_clients())
+        server = await event_loop.create_server(
+            ChatProtocol, ip_port[0], ip_port[1], backlog=backlog)
+        print('start socket server (event loop)，waiting client...')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+#Hooks the worker channel calls when another worker sends something for this process
+#Returns False if the client is not connected here
+def deliver_local(uid, data):
+    link = clients.link(uid)
+    if not link:
+        return False
+    link.send(data)
+    return True
+
+
+def deliver_room_local(name, exclude_uid, data):
+    links = [clients.link(uid) for uid in rooms.members(name) if uid != exclude_uid]
+    send_to_all([link for link in links if link], data)
+
+
+def remote_client_joined(uid):
+    presence.add(uid)
+    notify_presence(f"Presence: {uid} joined")
+
+
+def remote_client_left(uid):
+    presence.remove(uid)
+    notify_presence(f"Presence: {uid} left")
+
+
+#One process of --workers: the event-loop engine on a SO_REUSEPORT socket plus the worker channel
+def run_worker(index, count, run_dir, args):
+    #Settings again, a spawned (not forked) worker starts from a fresh module
+    apply_settings(args, index)
+    raise_file_limit()
+
+    async def serve():
+        global cluster, event_loop
+        event_loop = asyncio.get_running_loop()
+        cluster = WorkerCluster(index, count, run_dir, deliver_local, deliver_room_local,
+                                append_history, history_page_text, remote_client_joined, remote_client_left,
+                                search_text)
+        await cluster.start()
+        #Kept so the task is not garbage collected, the loop only holds a weak reference to it
+        reaper = event_loop.create_task(reap_idle_clients())
+        server = await asyncio.get_running_loop().create_server(
+            ChatProtocol, sock=reuseport_socket((args.host, args.port), args.backlog or 4096))
+        print(f'worker {index} of {count} started，waiting client...')
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+#One node of a --cluster-listen cluster: the event-loop engine plus the node's peer channels.
+#Ctrl-C or SIGTERM hands this node's histories to the remaining nodes before it exits.
+def run_cluster_node(args):
+    apply_settings(args)
+    raise_file_limit()
+
+    async def serve():
+        global cluster, event_loop
+        event_loop = asyncio.get_running_loop()
+        seeds = [seed.strip() for seed in (args.cluster_seeds or '').split(',') if seed.strip()]
+        cluster = ClusterNode(args.cluster_listen, seeds, history, clients,
+                              deliver_local, deliver_room_local, append_history, history_page_text, search_text)
+        await cluster.start()
+        #Kept so the task is not garbage collected, the loop only holds a weak reference to it
+        reaper = event_loop.create_task(reap_idle_clients())
+        server = await asyncio.get_running_loop().create_server(
+            ChatProtocol, args.host, args.port, backlog=args.backlog or 4096)
+        print(f'cluster node {args.cluster_listen} serving clients on {args.host}:{args.port}')
+        stop = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+        async with server:
+            await stop.wait()
+            server.close()
+            await cluster.leave()
+
+    asyncio.run(serve())
+
+
+#Starts --workers processes that share the port, and waits for them
+def run_workers(args):
+    run_dir = tempfile.mkdtemp(prefix='lab1-workers-')
+    processes = [multiprocessing.Process(target=run_worker, args=(index, args.workers, run_dir, args), daemon=True)
+                 for index in range(args.workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+#Server-wide settings from the command line, 'worker' is the index of this process under --workers
+def apply_settings(args, worker=0):
+    global QUEUE_SIZE, BACKPRESSURE, BLOCK_TIMEOUT, VERBOSE, history, transfers, limiter, idle
+    QUEUE_SIZE = args.queue_size
+    BACKPRESSURE = args.backpressure
+    BLOCK_TIMEOUT = args.block_timeout
+    VERBOSE = not args.quiet
+    if args.history_dir:
+        history = HistoryStore(args.history_dir, fsync=args.history_fsync, ids=client_ids)
+    if args.stats_port:
+        serve_stats(stats, (args.host, args.stats_port + worker))
+    idle = IdleTracker(args.heartbeat_interval, args.idle_timeout)
+    limiter = RateLimiter(args.rate_limit, args.rate_burst) if args.rate_limit > 0 else None
+    if args.file_port:
+        #Transfer ids are random, so workers may share one --spool-dir
+        spool_dir = args.spool_dir or tempfile.mkdtemp(prefix='lab1-spool-')
+        address = (args.host, args.file_port + worker)
+        transfers = FileTransfers(spool_dir, address, notify_client)
+        transfers.serve(address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lab1 chat server')
+    parser.add_argument('--engine', choices=['thread', 'eventloop'], default='thread',
+                        help='thread: one thread per client, eventloop: one asyncio loop for all clients')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--backlog', type=int, default=None,
+                        help='listen backlog (default 5 for thread, 4096 for eventloop)')
+    parser.add_argument('--history-dir', default=None,
+                        help='keep chat history on disk in this directory (default: in memory only)')
+    parser.add_argument('--history-fsync', action='store_true',
+                        help='fsync the history files after every message')
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE,
+                        help='messages a client may have waiting in its outbound queue')
+    parser.add_argument('--backpressure', choices=BACKPRESSURE_POLICIES, default=BACKPRESSURE,
+                        help='what happens when a receiver\'s outbound queue is full')
+    parser.add_argument('--block-timeout', type=float, default=BLOCK_TIMEOUT,
+                        help='thread engine: seconds a \'block\' sender waits for a full receiver before disconnecting it')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='run this many event-loop worker processes on the same port (SO_REUSEPORT)')
+    parser.add_argument('--cluster-listen', default=None, metavar='HOST:PORT',
+                        help='run as a node of a multi-server cluster, peers connect to this address')
+    parser.add_argument('--cluster-seeds', default=None, metavar='HOST:PORT,...',
+                        help='cluster nodes to join through (none for the first node)')
+    parser.add_argument('--quiet', action='store_true',
+                        help='no console line per connection and command (the "stats" command still counts them)')
+    parser.add_argument('--stats-port', type=int, default=None,
+                        help='serve a JSON stats snapshot to every connection on this port, worker i of --workers uses port + i')
+    parser.add_argument('--rate-limit', type=float, default=RATE_LIMIT,
+                        help='commands per second a client may send, the rest get an error (0: no limit)')
+    parser.add_argument('--rate-burst', type=int, default=RATE_BURST,
+                        help='commands a client may send at once before --rate-limit applies')
+    parser.add_argument('--heartbeat-interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='seconds of silence after which a client is sent "ping"')
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help='seconds of silence after which a client is disconnected (0: never)')
+    parser.add_argument('--file-port', type=int, default=None,
+                        help='accept "sendfile" uploads and downloads on this port, worker i of --workers uses port + i')
+    parser.add_argument('--spool-dir', default=None,
+                        help='directory for files in transfer (default: a new temporary directory)')
+    args = parser.parse_args()
+    if args.heartbeat_interval <= 0:
+        parser.error('--heartbeat-interval has to be more than 0')
+    if args.idle_timeout < 0:
+        parser.error('--idle-timeout has to be 0 or more')
+
+    ip_port = (args.host, args.port)
+    if args.cluster_listen:
+        #Clients and histories are spread over the nodes by consistent hashing
+        run_cluster_node(args)
+    elif args.workers > 1:
+        #Every worker opens its own history store, conversations are split between them by owner
+        run_workers(args)
+    elif args.engine == 'eventloop':
+        apply_settings(args)
+        run_event_loop_server(ip_port, args.backlog or 4096)
+    else:
+        apply_settings(args)
+        run_threaded_server(ip_port, args.backlog or 5)
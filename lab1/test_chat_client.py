@@ -0,0 +1,98 @@
+# -*- coding:utf-8 -*-
+
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from chat_client import ChatClient, ChatError
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'socket_server.py')
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+#Runs socket_server.py with 'options' for the duration of a test
+class ServerTestCase(unittest.TestCase):
+    engine = 'eventloop'
+    options = []
+
+    def setUp(self):
+        self.port = free_port()
+        self.server = subprocess.Popen([sys.executable, SERVER, '--engine', self.engine, '--port', str(self.port),
+                                        '--quiet'] + self.options,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(self.server.wait)
+        self.addCleanup(self.server.terminate)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def run_client(self, scenario):
+        async def run():
+            client = ChatClient('127.0.0.1', self.port)
+            try:
+                return await asyncio.wait_for(scenario(client), 10)
+            finally:
+                await client.close()
+        return asyncio.run(run())
+
+
+class RateLimitTest(ServerTestCase):
+    options = ['--rate-limit', '5', '--rate-burst', '5']
+
+    #Every request the limiter refuses fails with its own error, later replies still match their requests
+    def test_throttled_requests_fail(self):
+        async def scenario(client):
+            alice, bob = await client.open_sessions(2)
+            results = await asyncio.gather(*(alice.history(bob.uid) for _ in range(8)), return_exceptions=True)
+            await asyncio.sleep(1.5)  # the bucket refills
+            page = await alice.history(bob.uid)
+            return results, page, alice.messages.qsize()
+
+        results, page, unmatched = self.run_client(scenario)
+        errors = [result for result in results if isinstance(result, ChatError)]
+        self.assertTrue(errors)
+        self.assertTrue(all("rate limit" in str(error) for error in errors))
+        self.assertEqual(len(errors) + sum(isinstance(result, str) for result in results), 8)
+        self.assertIsInstance(page, str)
+        self.assertEqual(unmatched, 0)
+
+
+class ThreadRateLimitTest(RateLimitTest):
+    engine = 'thread'
+
+
+class RequestErrorTest(ServerTestCase):
+    #An error reply fails the request it answers, not an older or newer one of the same kind
+    def test_roomhistory_error(self):
+        async def scenario(client):
+            alice = await client.open_session()
+            alice.join("lobby")
+            bad = alice.room_history("lobby", "x")
+            good = alice.room_history("lobby")
+            with self.assertRaises(ChatError):
+                await bad
+            page = await good
+            return page, [alice.messages.get_nowait() for _ in range(alice.messages.qsize())]
+
+        page, messages = self.run_client(scenario)
+        self.assertIsInstance(page, str)
+        self.assertEqual(messages, ["Joined room lobby"])
+
+
+if __name__ == '__main__':
+    unittest.main()
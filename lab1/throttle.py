@@ -0,0 +1,79 @@
+# -*- coding:utf-8 -*-
+
+import asyncio
+import collections
+import threading
+import time
+
+
+#Default command rate of one client (commands per second) and the burst it may send at once
+RATE_LIMIT = 500.0
+RATE_BURST = 1000
+
+#Commands one event-loop connection may run before the others get their turn
+COMMANDS_PER_TURN = 64
+
+
+class RateLimiter:
+    #A token bucket per client: 'rate' tokens per second up to 'burst', every command takes one.
+    #The bucket and the count of refused commands live in the client's Session record (tokens,
+    #refilled, throttled), which only the thread (or loop) reading that client touches, so no lock.
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.total_throttled = 0
+        self.lock = threading.Lock()
+
+    def allow(self, session):
+        now = time.monotonic()
+        if session.tokens is None:
+            tokens = float(self.burst)
+        else:
+            tokens = min(self.burst, session.tokens + (now - session.refilled) * self.rate)
+        session.refilled = now
+        if tokens >= 1:
+            session.tokens = tokens - 1
+            return True
+        session.tokens = tokens
+        session.throttled += 1
+        with self.lock:
+            self.total_throttled += 1
+        return False
+
+    #Seconds until the client's next token
+    def retry_after(self, session):
+        return max(0.0, (1 - (session.tokens or 0.0)) / self.rate)
+
+    #Total refused commands and the connected clients that had the most refused
+    def snapshot(self, sessions, top=10):
+        throttled = sorted((session for session in sessions if session.throttled),
+                           key=lambda session: session.throttled, reverse=True)[:top]
+        return {"throttled": self.total_throttled,
+                "throttled_clients": {session.uid: session.throttled for session in throttled}}
+
+
+class FairScheduler:
+    #Round robin over event-loop connections that have more commands than one turn allows.
+    #A connection runs COMMANDS_PER_TURN commands per round, and the loop gets to do its I/O between rounds,
+    #so a client pipelining thousands of commands cannot hold up everybody else's.
+    def __init__(self, quantum=COMMANDS_PER_TURN):
+        self.quantum = quantum
+        self.ready = collections.deque()
+        self.scheduled = False
+
+    #'connection.run_turn(quantum)' runs up to 'quantum' commands and returns whether it has more
+    def schedule(self, connection):
+        self.ready.append(connection)
+        if not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self._round)
+
+    def _round(self):
+        for _ in range(len(self.ready)):
+            connection = self.ready.popleft()
+            if connection.run_turn(self.quantum):
+                self.ready.append(connection)
+        if self.ready:
+            asyncio.get_running_loop().call_soon(self._round)
+        else:
+            self.scheduled = False
@@ -0,0 +1,219 @@
+# -*- coding:utf-8 -*-
+
+import asyncio
+import functools
+import itertools
+import json
+import os
+import socket
+import uuid
+import zlib
+
+from framing import FrameReader, encode_frame
+
+
+#Multi-process mode of the lab1 chat server.
+#N worker processes accept on the same port through SO_REUSEPORT and each one serves its own clients
+#with the event-loop engine. Workers talk over Unix stream sockets in a run directory, one socket per
+#worker, with length-prefixed JSON frames:
+#  join / leave     a client connected to or left the sending worker, every worker keeps a directory
+#                   of remote clients so "list" and UUID checks cover the whole server
+#  deliver          bytes for a client held by the receiving worker
+#  room             a room message for the receiving worker's members of that room
+#  append           a message for a conversation whose history the receiving worker owns
+#  history / page   read one page of a conversation from its owner and the reply to that
+#  search           search a conversation at its owner, answered with a page too
+#Every conversation's history is owned by exactly one worker (crc32 of its id modulo N), so a
+#conversation is never appended to from two processes.
+
+#Worker-to-worker frames may carry whole history pages
+CHANNEL_MAX_FRAME_SIZE = 64 << 20
+
+
+def worker_socket_path(run_dir, index):
+    return os.path.join(run_dir, f"worker-{index}.sock")
+
+
+#Listening socket every worker binds on its own, the kernel spreads new connections over them
+def reuseport_socket(ip_port, backlog):
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise OSError("SO_REUSEPORT is not available on this platform, run without --workers")
+    sk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sk.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sk.bind(ip_port)
+    sk.listen(backlog)
+    sk.setblocking(False)
+    return sk
+
+
+class RemoteLink:
+    #Stands in for a client held by another worker: send() hands the bytes to that worker
+    def __init__(self, cluster, worker, uid):
+        self.cluster = cluster
+        self.worker = worker
+        self.uid = uid
+
+    def send(self, data):
+        self.cluster.send_to(self.worker, {"t": "deliver", "uid": self.uid, "data": data.decode()})
+        return True
+
+    def sendall(self, data):
+        self.send(data)
+
+
+class PeerChannel:
+    #Outgoing stream to one other process, frames wait in 'pending' until the connection is up.
+    #'open_connection' is a coroutine function returning (reader, writer), e.g. asyncio.open_unix_connection
+    def __init__(self, open_connection, retries=None):
+        self.open_connection = open_connection
+        self.retries = retries  # None retries forever
+        self.writer = None
+        self.pending = []
+
+    async def connect(self):
+        attempt = 0
+        while True:
+            try:
+                _, self.writer = await self.open_connection()
+                break
+            except OSError:
+                #That process has not opened its socket yet
+                attempt += 1
+                if self.retries is not None and attempt > self.retries:
+                    raise
+                await asyncio.sleep(0.05)
+        self.writer.write(b"".join(self.pending))
+        self.pending = None
+
+    def send(self, frame):
+        if self.writer is None:
+            self.pending.append(frame)
+        else:
+            self.writer.write(frame)
+
+
+class WorkerCluster:
+    #The channel of one worker. The server passes in what the remote side may do to it:
+    #  deliver(uid, data)                     send bytes to a local client
+    #  deliver_room(name, exclude_uid, data)  send bytes to the local members of a room
+    #  append_history(conversation, sender, message)
+    #  history_text(conversation, offset, limit) -> str
+    #  search_text(conversation, query) -> str
+    #  client_joined(uid) / client_left(uid)  a client of another worker came or went
+    def __init__(self, index, count, run_dir, deliver, deliver_room, append_history, history_text,
+                 client_joined, client_left, search_text=None):
+        self.index = index
+        self.count = count
+        self.run_dir = run_dir
+        self.deliver = deliver
+        self.deliver_room = deliver_room
+        self.append_history_local = append_history
+        self.history_text = history_text
+        self.search_text = search_text
+        self.client_joined = client_joined
+        self.client_left = client_left
+
+        self.directory = {}  # UUID of a remote client: index of the worker holding it
+        self.peers = {i: PeerChannel(functools.partial(asyncio.open_unix_connection, worker_socket_path(run_dir, i)))
+                      for i in range(count) if i != index}
+        self.request_ids = itertools.count()
+        self.waiting = {}  # history request id: callback taking the page text
+        self.tasks = []
+
+    async def start(self):
+        await asyncio.start_unix_server(self._serve_peer, worker_socket_path(self.run_dir, self.index))
+        self.tasks = [asyncio.ensure_future(peer.connect()) for peer in self.peers.values()]
+
+    #Index of the worker that keeps the history of a conversation
+    def owner(self, conversation):
+        return zlib.crc32(str(conversation).encode()) % self.count
+
+    def owns(self, conversation):
+        return self.owner(conversation) == self.index
+
+    #A link for a client held by another worker, None if no worker announced it
+    def remote_link(self, uid, sender=None):
+        worker = self.directory.get(uid)
+        return None if worker is None else RemoteLink(self, worker, uid)
+
+    #Whether a UUID that is not connected here is connected to another worker
+    def knows_remote(self, uid):
+        return uid in self.directory
+
+    #Any worker may hand out any UUID, the directory tells the others where it is
+    def mint_client_id(self):
+        return str(uuid.uuid4())
+
+    def send_to(self, worker, message):
+        self.peers[worker].send(encode_frame(json.dumps(message), CHANNEL_MAX_FRAME_SIZE))
+
+    def broadcast(self, message):
+        frame = encode_frame(json.dumps(message), CHANNEL_MAX_FRAME_SIZE)
+        for peer in self.peers.values():
+            peer.send(frame)
+
+    def announce_join(self, uid):
+        self.broadcast({"t": "join", "uid": uid, "w": self.index})
+
+    def announce_leave(self, uid):
+        self.broadcast({"t": "leave", "uid": uid})
+
+    def broadcast_room(self, name, exclude_uid, data):
+        self.broadcast({"t": "room", "name": name, "exclude": exclude_uid, "data": data.decode()})
+
+    def append_history(self, conversation, sender, message):
+        self.send_to(self.owner(conversation), {"t": "append", "conv": conversation, "sender": sender, "msg": message})
+
+    #Ask the owner for one page, 'reply' is called with the page text once it arrives
+    def request_history(self, conversation, offset, limit, reply):
+        request_id = next(self.request_ids)
+        self.waiting[request_id] = reply
+        self.send_to(self.owner(conversation), {"t": "history", "req": request_id, "from": self.index,
+                                                 "conv": conversation, "offset": offset, "limit": limit})
+
+    #Ask the owner to search a conversation, 'reply' is called with the result text
+    def request_search(self, conversation, query, reply):
+        request_id = next(self.request_ids)
+        self.waiting[request_id] = reply
+        self.send_to(self.owner(conversation), {"t": "search", "req": request_id, "from": self.index,
+                                                 "conv": conversation, "query": query})
+
+    async def _serve_peer(self, reader, writer):
+        frames = FrameReader(max_size=CHANNEL_MAX_FRAME_SIZE)
+        while True:
+            data = await reader.read(256 * 1024)
+            if not data:
+                break
+            for frame in frames.feed(data):
+                try:
+                    self._handle(json.loads(frame))
+                except ConnectionError:
+                    #The local client went away while the message was in flight
+                    pass
+        writer.close()
+
+    def _handle(self, message):
+        kind = message["t"]
+        if kind == "deliver":
+            self.deliver(message["uid"], message["data"].encode())
+        elif kind == "room":
+            self.deliver_room(message["name"], message["exclude"], message["data"].encode())
+        elif kind == "append":
+            self.append_history_local(message["conv"], message["sender"], message["msg"])
+        elif kind in ("history", "search"):
+            if kind == "history":
+                text = self.history_text(message["conv"], message["offset"], message["limit"])
+            else:
+                text = self.search_text(message["conv"], message["query"])
+            self.send_to(message["from"], {"t": "page", "req": message["req"], "text": text})
+        elif kind == "page":
+            reply = self.waiting.pop(message["req"], None)
+            if reply is not None:
+                reply(message["text"])
+        elif kind == "join":
+            self.directory[message["uid"]] = message["w"]
+            self.client_joined(message["uid"])
+        elif kind == "leave":
+            if self.directory.pop(message["uid"], None) is not None:
+                self.client_left(message["uid"])
@@ -0,0 +1,147 @@
+# Proposer-side batching of client values
+# Every Paxos round costs the same round trips whether it carries one value or hundreds, so the proposer
+# collects the values that arrive together and proposes them as one log entry.
+# AsyncBatcher does the same for a node on an asyncio loop, with tasks in place of threads.
+
+import asyncio
+import threading
+import time
+
+BATCH_SIZE = 256  # values in one batch at most
+BATCH_DELAY = 0.0005  # seconds the first value of a batch waits for more to arrive
+
+
+class Waiter:
+    """The result of one submitted value, set once its batch was proposed."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def set(self, result, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Batcher:
+    """Collects values submitted from many threads and hands them to propose(values) in batches.
+
+    A batch closes when it holds 'max_size' values or 'max_delay' seconds after its first value came in.
+    A lone value goes out at once while the load is light (the last batch had a single value too),
+    so a single client does not pay the delay on every append.
+    'workers' threads propose batches, so that many batches can be in their rounds at once. Once all of
+    them are busy the next batch keeps filling, so batches grow with the offered load instead of every
+    value waiting for its own round.
+    """
+
+    def __init__(self, propose, max_size=BATCH_SIZE, max_delay=BATCH_DELAY, workers=1):
+        self.propose = propose
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = []  # (value, Waiter)
+        self.last_size = 0
+        self.changed = threading.Condition()
+        for _ in range(workers):
+            threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, value):
+        """Queue a value and wait for its batch. Returns what propose returned for the batch."""
+        waiter = Waiter()
+        with self.changed:
+            self.pending.append((value, waiter))
+            if len(self.pending) == 1 or len(self.pending) >= self.max_size:
+                self.changed.notify()
+        return waiter.wait()
+
+    def run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending)
+                deadline = time.monotonic() + self.max_delay
+                light = len(self.pending) == 1 and self.last_size <= 1
+                while len(self.pending) < self.max_size and not light:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.changed.wait(remaining)
+                if not self.pending:
+                    continue  # another worker took them while this one waited
+                batch = self.pending[:self.max_size]
+                del self.pending[:self.max_size]
+                self.last_size = len(batch)
+
+            try:
+                result, error = self.propose([value for value, waiter in batch]), None
+            except Exception as e:
+                result, error = None, e
+            for value, waiter in batch:
+                waiter.set(result, error)
+
+
+class AsyncBatcher:
+    """Batcher for a node on an asyncio loop: values come from the loop's tasks, and 'workers' tasks await
+    the coroutine propose(values). The worker tasks start with the first submit, on the loop that runs it.
+    """
+
+    def __init__(self, propose, max_size=BATCH_SIZE, max_delay=BATCH_DELAY, workers=1):
+        self.propose = propose
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.workers = workers
+        self.pending = []  # (value, future)
+        self.last_size = 0
+        self.changed = None
+        self.tasks = []
+
+    async def submit(self, value):
+        """Queue a value and wait for its batch. Returns what propose returned for the batch."""
+        if not self.tasks:
+            self.changed = asyncio.Condition()
+            self.tasks = [asyncio.ensure_future(self.run()) for _ in range(self.workers)]
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((value, future))
+        if len(self.pending) == 1 or len(self.pending) >= self.max_size:
+            async with self.changed:
+                self.changed.notify()
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self.changed:
+                await self.changed.wait_for(lambda: self.pending)
+                deadline = loop.time() + self.max_delay
+                light = len(self.pending) == 1 and self.last_size <= 1
+                while len(self.pending) < self.max_size and not light:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        break
+                if not self.pending:
+                    continue  # another worker took them while this one waited
+                batch = self.pending[:self.max_size]
+                del self.pending[:self.max_size]
+                self.last_size = len(batch)
+
+            try:
+                result, error = await self.propose([value for value, future in batch]), None
+            except Exception as e:
+                result, error = None, e
+            for value, future in batch:
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,150 @@
+# State transfer to a node that fell behind
+# A node that was down, or missed commits, asks the most advanced peer for its status. If that peer has
+# compacted slots the node never applied, the node streams the peer's latest snapshot in chunks, then it
+# asks for the chosen slots after it until it has them all. The transfer uses a connection of its own,
+# so chunks never queue up in front of the Accept traffic on the nodes' pooled connections.
+#
+# Messages (served by every node):
+#   STATUS                          -> STATUS <applied> <compacted>
+#   SNAPSHOT_OPEN                   -> SNAPSHOT <transfer id> <header> | NONE
+#   SNAPSHOT_CHUNK <id> <offset> <n>-> CHUNK <up to n bytes of snapshot data from offset> | Error: ...
+#   SNAPSHOT_CLOSE <id>             -> OK
+#   LOG_SUFFIX <from_slot> <n>      -> SUFFIX [[slot, batch], ...], up to n chosen slots from from_slot
+
+import itertools
+import json
+import os
+import threading
+import time
+
+from snapshot import copy_range
+
+CHUNK_SIZE = 1 << 20  # bytes of snapshot per request
+CHUNK_WINDOW = 4  # chunk requests in flight at once, so at most this many chunks are buffered anywhere
+SUFFIX_SLOTS = 1000  # chosen slots per LOG_SUFFIX reply
+TRANSFER_TIMEOUT = 30  # seconds without a chunk before a transfer is given up
+TRANSFER_IDLE = 300  # seconds an opened snapshot is kept for a peer that went quiet
+CATCH_UP_GAP = 16  # a commit this many slots past the applied ones means commits were missed
+CATCH_UP_ATTEMPTS = 3  # rounds of snapshot and suffix while the peer keeps moving ahead
+
+
+class SnapshotSource:
+    """The snapshots a node is streaming to its peers.
+
+    Every transfer reads from the snapshot file it opened, and the open file stays readable even after
+    a newer snapshot replaced it on disk, so a long transfer is not restarted by the node's own snapshots.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.transfers = {}  # transfer id: [file, data offset, last used]
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def open(self):
+        """Returns (transfer id, header) of the current snapshot, None if there is none."""
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return None
+        header = f.readline()
+        with self.lock:
+            self.expire()
+            transfer_id = next(self.ids)
+            self.transfers[transfer_id] = [f, len(header), time.monotonic()]
+        return transfer_id, json.loads(header)
+
+    def read(self, transfer_id, offset, length):
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None:
+                return None
+            transfer[2] = time.monotonic()
+        f, data_offset, _ = transfer
+        return os.pread(f.fileno(), min(length, CHUNK_SIZE), data_offset + offset)
+
+    def close(self, transfer_id):
+        with self.lock:
+            transfer = self.transfers.pop(transfer_id, None)
+        if transfer is not None:
+            transfer[0].close()
+
+    # Lock held
+    def expire(self):
+        now = time.monotonic()
+        for transfer_id, (f, data_offset, used) in list(self.transfers.items()):
+            if now - used > TRANSFER_IDLE:
+                del self.transfers[transfer_id]
+                f.close()
+
+
+def fetch_snapshot(connection, path):
+    """Stream the peer's current snapshot into 'path' (header line and data), with at most CHUNK_WINDOW
+    chunks requested ahead of the ones written. Returns the snapshot's metadata, None if the peer has no
+    snapshot, and raises OSError if the transfer failed."""
+    reply = connection.request("SNAPSHOT_OPEN")
+    if reply is None or not reply.startswith("SNAPSHOT "):
+        return None
+    _, transfer_id, header = reply.split(" ", 2)
+    metadata = json.loads(header)
+    size = metadata["size"]
+    header = json.dumps(metadata).encode() + b"\n"
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    changed = threading.Condition()
+    progress = {"requested": 0, "written": 0, "in_flight": 0, "error": None, "closed": False}
+
+    def on_chunk(offset, length, reply):
+        with changed:
+            if progress["closed"]:
+                return
+            if reply is None or not reply.startswith(b"CHUNK ") or len(reply) - 6 != length:
+                progress["error"] = progress["error"] or f"chunk at {offset} failed: {reply!r:.80}"
+            else:
+                os.pwrite(fd, memoryview(reply)[6:], len(header) + offset)
+                progress["written"] += length
+            progress["in_flight"] -= 1
+            changed.notify()
+
+    try:
+        os.write(fd, header)
+        while True:
+            with changed:
+                if not changed.wait_for(lambda: progress["error"] or progress["written"] == size
+                                        or (progress["in_flight"] < CHUNK_WINDOW and progress["requested"] < size),
+                                        TRANSFER_TIMEOUT):
+                    progress["error"] = "timed out"
+                if progress["error"] or progress["written"] == size:
+                    break
+                requests = []
+                while progress["in_flight"] < CHUNK_WINDOW and progress["requested"] < size:
+                    length = min(CHUNK_SIZE, size - progress["requested"])
+                    requests.append((progress["requested"], length))
+                    progress["requested"] += length
+                    progress["in_flight"] += 1
+            for offset, length in requests:
+                connection.submit(f"SNAPSHOT_CHUNK {transfer_id} {offset} {length}",
+                                  lambda reply, offset=offset, length=length: on_chunk(offset, length, reply),
+                                  raw=True)
+        with changed:
+            error = progress["error"]
+        if error is None:
+            os.fsync(fd)
+    finally:
+        connection.submit(f"SNAPSHOT_CLOSE {transfer_id}", lambda reply: None)
+        with changed:
+            progress["closed"] = True  # chunks still on their way are dropped
+            os.close(fd)
+    if error is not None:
+        os.remove(path)
+        raise OSError(f"snapshot transfer from {connection.address} failed: {error}")
+    return metadata
+
+
+def extract_state(snapshot_path, state_path, metadata):
+    """Write the data of a snapshot out as a state file."""
+    with open(snapshot_path, "rb") as snapshot, open(state_path, "wb") as state:
+        header_size = len(snapshot.readline())
+        copy_range(snapshot, state, metadata["size"], header_size)
+        state.flush()
+        os.fsync(state.fileno())
@@ -2,172 +2,752 @@
 # 11/10/2024 
 # Distributed Systems Lab2
 
+import argparse
+import asyncio
+import json
+import os
 import socket
 import threading
-import os
+import time
+
+import catch_up
+import snapshot
+from batcher import AsyncBatcher, Batcher
+from catch_up import CATCH_UP_ATTEMPTS, CATCH_UP_GAP, SUFFIX_SLOTS, SnapshotSource
+from peer_pool import PEER_MAGIC, AsyncPeerPool, FrameReader, PeerConnection, PeerPool, encode_frame
+from snapshot import SNAPSHOT_INTERVAL
+from wal import WriteAheadLog, fsync_directory
+
+# Multi-Paxos: the nodes agree on a log of numbered slots instead of a single value.
+# A node becomes leader by running Prepare once with a new proposal number for every slot from the first
+# one it does not know to be chosen. After that each value it appends costs only an Accept round for the
+# next free slot. A node that sees a higher proposal number in a rejection stops leading, and the next
+# append runs Prepare again. Chosen values are announced with COMMIT and applied to the node's file in
+# slot order.
+# Each slot holds a batch: the values clients sent while the previous batch was being proposed.
+# The leader keeps up to 'window' slots in their Accept round at once, and sends COMMIT in slot order.
+# Promises, accepted values and commits go to the node's write-ahead log, and an acceptor answers only
+# once its promise or accepted value is on disk. A restarted node replays the log and rebuilds its file.
+# Every 'snapshot_interval' applied slots the node snapshots its file in the background, then drops the
+# slots the snapshot covers from memory and the write-ahead log segments before the snapshot.
+# A node that starts, misses commits, or finds slots only in other nodes' snapshots catches up from the
+# most advanced peer: that peer's snapshot in chunks if needed, then the chosen slots after it.
+# --engine eventloop runs each node on one asyncio loop (EventLoopNodeServer), with the same messages.
+#
+# Messages between nodes (values are JSON):
+#   PREPARE <n> <from_slot>         -> PROMISE <n> <compacted> [[slot, accepted n, batch], ...] | REJECTED <min_proposal>
+#                                      (slots below 'compacted' are chosen and only in the acceptor's snapshot)
+#   ACCEPT <n> <slot> <batch>       -> ACCEPTED <slot> | REJECTED <min_proposal>
+#   COMMIT <slot> <batch>           -> OK
+#   STATUS, SNAPSHOT_OPEN, SNAPSHOT_CHUNK, SNAPSHOT_CLOSE, LOG_SUFFIX, see catch_up.py
+# Messages from clients:
+#   START_PAXOS <A|B> <int value>   -> appends the value on the node of that proposer (node 1 for A, 3 for B)
+#   APPEND <value text>             -> APPENDED <slot> | Error: ...
+#   READ [from_slot]                -> LOG <from_slot> [batch, ...], the committed prefix from that slot
+
+NOOP = []  # an empty batch, fills slots a new leader finds empty below ones that were accepted
+PROPOSAL_STRIDE = 100  # proposal numbers are round * PROPOSAL_STRIDE + node id, so no two nodes share one
+APPEND_ATTEMPTS = 3  # Prepare/Accept tries before append gives up on a contended log
+PIPELINE_WINDOW = 8  # slots the leader may have in their Accept round at the same time
+VERBOSE = True
+
 
 class NodeServer:
-    def __init__(self, node_id, address, all_nodes):
+    # Threaded engine: a thread per connection and per batcher worker
+    peer_pool_class = PeerPool
+    batcher_class = Batcher
+
+    def __init__(self, node_id, address, all_nodes, window=PIPELINE_WINDOW, snapshot_interval=SNAPSHOT_INTERVAL):
         self.node_id = node_id
         self.address = address
         self.all_nodes = all_nodes
-        self.min_proposal = 0  # Minimum proposal number this node is willing to accept
-        self.accepted_proposal = None  # The last proposal number this node accepted
-        self.accepted_value = None  # The last value this node accepted
+        self.majority = len(all_nodes) // 2 + 1
         self.file_path = f"CISC5597_{self.node_id}.txt"  # Each node maintains a file as part of simulation
-        self.last_proposal_number = 0  # Tracks the last proposal number
-
-        # Initialize file if it doesn't exist
-        if not os.path.exists(self.file_path):
-            with open(self.file_path, 'w') as f:
-                f.write("Initial content of CISC5597\n")
-
-    # 1) Proposer: Choose new proposal number n and broadcast Prepare(n) to all servers
-    def start_paxos_process(self, value, prop_num):
-        proposal_number = self.min_proposal + prop_num
-        print(f"Node {self.node_id}: Starting new Paxos protocol as proposer with proposal number {proposal_number} and value {value}")
-        prepare_responses = self.send_prepare(proposal_number)
-
-        # 4) Proposer: Count PREPARE_OK responses for majority check
-        prepare_ok_count = sum(1 for response in prepare_responses if response['status'] == "PREPARE_OK")
-        
-        if prepare_ok_count >= 2:
-            # If any acceptedValues returned, use highest accepted proposal’s value
-            highest_accepted = max(
-                (response for response in prepare_responses if response['accepted_value'] is not None),
-                key=lambda x: x['accepted_proposal'], default=None
-            )
-            if highest_accepted:
-                value = highest_accepted['accepted_value']
-                print(f"Node {self.node_id}: Proposal number {proposal_number} updated with accepted value {value}")
-
-            # Proceed to Accept phase
-            accept_responses = self.send_accept(proposal_number, value)
-            accept_ok_count = sum(1 for response in accept_responses if response == "ACCEPT_OK")
-            
-            if accept_ok_count >= 2:
-                self.finalize_value(value)
-
-    # Sends a prepare message to all nodes
-    def send_prepare(self, proposal_number):
-        responses = []
-        threads = []
-
-        # Define a callback for handling responses
-        def handle_response(node, s):
-            response = s.recv(1024).decode()
-            status, accepted_proposal, accepted_value = response.split()
-            responses.append({
-                'node': node,
-                'status': status,
-                'accepted_proposal': int(accepted_proposal) if accepted_proposal != 'None' else None,
-                'accepted_value': int(accepted_value) if accepted_value != 'None' else None
-            })
-            s.close()
-
-        # Broadcast prepare message to all nodes
-        for node in self.all_nodes:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(node)
-            message = f"PREPARE {proposal_number}"
-            print(f"Node {self.node_id} (Proposer): Sending PREPARE with proposal number {proposal_number} to Node at {node}")
-            s.send(message.encode())
-            t = threading.Thread(target=handle_response, args=(node, s))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        return responses
-
-    # Sends an accept message to all nodes
-    def send_accept(self, proposal_number, value):
-        responses = []
-        threads = []
-
-        def handle_response(node, s):
-            response = s.recv(1024).decode()
-            responses.append(response)
-            s.close()
-
-        for node in self.all_nodes:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(node)
-            message = f"ACCEPT {proposal_number} {value}"
-            print(f"Node {self.node_id} (Proposer): Sending ACCEPT with proposal number {proposal_number} and value {value} to Node at {node}")
-            s.send(message.encode())
-            t = threading.Thread(target=handle_response, args=(node, s))
-            threads.append(t)
-            t.start()
-
-        for t in threads:
-            t.join()
-
-        return responses
-
-    def finalize_value(self, value):
-        """Finalize the value and save it to the node's file."""
-        self.accepted_value = value
-        with open(self.file_path, 'w') as f:
-            f.write(f"Accepted value: {value}\n")
-        print(f"Node {self.node_id}: Finalized value {value}.")
-
-    def handle_prepare(self, proposal_number):
-        if proposal_number > self.min_proposal:
-            self.min_proposal = proposal_number
-            print(f"Node {self.node_id}: PREPARE_OK for proposal number {proposal_number}.")
-            return f"PREPARE_OK {self.accepted_proposal or 'None'} {self.accepted_value or 'None'}"
-        else:
-            print(f"Node {self.node_id}: PREPARE_REJECTED for proposal number {proposal_number}.")
-            return "REJECTED None None"
-
-    def handle_accept(self, proposal_number, value):
-        if proposal_number >= self.min_proposal:
-            self.accepted_proposal = self.min_proposal = proposal_number
-            self.accepted_value = value
-            print(f"Node {self.node_id}: ACCEPT_OK for proposal {proposal_number} with value {value}.")
-            with open(self.file_path, 'w') as f:
-                f.write(f"Accepted value: {value}\n")
-            return "ACCEPT_OK"
+        self.peers = self.peer_pool_class(all_nodes)  # One long-lived connection to every node, opened on first use
+
+        # Acceptor: one promise for all slots, and what was accepted in each slot, kept in the write-ahead log
+        self.min_proposal = 0  # Minimum proposal number this node is willing to accept
+        self.accepted = {}  # slot: (proposal number, value)
+        self.lock = threading.Lock()  # guards the acceptor and learner state, handlers run on many threads
+        self.wal = WriteAheadLog(f"CISC5597_{self.node_id}.wal")
+
+        # Learner: chosen values, applied to the file in slot order
+        self.chosen = {}  # slot: value
+        self.applied = 0  # slots below this one are in the file
+        self.file_size = 0  # bytes in the file
+        self.file = None  # the file opened for appending, kept open across batches
+
+        # Snapshots of the file, see snapshot.py
+        self.snapshot_path = f"CISC5597_{self.node_id}.snapshot"
+        self.snapshot_interval = snapshot_interval
+        self.compacted = 0  # slots below this one are only in the snapshot
+        self.snapshotting = False
+        self.snapshot_source = SnapshotSource(self.snapshot_path)  # snapshots being streamed to peers
+        self.catching_up = False
+
+        # Leader: set while this node's proposal number holds a majority's promise
+        self.proposal_number = None
+        self.highest_seen = 0  # highest proposal number seen in a rejection, the next one has to beat it
+        self.next_slot = 0
+        self.proposer_lock = threading.Lock()  # guards the leader state, held for Prepare and to take a slot
+        self.decided = {}  # slot: batch, accepted by a majority and waiting for the slots before it
+        self.commit_next = 0  # the next slot to send COMMIT for
+        self.commit_lock = threading.Lock()
+        # Values appended together go into one slot, and 'window' batches are in their rounds at once
+        self.batcher = self.batcher_class(self.propose, workers=window)
+
+        self.recover()
+
+    # Rebuilds the file from the last snapshot, the acceptor and learner state from the write-ahead log,
+    # and applies the chosen values that came after the snapshot
+    def recover(self):
+        metadata = snapshot.read_header(self.snapshot_path)
+        if metadata is not None:
+            snapshot.restore_state(self.snapshot_path, self.file_path, metadata)
+            self.applied = self.compacted = metadata["applied"]
+            self.file_size = metadata["size"]
         else:
-            print(f"Node {self.node_id}: REJECTED for ACCEPT proposal {proposal_number} with value {value}.")
-            return "REJECTED"
+            with open(self.file_path, 'wb') as f:
+                self.file_size = f.write(b"Initial content of CISC5597\n")
+
+        for record in self.wal.replay():
+            if record[0] == "P":
+                self.min_proposal = max(self.min_proposal, record[1])
+            elif record[0] == "A":
+                slot, proposal_number, value = record[1:]
+                self.min_proposal = max(self.min_proposal, proposal_number)
+                self.accepted[slot] = (proposal_number, value)
+            elif record[0] == "C":
+                self.chosen[record[1]] = record[2]
+            elif record[0] == "S":
+                # Written when a snapshot started: the state its segment starts from
+                self.min_proposal = max(self.min_proposal, record[1])
+                self.accepted.update((slot, (proposal_number, value)) for slot, proposal_number, value in record[2])
+                self.chosen.update((slot, value) for slot, value in record[3])
+        self.accepted = {slot: entry for slot, entry in self.accepted.items() if slot >= self.compacted}
+        self.chosen = {slot: value for slot, value in self.chosen.items() if slot >= self.applied}
+        self.apply_chosen()
+        self.wal.open()
+        if self.accepted or self.chosen:
+            self.log(f"Recovered promise {self.min_proposal}, {len(self.accepted)} accepted slots, "
+                     f"{self.applied} applied slots ({self.compacted} from the snapshot)")
+
+    def log(self, text):
+        if VERBOSE:
+            print(f"Node {self.node_id}: {text}")
+
+    # Proposer: append a value to the replicated log, returns its slot or None if other proposers kept winning.
+    # Values appended concurrently share a slot, see batcher.py.
+    def append(self, value):
+        return self.batcher.submit(value)
+
+    # Proposes one batch of values for the next free slot, returns the slot or None.
+    # Each batcher worker takes a slot under the proposer lock and runs the Accept round without it,
+    # so the rounds of up to 'window' slots overlap.
+    def propose(self, values):
+        for attempt in range(APPEND_ATTEMPTS):
+            with self.proposer_lock:
+                if self.proposal_number is None and not self.become_leader():
+                    continue
+                proposal_number, slot = self.proposal_number, self.next_slot
+                self.next_slot += 1
+            if self.send_accept(proposal_number, slot, values):
+                self.commit_in_order(slot, values)
+                return slot
+            # The slot stays empty until the next leader fills it while re-proposing
+            self.log(f"Lost leadership at slot {slot}")
+            with self.proposer_lock:
+                if self.proposal_number == proposal_number:
+                    self.proposal_number = None
+        return None
+
+    # Leader: COMMIT goes out in slot order, a slot decided before the ones below it waits here for them
+    def commit_in_order(self, slot, value):
+        with self.commit_lock:
+            if slot < self.commit_next:
+                return
+            self.decided[slot] = value
+            while True:
+                if self.commit_next in self.decided:
+                    self.send_commit(self.commit_next, self.decided.pop(self.commit_next))
+                elif not self.is_chosen(self.commit_next):
+                    break
+                self.commit_next += 1
+
+    def is_chosen(self, slot):
+        with self.lock:
+            return slot < self.applied or slot in self.chosen
+
+    # The batches of the committed prefix of the log, from slot 'start' up to the first slot not known to be chosen
+    def committed(self, start=0):
+        with self.lock:
+            values = []
+            slot = start
+            while slot in self.chosen:
+                values.append(self.chosen[slot])
+                slot += 1
+            return values
+
+    # 1) Proposer: Choose new proposal number n and broadcast Prepare(n) for every slot not known to be chosen
+    def become_leader(self):
+        proposal_number, from_slot, known_end = self.new_round()
+        self.log(f"Starting Prepare with proposal number {proposal_number} from slot {from_slot}")
+        promised = self.count_promises(proposal_number, self.send_prepare(proposal_number, from_slot))
+        if promised is None:
+            return False
+        compacted, highest = promised
+        if compacted > from_slot:
+            self.log(f"Cannot lead yet, slots {from_slot}-{compacted - 1} are only in other nodes' snapshots")
+            self.catch_up()
+            return False
+
+        end = max(max(highest, default=-1) + 1, known_end)
+        self.proposal_number = proposal_number
+        self.log(f"Leading with proposal number {proposal_number}, re-proposing slots {from_slot}-{end}")
+        for slot in range(from_slot, end):
+            value = self.reproposal(slot, highest)
+            if not self.send_accept(proposal_number, slot, value):
+                self.proposal_number = None
+                return False
+            self.commit_in_order(slot, value)
+        self.next_slot = end
+        return True
+
+    # A proposal number above every one seen, the first slot not known to be chosen, and the end of the known ones
+    def new_round(self):
+        with self.lock:
+            round_number = max(self.min_proposal, self.highest_seen) // PROPOSAL_STRIDE + 1
+            proposal_number = round_number * PROPOSAL_STRIDE + self.node_id
+            from_slot = self.applied
+            while from_slot in self.chosen:
+                from_slot += 1
+            return proposal_number, from_slot, max(self.chosen, default=-1) + 1
+
+    # 4) Proposer: Count PROMISE responses for majority check. Returns None without a majority, otherwise the
+    # first slot no acceptor compacted away and {slot: (accepted proposal number, value)} of the highest
+    # proposal number accepted in every slot a promise reported
+    def count_promises(self, proposal_number, responses):
+        promises = [entries for status, compacted, entries in responses if status == "PROMISE"]
+        if len(promises) < self.majority:
+            self.log(f"Prepare with proposal number {proposal_number} rejected")
+            return None
+        # Slots an acceptor compacted away are chosen, but this node does not know their values
+        compacted = max(compacted for status, compacted, entries in responses if status == "PROMISE")
+        highest = {}
+        for entries in promises:
+            for slot, accepted_proposal, value in entries:
+                if slot not in highest or accepted_proposal > highest[slot][0]:
+                    highest[slot] = (accepted_proposal, value)
+        return compacted, highest
+
+    # The value a new leader proposes in a slot: the chosen one if known, else the one accepted with the
+    # highest proposal number, else a no-op
+    def reproposal(self, slot, highest):
+        with self.lock:
+            return self.chosen[slot] if slot in self.chosen else highest.get(slot, (None, NOOP))[1]
+
+    # Sends a prepare message to all nodes, returns [(status, compacted, accepted entries)] of the nodes that answered
+    def send_prepare(self, proposal_number, from_slot):
+        message = f"PREPARE {proposal_number} {from_slot}"
+        self.log(f"(Proposer) Sending PREPARE with proposal number {proposal_number} from slot {from_slot}")
+        # All nodes get the message at once over their open connections, one round trip for the phase
+        return [self.prepare_response(response) for node, response in self.peers.broadcast(message)]
+
+    def prepare_response(self, response):
+        parts = response.split(" ", 3)
+        if parts[0] == "PROMISE":
+            return parts[0], int(parts[2]), json.loads(parts[3])
+        self.saw_proposal(int(parts[1]))
+        return parts[0], 0, []
+
+    # Sends an accept message to all nodes, returns whether a majority accepted it
+    def send_accept(self, proposal_number, slot, value):
+        message = f"ACCEPT {proposal_number} {slot} {json.dumps(value)}"
+        self.log(f"(Proposer) Sending ACCEPT with proposal number {proposal_number} for slot {slot} and value {value}")
+        return self.count_accepted(self.peers.broadcast(message, wait_for=self.majority)) >= self.majority
+
+    def count_accepted(self, responses):
+        accepted = 0
+        for node, response in responses:
+            status, number = response.split()
+            if status == "ACCEPTED":
+                accepted += 1
+            else:
+                self.saw_proposal(int(number))
+        return accepted
+
+    # Learns a chosen value here and tells the other nodes, without waiting for them
+    def send_commit(self, slot, value):
+        self.handle_commit(slot, value)
+        others = [node for node in self.all_nodes if node != self.address]
+        self.peers.notify(f"COMMIT {slot} {json.dumps(value)}", others)
+
+    # A rejection names a higher promise: remember it so the next proposal number beats it
+    def saw_proposal(self, proposal_number):
+        with self.lock:
+            self.highest_seen = max(self.highest_seen, proposal_number)
+
+    def handle_prepare(self, proposal_number, from_slot):
+        with self.lock:
+            if proposal_number > self.min_proposal:
+                self.min_proposal = proposal_number
+                self.wal.append(["P", proposal_number])
+                entries = [[slot, accepted_proposal, value]
+                           for slot, (accepted_proposal, value) in sorted(self.accepted.items()) if slot >= from_slot]
+                self.log(f"PROMISE for proposal number {proposal_number} from slot {from_slot}.")
+                return f"PROMISE {proposal_number} {self.compacted} {json.dumps(entries)}"
+            self.log(f"PREPARE_REJECTED for proposal number {proposal_number}.")
+            return f"REJECTED {self.min_proposal}"
+
+    def handle_accept(self, proposal_number, slot, value):
+        with self.lock:
+            if slot < self.compacted:
+                return f"ACCEPTED {slot}"  # chosen long ago, whoever sends this re-proposes the chosen value
+            if proposal_number >= self.min_proposal:
+                self.min_proposal = proposal_number
+                self.accepted[slot] = (proposal_number, value)
+                self.wal.append(["A", slot, proposal_number, value])
+                self.log(f"ACCEPT_OK for proposal {proposal_number} in slot {slot} with value {value}.")
+                return f"ACCEPTED {slot}"
+            self.log(f"REJECTED for ACCEPT proposal {proposal_number} in slot {slot} with value {value}.")
+            return f"REJECTED {self.min_proposal}"
+
+    def handle_commit(self, slot, value):
+        with self.lock:
+            if slot >= self.applied and slot not in self.chosen:
+                self.chosen[slot] = value
+                self.wal.append(["C", slot, value], sync=False)  # only acceptor answers have to wait for the disk
+            self.apply_chosen()
+            if slot - self.applied >= CATCH_UP_GAP and not self.catching_up:
+                self.log(f"Commit for slot {slot} while slot {self.applied} is missing, catching up")
+                threading.Thread(target=self.catch_up, daemon=True).start()
+        return "OK"
+
+    # Appends the chosen values that follow the applied prefix to the file, in slot order (lock held)
+    def apply_chosen(self):
+        lines = []
+        while self.applied in self.chosen:
+            for value in self.chosen[self.applied]:
+                lines.append(f"Accepted value: {value}\n")
+            self.applied += 1
+        if lines:
+            if self.file is None:
+                self.file = open(self.file_path, 'ab', buffering=0)
+            self.file_size += self.file.write("".join(lines).encode())
+            self.log(f"Applied log up to slot {self.applied - 1}.")
+        if self.applied - self.compacted >= self.snapshot_interval and not self.snapshotting:
+            self.start_snapshot()
+
+    # Starts a snapshot of the file as it is now (lock held). Records from here on go to a new write-ahead
+    # log segment, which starts with what the acceptor and learner know about slots past the snapshot, so
+    # the older segments can go once the snapshot is on disk.
+    def start_snapshot(self):
+        self.snapshotting = True
+        applied = self.applied
+        segment, sequence = self.start_segment(applied)
+        metadata = {"node": self.node_id, "applied": applied, "size": self.file_size}
+        threading.Thread(target=self.take_snapshot, args=(metadata, segment, sequence), daemon=True).start()
+
+    # Rotates the write-ahead log, and starts the new segment with everything about slots from 'first' on
+    # (lock held). Returns the segment and the sequence number of that record.
+    def start_segment(self, first):
+        segment = self.wal.rotate()
+        sequence = self.wal.append([
+            "S", self.min_proposal,
+            [[slot, proposal_number, value] for slot, (proposal_number, value) in self.accepted.items() if slot >= first],
+            [[slot, value] for slot, value in self.chosen.items() if slot >= first]])
+        return segment, sequence
+
+    # Snapshot thread: copies the file, then compacts the write-ahead log and the in-memory log
+    def take_snapshot(self, metadata, segment, sequence):
+        try:
+            snapshot.write_snapshot(self.file_path, self.snapshot_path, metadata)
+            self.wal.flush(sequence)
+            self.wal.remove_segments(segment)
+        except OSError as e:
+            self.log(f"Snapshot failed: {e}")
+            with self.lock:
+                self.snapshotting = False
+            return
+
+        # Drop the covered slots a bounded number at a time, so accepts only ever wait for a short stretch
+        applied = metadata["applied"]
+        with self.lock:
+            start, self.compacted = self.compacted, applied
+        for first in range(start, applied, 1000):
+            with self.lock:
+                for slot in range(first, min(first + 1000, applied)):
+                    self.accepted.pop(slot, None)
+                    self.chosen.pop(slot, None)
+        with self.lock:
+            self.snapshotting = False
+        self.log(f"Snapshot of slots below {applied} ({metadata['size']} bytes) taken, log compacted")
+
+    # Brings the file and the log up to the most advanced peer. Returns at once if a catch-up is running.
+    def catch_up(self):
+        with self.lock:
+            if self.catching_up:
+                return
+            self.catching_up = True
+        # Connections of their own, so snapshot chunks do not queue in front of Accepts to the same node,
+        # and a peer that is down now does not count as down for the pool
+        connections = [PeerConnection(node) for node in self.all_nodes if node != self.address]
+        try:
+            statuses = []
+            for connection in connections:
+                response = connection.request("STATUS")
+                if response is not None and response.startswith("STATUS "):
+                    status, applied, compacted = response.split()
+                    statuses.append((int(applied), int(compacted), connection))
+            if not statuses:
+                return
+            applied, compacted, connection = max(statuses, key=lambda status: status[:2])
+            # The peer may snapshot past the slots it sent while the transfer runs, then go again
+            for attempt in range(CATCH_UP_ATTEMPTS):
+                if applied <= self.applied:
+                    break
+                self.log(f"Catching up from slot {self.applied} to {applied} from Node at {connection.address}")
+                if compacted > self.applied:
+                    self.install_snapshot(connection)
+                self.fetch_suffix(connection)
+                self.log(f"Caught up to slot {self.applied}")
+                response = connection.request("STATUS")
+                if response is None or not response.startswith("STATUS "):
+                    break
+                applied, compacted = (int(number) for number in response.split()[1:])
+        except OSError as e:
+            self.log(f"Catching up failed: {e}")
+        finally:
+            for connection in connections:
+                connection.close()
+            with self.lock:
+                self.catching_up = False
+
+    # Streams a peer's snapshot and makes it this node's file and snapshot
+    def install_snapshot(self, connection):
+        incoming = self.snapshot_path + ".incoming"
+        metadata = catch_up.fetch_snapshot(connection, incoming)
+        if metadata is None:
+            return
+        state = self.file_path + ".incoming"
+        catch_up.extract_state(incoming, state, metadata)
+
+        # A snapshot of this node's own must not replace the newer one
+        while True:
+            with self.lock:
+                if not self.snapshotting:
+                    self.snapshotting = True
+                    break
+            time.sleep(0.05)
+        try:
+            with self.lock:
+                if metadata["applied"] <= self.applied:
+                    os.remove(incoming)
+                    os.remove(state)
+                    return
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                os.replace(state, self.file_path)
+                os.replace(incoming, self.snapshot_path)
+                self.applied = self.compacted = metadata["applied"]
+                self.file_size = metadata["size"]
+                self.accepted = {slot: entry for slot, entry in self.accepted.items() if slot >= self.applied}
+                self.chosen = {slot: value for slot, value in self.chosen.items() if slot >= self.applied}
+                segment, sequence = self.start_segment(self.applied)
+                self.apply_chosen()
+            fsync_directory(self.file_path)
+            self.wal.flush(sequence)
+            self.wal.remove_segments(segment)
+            self.log(f"Installed a snapshot of slots below {metadata['applied']} ({metadata['size']} bytes)")
+        finally:
+            with self.lock:
+                self.snapshotting = False
+
+    # Asks a peer for the chosen slots after the applied ones until it has no more
+    def fetch_suffix(self, connection):
+        while True:
+            applied = self.applied
+            response = connection.request(f"LOG_SUFFIX {applied} {SUFFIX_SLOTS}")
+            if response is None or not response.startswith("SUFFIX "):
+                return
+            entries = json.loads(response[len("SUFFIX "):])
+            for slot, value in entries:
+                self.handle_commit(slot, value)
+            if not entries or self.applied == applied:
+                return
+
+    def handle_status(self):
+        with self.lock:
+            return f"STATUS {self.applied} {self.compacted}"
+
+    def handle_log_suffix(self, from_slot, count):
+        with self.lock:
+            if from_slot < self.compacted:
+                return f"Error: slots below {self.compacted} are only in the snapshot"
+            entries = []
+            slot = from_slot
+            while slot in self.chosen and len(entries) < count:
+                entries.append([slot, self.chosen[slot]])
+                slot += 1
+        return f"SUFFIX {json.dumps(entries)}"
+
+    def handle_snapshot_open(self):
+        opened = self.snapshot_source.open()
+        if opened is None:
+            return "NONE"
+        transfer_id, metadata = opened
+        return f"SNAPSHOT {transfer_id} {json.dumps(metadata)}"
+
+    def handle_snapshot_chunk(self, transfer_id, offset, length):
+        data = self.snapshot_source.read(transfer_id, offset, length)
+        if data is None:
+            return f"Error: no snapshot transfer {transfer_id}"
+        return b"CHUNK " + data
 
     def start(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.bind(self.address)
         server.listen()
         print(f"Node {self.node_id} started at {self.address}")
+        # A node that was down catches up with the others before it gets far behind
+        threading.Thread(target=self.catch_up, daemon=True).start()
 
         while True:
             conn, addr = server.accept()
             threading.Thread(target=self.handle_request, args=(conn,)).start()
 
     def handle_request(self, conn):
-        message = conn.recv(1024).decode()
-        parts = message.split()
+        message = conn.recv(1024)
+        # Other nodes open a long-lived connection that starts with PEER_MAGIC
+        while message and PEER_MAGIC.startswith(message[:len(PEER_MAGIC)]) and len(message) < len(PEER_MAGIC):
+            data = conn.recv(1024)
+            if not data:
+                break
+            message += data
+        if message.startswith(PEER_MAGIC):
+            self.handle_peer(conn, message[len(PEER_MAGIC):])
+            return
+
+        response = self.handle_message(message.decode())
+        self.wal.flush()
+        # Snapshot chunks are bytes already, and may be more than one send takes
+        if isinstance(response, str):
+            response = response.encode()
+        conn.sendall(response)
+        conn.close()
+
+    # Serves a peer's connection until it closes, answering each request frame with a frame of the same id
+    def handle_peer(self, conn, data):
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = FrameReader(conn, data)
+        try:
+            while True:
+                frames = reader.read()
+                if frames is None:
+                    break
+                replies = [encode_frame(request_id, self.handle_message(payload.decode()))
+                           for request_id, payload in frames]
+                # One fsync covers the records of every frame in this read (and of other connections meanwhile)
+                self.wal.flush()
+                conn.sendall(b"".join(replies))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def handle_message(self, message):
+        parts = message.split(" ", 3)
 
         if parts[0] == "START_PAXOS":
             proposer_type = parts[1]
             value = int(parts[2])
-            proposal_num = 5 if proposer_type == 'A' else 7
             if (proposer_type == 'A' and self.node_id == 1) or (proposer_type == 'B' and self.node_id == 3):
-                self.start_paxos_process(value, proposal_num)
-                response = f"Proposal initiated by Node {self.node_id} for Proposer {proposer_type}"
+                slot = self.append(value)
+                if slot is None:
+                    response = f"Proposal by Node {self.node_id} for Proposer {proposer_type} was not chosen"
+                else:
+                    response = f"Value {value} chosen in slot {slot} by Node {self.node_id} for Proposer {proposer_type}"
             else:
                 response = "Invalid Proposer"
 
+        elif parts[0] == "APPEND":
+            value = message[len("APPEND "):]
+            slot = self.append(value)
+            response = f"APPENDED {slot}" if slot is not None else "Error: value was not chosen, other proposers kept winning"
+        elif parts[0] == "READ":
+            start = max(int(parts[1]) if len(parts) > 1 else 0, self.compacted)
+            response = f"LOG {start} {json.dumps(self.committed(start))}"
+
         elif parts[0] == "PREPARE":
-            proposal_number = int(parts[1])
-            response = self.handle_prepare(proposal_number)
+            response = self.handle_prepare(int(parts[1]), int(parts[2]))
         elif parts[0] == "ACCEPT":
-            proposal_number = int(parts[1])
-            value = int(parts[2])
-            response = self.handle_accept(proposal_number, value)
+            response = self.handle_accept(int(parts[1]), int(parts[2]), json.loads(parts[3]))
+        elif parts[0] == "COMMIT":
+            _, slot, value = message.split(" ", 2)
+            response = self.handle_commit(int(slot), json.loads(value))
 
-        conn.send(response.encode())
-        conn.close()
+        elif parts[0] == "STATUS":
+            response = self.handle_status()
+        elif parts[0] == "LOG_SUFFIX":
+            response = self.handle_log_suffix(int(parts[1]), int(parts[2]))
+        elif parts[0] == "SNAPSHOT_OPEN":
+            response = self.handle_snapshot_open()
+        elif parts[0] == "SNAPSHOT_CHUNK":
+            response = self.handle_snapshot_chunk(int(parts[1]), int(parts[2]), int(parts[3]))
+        elif parts[0] == "SNAPSHOT_CLOSE":
+            self.snapshot_source.close(int(parts[1]))
+            response = "OK"
+        else:
+            response = f"Error: unknown message {parts[0]}"
+
+        return response
+
+
+class EventLoopNodeServer(NodeServer):
+    """The same node on one asyncio loop: connections, Prepare/Accept rounds and batcher workers are tasks
+    instead of threads. The acceptor and learner handlers are NodeServer's, called on the loop. The
+    write-ahead log writer, snapshots and catch-up keep their threads, they block on the disk or run long.
+    """
+    peer_pool_class = AsyncPeerPool
+    batcher_class = AsyncBatcher
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.proposer_lock = asyncio.Lock()  # held across the awaits of Prepare
+        self.loop = None
+
+    async def append(self, value):
+        return await self.batcher.submit(value)
+
+    async def propose(self, values):
+        for attempt in range(APPEND_ATTEMPTS):
+            async with self.proposer_lock:
+                if self.proposal_number is None and not await self.become_leader():
+                    continue
+                proposal_number, slot = self.proposal_number, self.next_slot
+                self.next_slot += 1
+            if await self.send_accept(proposal_number, slot, values):
+                self.commit_in_order(slot, values)
+                return slot
+            self.log(f"Lost leadership at slot {slot}")
+            if self.proposal_number == proposal_number:
+                self.proposal_number = None
+        return None
+
+    async def become_leader(self):
+        proposal_number, from_slot, known_end = self.new_round()
+        self.log(f"Starting Prepare with proposal number {proposal_number} from slot {from_slot}")
+        promised = self.count_promises(proposal_number, await self.send_prepare(proposal_number, from_slot))
+        if promised is None:
+            return False
+        compacted, highest = promised
+        if compacted > from_slot:
+            self.log(f"Cannot lead yet, slots {from_slot}-{compacted - 1} are only in other nodes' snapshots")
+            await self.loop.run_in_executor(None, self.catch_up)
+            return False
+
+        end = max(max(highest, default=-1) + 1, known_end)
+        self.proposal_number = proposal_number
+        self.log(f"Leading with proposal number {proposal_number}, re-proposing slots {from_slot}-{end}")
+        for slot in range(from_slot, end):
+            value = self.reproposal(slot, highest)
+            if not await self.send_accept(proposal_number, slot, value):
+                self.proposal_number = None
+                return False
+            self.commit_in_order(slot, value)
+        self.next_slot = end
+        return True
+
+    async def send_prepare(self, proposal_number, from_slot):
+        message = f"PREPARE {proposal_number} {from_slot}"
+        self.log(f"(Proposer) Sending PREPARE with proposal number {proposal_number} from slot {from_slot}")
+        return [self.prepare_response(response) for node, response in await self.peers.broadcast(message)]
+
+    async def send_accept(self, proposal_number, slot, value):
+        message = f"ACCEPT {proposal_number} {slot} {json.dumps(value)}"
+        self.log(f"(Proposer) Sending ACCEPT with proposal number {proposal_number} for slot {slot} and value {value}")
+        return self.count_accepted(await self.peers.broadcast(message, wait_for=self.majority)) >= self.majority
+
+    # Waits on the loop until every synced write-ahead log record so far is on disk
+    async def flush(self):
+        future = self.loop.create_future()
+
+        def durable(error):
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+        if self.wal.when_durable(lambda error: self.loop.call_soon_threadsafe(durable, error)):
+            await future
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle_request, *self.address)
+        print(f"Node {self.node_id} started at {self.address}")
+        threading.Thread(target=self.catch_up, daemon=True).start()
+        async with server:
+            await server.serve_forever()
+
+    async def handle_request(self, reader, writer):
+        try:
+            message = await reader.read(1024)
+            while message and PEER_MAGIC.startswith(message[:len(PEER_MAGIC)]) and len(message) < len(PEER_MAGIC):
+                data = await reader.read(1024)
+                if not data:
+                    break
+                message += data
+            if message.startswith(PEER_MAGIC):
+                await self.handle_peer(reader, writer, message[len(PEER_MAGIC):])
+                return
+            response = await self.handle_message(message.decode())
+            await self.flush()
+            if isinstance(response, str):
+                response = response.encode()
+            writer.write(response)
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def handle_peer(self, reader, writer, data):
+        frames = FrameReader(None)
+        pending = frames.feed(data)
+        while True:
+            replies = [encode_frame(request_id, await self.handle_message(payload.decode()))
+                       for request_id, payload in pending]
+            if replies:
+                await self.flush()
+                writer.write(b"".join(replies))
+                await writer.drain()
+            data = await reader.read(256 * 1024)
+            if not data:
+                return
+            pending = frames.feed(data)
+
+    # Client messages that append wait for their batch on the loop, everything else is answered at once
+    async def handle_message(self, message):
+        parts = message.split(" ", 3)
+        if parts[0] == "START_PAXOS":
+            proposer_type = parts[1]
+            value = int(parts[2])
+            if (proposer_type == 'A' and self.node_id == 1) or (proposer_type == 'B' and self.node_id == 3):
+                slot = await self.append(value)
+                if slot is None:
+                    return f"Proposal by Node {self.node_id} for Proposer {proposer_type} was not chosen"
+                return f"Value {value} chosen in slot {slot} by Node {self.node_id} for Proposer {proposer_type}"
+            return "Invalid Proposer"
+        if parts[0] == "APPEND":
+            slot = await self.append(message[len("APPEND "):])
+            return f"APPENDED {slot}" if slot is not None else "Error: value was not chosen, other proposers kept winning"
+        return NodeServer.handle_message(self, message)
 
 # Initialize nodes and their addresses
 nodes = {
@@ -176,9 +756,34 @@ nodes = {
     3: ('localhost', 5003)
 }
 
-# Create NodeServer instances for each node
-node_servers = [NodeServer(node_id, address, list(nodes.values())) for node_id, address in nodes.items()]
+ENGINES = {'thread': NodeServer, 'eventloop': EventLoopNodeServer}
+
+def start_nodes(nodes, engine='thread', **options):
+    # Create NodeServer instances for each node
+    node_servers = [ENGINES[engine](node_id, address, list(nodes.values()), **options)
+                    for node_id, address in nodes.items()]
+
+    # Start servers for each node in separate threads
+    for node_server in node_servers:
+        threading.Thread(target=node_server.start).start()
+    return node_servers
+
+def main(nodes):
+    global VERBOSE
+    parser = argparse.ArgumentParser(description='Multi-Paxos nodes of lab3')
+    parser.add_argument('--window', type=int, default=PIPELINE_WINDOW,
+                        help='slots the leader keeps in their Accept round at once')
+    parser.add_argument('--snapshot-interval', type=int, default=SNAPSHOT_INTERVAL,
+                        help='applied slots between snapshots of the file')
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='thread',
+                        help='thread: a thread per connection and batcher worker, eventloop: one asyncio loop per node')
+    parser.add_argument('--quiet', action='store_true', help='do not print every Paxos message')
+    args = parser.parse_args()
+    VERBOSE = not args.quiet
+    start_nodes(nodes, engine=args.engine, window=args.window, snapshot_interval=args.snapshot_interval)
+    # The event-loop engine resolves addresses and catches up in asyncio's executor, which stops taking
+    # work once the main thread is done
+    threading.Event().wait()
 
-# Start servers for each node in separate threads
-for node_server in node_servers:
-    threading.Thread(target=node_server.start).start()
+if __name__ == "__main__":
+    main(nodes)
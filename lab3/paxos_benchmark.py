@@ -0,0 +1,196 @@
+# Throughput of the lab3 Multi-Paxos log by pipeline window
+# For every window size a fresh three node cluster is started in this process, 'clients' threads append
+# 'values' values through its first node as fast as they can, and the values committed per second are reported.
+# Loopback round trips are far shorter than real ones, so --rtt can add a simulated round trip to every
+# message between nodes (the reply is handed over that much later, without holding up other messages).
+# --engines runs the same windows on the threaded and the event-loop node (node_server.ENGINES). With the
+# default batch size of 1 every slot is one Accept round, and the CPU time of the whole process (all three
+# nodes and the clients) is reported per round. On the event-loop engine the clients are tasks on the
+# first node's loop.
+#   python paxos_benchmark.py --windows 1,2,4,8,16 --clients 64 --values 20000 --rtt 2
+#   python paxos_benchmark.py --engines thread,eventloop --windows 1,8 --values 20000
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import node_server
+import peer_pool
+from node_server import ENGINES
+from snapshot import SNAPSHOT_INTERVAL
+
+
+class Delay:
+    """Calls functions after a delay on one timer thread, in the order they are due."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.due = []  # (time, sequence, function, argument)
+        self.sequence = 0
+        self.changed = threading.Condition()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def call_later(self, function, argument):
+        with self.changed:
+            self.sequence += 1
+            heapq.heappush(self.due, (time.monotonic() + self.seconds, self.sequence, function, argument))
+            self.changed.notify()
+
+    def run(self):
+        while True:
+            with self.changed:
+                while not self.due or self.due[0][0] > time.monotonic():
+                    self.changed.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                _, _, function, argument = heapq.heappop(self.due)
+            function(argument)
+
+
+def delay_replies(seconds):
+    """Hand every reply a node gets from its peers over 'seconds' late."""
+    delay = Delay(seconds)
+    submit = peer_pool.PeerConnection.submit
+
+    def delayed_submit(connection, message, callback, raw=False):
+        return submit(connection, message, lambda reply: delay.call_later(callback, reply), raw)
+
+    peer_pool.PeerConnection.submit = delayed_submit
+
+    submit_async = peer_pool.AsyncPeerConnection.submit
+
+    def delayed_submit_async(connection, message, raw=False):
+        request_id, future = submit_async(connection, message, raw)
+        delayed = future.get_loop().create_future()
+
+        def hand_over(reply):
+            if not delayed.done():
+                delayed.set_result(reply)
+
+        future.add_done_callback(lambda done: delayed.get_loop().call_later(seconds, hand_over, done.result()))
+        return request_id, delayed
+
+    peer_pool.AsyncPeerConnection.submit = delayed_submit_async
+
+
+def start_cluster(index, base_port, engine, window, batch_size, snapshot_interval):
+    # The clusters of earlier runs keep running in this directory, so every cluster gets node ids (and
+    # with them CISC5597 files) of its own
+    nodes = {3 * index + number: ('localhost', base_port + number) for number in (1, 2, 3)}
+    servers = []
+    for node_id, address in nodes.items():
+        server = ENGINES[engine](node_id, address, list(nodes.values()), window=window,
+                                 snapshot_interval=snapshot_interval)
+        server.batcher.max_size = batch_size
+        threading.Thread(target=server.start, daemon=True).start()
+        servers.append(server)
+    time.sleep(0.2)
+    return servers
+
+
+# Appends 'values' values from 'clients' concurrent clients through the leader, returns when all are in
+def append_values(leader, engine, clients, values, value):
+    if engine == 'eventloop':
+        async def append_all():
+            remaining = [values]
+
+            async def client():
+                while remaining[0] > 0:
+                    remaining[0] -= 1
+                    await leader.append(value)
+
+            await asyncio.gather(*(client() for _ in range(clients)))
+
+        asyncio.run_coroutine_threadsafe(append_all(), leader.loop).result()
+        return
+
+    remaining = [values]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    return
+                remaining[0] -= 1
+            leader.append(value)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run(args):
+    node_server.VERBOSE = False
+    if args.rtt:
+        delay_replies(args.rtt / 1000)
+    results = []
+    runs = [(engine, window) for engine in args.engines for window in args.windows]
+    for index, (engine, window) in enumerate(runs):
+        threads = threading.active_count()  # the clusters of earlier runs keep theirs
+        servers = start_cluster(index, args.port + 10 * index, engine, window, args.batch_size,
+                                args.snapshot_interval)
+        leader = servers[0]
+        append_values(leader, engine, 1, 1, "warm up")  # elects the first node and opens the connections
+
+        first_slot = leader.next_slot
+        first_syncs = servers[1].wal.syncs
+        start = time.perf_counter()
+        start_cpu = time.process_time()
+        append_values(leader, engine, args.clients, args.values, "x" * args.value_size)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - start_cpu
+        slots = leader.next_slot - first_slot
+        syncs = servers[1].wal.syncs - first_syncs
+        results.append({"engine": engine,
+                        "window": window,
+                        "values_per_second": round(args.values / elapsed),
+                        "slots_per_second": round(slots / elapsed),
+                        "values_per_slot": round(args.values / max(slots, 1), 1),
+                        "slots_per_fsync": round(slots / max(syncs, 1), 1),
+                        "cpu_us_per_slot": round(cpu / max(slots, 1) * 1e6),
+                        "threads": threading.active_count() - threads})
+        print(f"{engine:9} window {window:3}: {results[-1]['values_per_second']:7} values/s, "
+              f"{results[-1]['slots_per_second']:6} slots/s, {results[-1]['values_per_slot']} values per slot, "
+              f"{results[-1]['slots_per_fsync']} slots per acceptor fsync, "
+              f"{results[-1]['cpu_us_per_slot']} us CPU per slot, {results[-1]['threads']} threads")
+    return {"clients": args.clients, "values": args.values, "batch_size": args.batch_size,
+            "rtt_ms": args.rtt, "results": results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='lab3 Multi-Paxos throughput by pipeline window')
+    parser.add_argument('--windows', type=lambda text: [int(w) for w in text.split(',')], default=[1, 2, 4, 8, 16],
+                        help='comma separated window sizes to run')
+    parser.add_argument('--engines', type=lambda text: text.split(','), default=['thread'],
+                        help='comma separated node engines to run: thread, eventloop')
+    parser.add_argument('--clients', type=int, default=64, help='threads appending at the same time')
+    parser.add_argument('--values', type=int, default=20000, help='values to append per window size')
+    parser.add_argument('--value-size', type=int, default=16, help='characters per value')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='values per slot at most (1 measures the window alone)')
+    parser.add_argument('--snapshot-interval', type=int, default=SNAPSHOT_INTERVAL,
+                        help='applied slots between snapshots')
+    parser.add_argument('--rtt', type=float, default=0, help='simulated round trip between nodes, in ms')
+    parser.add_argument('--port', type=int, default=6001, help='first port, every cluster takes the next 10')
+    parser.add_argument('--output', default=None, help='also write the results as JSON here')
+    args = parser.parse_args()
+    if args.output:
+        args.output = os.path.abspath(args.output)
+
+    # The nodes write their CISC5597 files into the working directory
+    directory = tempfile.mkdtemp()
+    os.chdir(directory)
+    try:
+        report = run(args)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
@@ -0,0 +1,385 @@
+# Long-lived connections between Paxos nodes
+# A node keeps one TCP connection to every peer and sends all of its PREPARE/ACCEPT messages over it.
+# The connection starts with PEER_MAGIC, after that every message in either direction is one frame:
+# a header with the payload length and a request id, then the utf-8 payload.
+# Replies carry the id of the request they answer, so many requests can be in flight on one connection
+# and the replies can come back in any order.
+# AsyncPeerConnection and AsyncPeerPool speak the same protocol for a node running on an asyncio loop.
+
+import asyncio
+import functools
+import itertools
+import socket
+import struct
+import threading
+import time
+
+PEER_MAGIC = b"\x00PEER"
+HEADER = struct.Struct("!IQ")  # payload length, request id
+MAX_FRAME_SIZE = 64 << 20
+
+CONNECT_TIMEOUT = 1.0  # seconds to wait for a peer to accept the connection
+REQUEST_TIMEOUT = 2.0  # seconds to wait for replies before counting a peer as silent
+RECONNECT_DELAY = 0.5  # after a failed connect, requests to that peer fail at once for this long
+
+
+def encode_frame(request_id, payload):
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return HEADER.pack(len(payload), request_id) + payload
+
+
+class FrameReader:
+    """Reads frames from a socket, returning every complete frame a recv brought in at once."""
+
+    def __init__(self, sock, data=b""):
+        self.sock = sock
+        self.buffer = bytearray(data)
+
+    def read(self):
+        """Block until at least one frame is complete. Returns [(request_id, payload)], None once the peer closed."""
+        while True:
+            frames = self._frames()
+            if frames:
+                return frames
+            data = self.sock.recv(256 * 1024)
+            if not data:
+                return None
+            self.buffer += data
+
+    def feed(self, data):
+        """Add data read elsewhere (by an asyncio stream), returns the frames it completed."""
+        self.buffer += data
+        return self._frames()
+
+    def _frames(self):
+        frames = []
+        start = 0
+        while len(self.buffer) - start >= HEADER.size:
+            length, request_id = HEADER.unpack_from(self.buffer, start)
+            if length > MAX_FRAME_SIZE:
+                raise ConnectionError(f"peer announced a frame of {length} bytes")
+            end = start + HEADER.size + length
+            if end > len(self.buffer):
+                break
+            frames.append((request_id, bytes(self.buffer[start + HEADER.size:end])))
+            start = end
+        if start:
+            del self.buffer[:start]
+        return frames
+
+
+class PeerConnection:
+    """One persistent connection to a peer, opened on first use and reopened after the peer drops.
+
+    submit() sends a request and returns at once; the callback gets the reply (str, or bytes with raw=True)
+    from the connection's reader thread, or None if the connection broke before the reply came.
+    """
+
+    def __init__(self, address, connect_timeout=CONNECT_TIMEOUT):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.sock = None
+        self.pending = {}  # request id: (callback, raw)
+        self.ids = itertools.count(1)
+        self.retry_at = 0.0
+        self.lock = threading.Lock()  # guards sock and pending, and keeps frames from interleaving
+
+    def submit(self, message, callback, raw=False):
+        """Send one request. Returns its id, or None if the peer could not be reached (callback already got None)."""
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self._connect()
+                request_id = next(self.ids)
+                self.pending[request_id] = (callback, raw)
+                self.sock.sendall(encode_frame(request_id, message))
+                return request_id
+            except OSError as e:
+                failed = self._drop(e)
+        for pending_callback in failed:
+            pending_callback(None)
+        if callback not in failed:
+            callback(None)
+        return None
+
+    def request(self, message, timeout=REQUEST_TIMEOUT, raw=False):
+        """Send one request and wait for its reply, None if there was none in time."""
+        done = threading.Event()
+        reply = [None]
+
+        def on_reply(payload):
+            reply[0] = payload
+            done.set()
+
+        request_id = self.submit(message, on_reply, raw)
+        if not done.wait(timeout):
+            self.cancel(request_id)
+        return reply[0]
+
+    def cancel(self, request_id):
+        """Forget a request whose reply is no longer wanted."""
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def close(self):
+        with self.lock:
+            failed = self._drop(None)
+        for callback in failed:
+            callback(None)
+
+    # Called with the lock held
+    def _connect(self):
+        if time.monotonic() < self.retry_at:
+            raise ConnectionRefusedError(f"peer {self.address} was unreachable moments ago")
+        try:
+            sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+        except OSError:
+            self.retry_at = time.monotonic() + RECONNECT_DELAY
+            raise
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(PEER_MAGIC)
+        self.sock = sock
+        threading.Thread(target=self._read_replies, args=(sock,), daemon=True).start()
+
+    # Called with the lock held, returns the callbacks that will never get their reply
+    def _drop(self, error):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        failed = [callback for callback, raw in self.pending.values()]
+        self.pending = {}
+        return failed
+
+    def _read_replies(self, sock):
+        reader = FrameReader(sock)
+        error = None
+        try:
+            while True:
+                frames = reader.read()
+                if frames is None:
+                    break
+                with self.lock:
+                    callbacks = [(self.pending.pop(request_id, None), payload) for request_id, payload in frames]
+                for pending, payload in callbacks:
+                    if pending is not None:
+                        callback, raw = pending
+                        callback(payload if raw else payload.decode())
+        except OSError as e:
+            error = e
+        failed = []
+        with self.lock:
+            if self.sock is sock:
+                failed = self._drop(error)
+        for callback in failed:
+            callback(None)
+
+
+class PeerPool:
+    """The connections from one node to all nodes of the cluster (itself included)."""
+
+    def __init__(self, addresses):
+        self.connections = {address: PeerConnection(address) for address in addresses}
+
+    def request(self, address, message, timeout=REQUEST_TIMEOUT):
+        """Send one request to one peer and wait for its reply, None if there was none in time."""
+        return dict(self.broadcast(message, timeout, addresses=[address])).get(address)
+
+    def broadcast(self, message, timeout=REQUEST_TIMEOUT, addresses=None, wait_for=None):
+        """Send a request to every peer at once and collect the replies.
+
+        Returns [(address, reply)] of the peers that answered, once all have answered (or their
+        connection broke), 'wait_for' of them have answered, or 'timeout' seconds have passed.
+        """
+        addresses = list(self.connections) if addresses is None else addresses
+        wait_for = len(addresses) if wait_for is None else wait_for
+        replies = []
+        done = threading.Condition()
+        finished = [0]
+
+        def on_reply(address, reply):
+            with done:
+                finished[0] += 1
+                if reply is not None:
+                    replies.append((address, reply))
+                done.notify()
+
+        request_ids = {}
+        for address in addresses:
+            request_ids[address] = self.connections[address].submit(
+                message, lambda reply, address=address: on_reply(address, reply))
+
+        with done:
+            done.wait_for(lambda: len(replies) >= wait_for or finished[0] == len(addresses), timeout)
+            answered = list(replies)
+        for address, request_id in request_ids.items():
+            if request_id is not None:
+                self.connections[address].cancel(request_id)
+        return answered
+
+    def notify(self, message, addresses=None):
+        """Send a message to peers without waiting for (or keeping) their replies."""
+        addresses = list(self.connections) if addresses is None else addresses
+        for address in addresses:
+            self.connections[address].submit(message, lambda reply: None)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+
+class AsyncPeerConnection:
+    """PeerConnection for a node on an asyncio loop, used from the loop only.
+
+    submit() queues a request and returns (request id, future of the reply); the future gets None if the
+    connection broke before the reply came. The requests queued in one pass of the loop go out in one
+    write, and the ones queued while the connection opens wait for it.
+    """
+
+    def __init__(self, address, connect_timeout=CONNECT_TIMEOUT):
+        self.address = address
+        self.connect_timeout = connect_timeout
+        self.writer = None
+        self.connecting = False
+        self.outgoing = []  # frames not written yet
+        self.flush_scheduled = False
+        self.pending = {}  # request id: (future, raw)
+        self.ids = itertools.count(1)
+        self.retry_at = 0.0
+
+    def submit(self, message, raw=False):
+        future = asyncio.get_running_loop().create_future()
+        if self.writer is None and not self.connecting and time.monotonic() < self.retry_at:
+            future.set_result(None)  # the peer was unreachable moments ago
+            return None, future
+        request_id = next(self.ids)
+        self.pending[request_id] = (future, raw)
+        self.outgoing.append(encode_frame(request_id, message))
+        if self.writer is not None:
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                asyncio.get_running_loop().call_soon(self._flush)
+        elif not self.connecting:
+            self.connecting = True
+            asyncio.ensure_future(self._connect())
+        return request_id, future
+
+    async def request(self, message, timeout=REQUEST_TIMEOUT, raw=False):
+        """Send one request and wait for its reply, None if there was none in time."""
+        request_id, future = self.submit(message, raw)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.cancel(request_id)
+            return None
+
+    def cancel(self, request_id):
+        """Forget a request whose reply is no longer wanted."""
+        self.pending.pop(request_id, None)
+
+    def close(self):
+        self._drop()
+
+    async def _connect(self):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), self.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.connecting = False
+            self.retry_at = time.monotonic() + RECONNECT_DELAY
+            self._drop()
+            return
+        # asyncio turns on TCP_NODELAY for its TCP streams already
+        writer.write(PEER_MAGIC + b"".join(self.outgoing))
+        self.outgoing = []
+        self.writer = writer
+        self.connecting = False
+        asyncio.ensure_future(self._read_replies(reader, writer))
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.writer is not None and self.outgoing:
+            self.writer.write(b"".join(self.outgoing))
+            self.outgoing = []
+
+    # Fails every request still waiting for its reply
+    def _drop(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.outgoing = []
+        pending, self.pending = self.pending, {}
+        for future, raw in pending.values():
+            if not future.done():
+                future.set_result(None)
+
+    async def _read_replies(self, reader, writer):
+        frames = FrameReader(None)
+        try:
+            while True:
+                data = await reader.read(256 * 1024)
+                if not data:
+                    break
+                for request_id, payload in frames.feed(data):
+                    pending = self.pending.pop(request_id, None)
+                    if pending is not None and not pending[0].done():
+                        future, raw = pending
+                        future.set_result(payload if raw else payload.decode())
+        except OSError:
+            pass
+        if self.writer is writer:
+            self._drop()
+
+
+class AsyncPeerPool:
+    """PeerPool for a node on an asyncio loop: broadcast() and request() are coroutines, notify() only sends."""
+
+    def __init__(self, addresses):
+        self.connections = {address: AsyncPeerConnection(address) for address in addresses}
+
+    async def request(self, address, message, timeout=REQUEST_TIMEOUT):
+        """Send one request to one peer and wait for its reply, None if there was none in time."""
+        return dict(await self.broadcast(message, timeout, addresses=[address])).get(address)
+
+    async def broadcast(self, message, timeout=REQUEST_TIMEOUT, addresses=None, wait_for=None):
+        """Send a request to every peer at once and collect the replies, see PeerPool.broadcast."""
+        addresses = list(self.connections) if addresses is None else addresses
+        wait_for = len(addresses) if wait_for is None else wait_for
+        loop = asyncio.get_running_loop()
+        replies = []
+        done = loop.create_future()
+        finished = [0]
+
+        def on_reply(address, future):
+            finished[0] += 1
+            if future.result() is not None:
+                replies.append((address, future.result()))
+            if not done.done() and (len(replies) >= wait_for or finished[0] == len(addresses)):
+                done.set_result(None)
+
+        request_ids = {}
+        for address in addresses:
+            request_ids[address], future = self.connections[address].submit(message)
+            future.add_done_callback(functools.partial(on_reply, address))
+
+        timer = loop.call_later(timeout, lambda: done.done() or done.set_result(None))
+        await done
+        timer.cancel()
+        answered = list(replies)
+        for address, request_id in request_ids.items():
+            if request_id is not None:
+                self.connections[address].cancel(request_id)
+        return answered
+
+    def notify(self, message, addresses=None):
+        """Send a message to peers without waiting for (or keeping) their replies."""
+        addresses = list(self.connections) if addresses is None else addresses
+        for address in addresses:
+            self.connections[address].submit(message)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
@@ -0,0 +1,61 @@
+# Snapshots of a node's applied state
+# A snapshot is a copy of the first 'size' bytes of the node's CISC5597 file, which hold every value
+# applied below slot 'applied', after a one-line JSON header with that metadata. The file only ever grows
+# at its end while values are applied, so the copy is taken in the background from a prefix that no
+# longer changes, and the node keeps accepting and applying while it runs.
+
+import json
+import os
+
+from wal import fsync_directory
+
+SNAPSHOT_INTERVAL = 10000  # applied slots between snapshots
+COPY_CHUNK = 1 << 20
+
+
+def read_header(path):
+    """The metadata of the snapshot at 'path', None if there is none."""
+    try:
+        with open(path, "rb") as f:
+            return json.loads(f.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def copy_range(source, target, size, offset=0):
+    """Copy 'size' bytes from the start of the open file 'source' to the open file 'target'."""
+    source.seek(offset)
+    while size > 0:
+        chunk = source.read(min(COPY_CHUNK, size))
+        if not chunk:
+            raise OSError(f"{source.name} ended {size} bytes early")
+        target.write(chunk)
+        size -= len(chunk)
+
+
+def write_snapshot(state_path, path, metadata):
+    """Copy the state file's first metadata['size'] bytes into a new snapshot, replacing the old one
+    only once the new one is complete and on disk."""
+    temporary = path + ".tmp"
+    with open(state_path, "rb") as state, open(temporary, "wb") as snapshot:
+        # The snapshot is the recovery point for the state file as well, so that prefix has to be on disk too
+        os.fsync(state.fileno())
+        snapshot.write(json.dumps(metadata).encode() + b"\n")
+        copy_range(state, snapshot, metadata["size"])
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+    fsync_directory(path)
+
+
+def restore_state(path, state_path, metadata):
+    """Bring the state file back to the snapshot's contents. A state file at least as long as the snapshot
+    already holds them (they were synced before the snapshot was written), so it is only cut back;
+    a missing or shorter one is copied out of the snapshot."""
+    size = metadata["size"]
+    if os.path.exists(state_path) and os.path.getsize(state_path) >= size:
+        os.truncate(state_path, size)
+        return
+    with open(path, "rb") as snapshot, open(state_path, "wb") as state:
+        header_size = len(snapshot.readline())
+        copy_range(snapshot, state, size, header_size)
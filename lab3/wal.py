@@ -0,0 +1,193 @@
+# Write-ahead log of a node's acceptor state
+# An acceptor may only answer PROMISE or ACCEPTED once the promise or the accepted value is on disk,
+# otherwise a node that restarts can forget a promise and accept something it promised not to.
+# Records are written with a length and a CRC, so a record torn by a crash is found and dropped on replay.
+# The log is a series of segment files (the first one is the log's path, then <path>.1, <path>.2, ...).
+# rotate() starts a new segment, and once a snapshot covers everything in the older ones they are removed.
+
+import json
+import os
+import struct
+import threading
+import zlib
+
+HEADER = struct.Struct("!II")  # payload length, crc32 of the payload
+LAZY_DELAY = 0.05  # seconds a record queued with sync=False waits for a synced one to go out with
+
+
+def fsync_directory(path):
+    """Make a file created or renamed in the directory of 'path' survive a crash."""
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def encode_record(record):
+    payload = json.dumps(record, separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+class WriteAheadLog:
+    """Append-only file of acceptor records, made durable in groups.
+
+    append() only queues a record and flush() waits until every record queued with sync=True is on disk.
+    Records queued with sync=False go out with the next synced group, or after LAZY_DELAY if none comes.
+    One writer thread takes all records that queued up while the previous fsync ran and writes them
+    with one write and one fsync, so concurrent handlers (and all the frames of one read on a peer
+    connection) share an fsync instead of paying one each.
+    when_durable() is flush() for callers on an event loop, which must not block.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segment = 0  # the segment records appended now go to
+        self.writing = 0  # the segment the writer thread has open
+        self.file = None
+        self.pending = []  # encoded records not written yet, None where a new segment starts
+        self.appended = 0  # records queued so far
+        self.requested = 0  # records that have to be on disk as soon as possible
+        self.durable = 0  # records on disk
+        self.syncs = 0
+        self.error = None
+        self.waiters = []  # (sequence, callback) of when_durable()
+        self.changed = threading.Condition()
+
+    def segment_path(self, number):
+        return self.path if number == 0 else f"{self.path}.{number}"
+
+    # Numbers of the segment files on disk, oldest first
+    def segments(self):
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + "."
+        numbers = [int(name[len(prefix):]) for name in os.listdir(directory)
+                   if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        if os.path.exists(self.path):
+            numbers.append(0)
+        return sorted(numbers)
+
+    def replay(self):
+        """The records of all segments, in order. A torn or corrupt tail is cut off. Call before open()."""
+        records = []
+        for number in self.segments():
+            path = self.segment_path(number)
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset + HEADER.size <= len(data):
+                length, crc = HEADER.unpack_from(data, offset)
+                payload = data[offset + HEADER.size:offset + HEADER.size + length]
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    break
+                records.append(json.loads(payload))
+                offset += HEADER.size + length
+            if offset < len(data):
+                os.truncate(path, offset)
+            self.segment = self.writing = number
+        return records
+
+    def open(self):
+        self.file = open(self.segment_path(self.writing), "ab")
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def rotate(self):
+        """Records appended from now on go to a new segment. Returns the new segment's number."""
+        with self.changed:
+            self.segment += 1
+            self.pending.append(None)
+            self.requested = self.appended
+            self.changed.notify_all()
+            return self.segment
+
+    def remove_segments(self, before):
+        """Delete the segments older than 'before' that the writer is done with."""
+        with self.changed:
+            before = min(before, self.writing)
+        for number in self.segments():
+            if number < before:
+                os.remove(self.segment_path(number))
+
+    def append(self, record, sync=True):
+        """Queue a record, returns its sequence number for flush()."""
+        encoded = encode_record(record)
+        with self.changed:
+            self.pending.append(encoded)
+            self.appended += 1
+            if sync:
+                self.requested = self.appended
+                self.changed.notify_all()
+            return self.appended
+
+    def flush(self, sequence=None):
+        """Wait until the record with this sequence number (by default every synced record so far) is durable."""
+        with self.changed:
+            sequence = self.requested if sequence is None else sequence
+            if sequence > self.requested:
+                self.requested = sequence
+                self.changed.notify_all()
+            self.changed.wait_for(lambda: self.durable >= sequence or self.error is not None)
+            if self.durable < sequence:
+                raise OSError(f"write-ahead log {self.path} failed: {self.error}")
+
+    def when_durable(self, callback, sequence=None):
+        """Like flush(), without blocking: returns False if the record is durable already, otherwise True and
+        the writer thread calls callback(error) once it is, error being None unless the log failed."""
+        with self.changed:
+            sequence = self.requested if sequence is None else sequence
+            if self.durable >= sequence:
+                return False
+            if self.error is None:
+                if sequence > self.requested:
+                    self.requested = sequence
+                    self.changed.notify_all()
+                self.waiters.append((sequence, callback))
+                return True
+            error = self.error
+        callback(error)
+        return True
+
+    def run(self):
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.requested > self.durable, LAZY_DELAY)
+                if not self.pending:
+                    continue
+                batch, self.pending = self.pending, []
+                sequence = self.appended
+            try:
+                self.write(batch)
+            except OSError as e:
+                with self.changed:
+                    self.error = e
+                    self.changed.notify_all()
+                    waiters, self.waiters = self.waiters, []
+                for _, callback in waiters:
+                    callback(e)
+                return
+            with self.changed:
+                self.durable = sequence
+                self.syncs += 1
+                self.changed.notify_all()
+                done = [callback for waiting, callback in self.waiters if waiting <= sequence]
+                if done:
+                    self.waiters = [(waiting, callback) for waiting, callback in self.waiters if waiting > sequence]
+            for callback in done:
+                callback(None)
+
+    # Writes a batch with one write and one fsync per segment it touches
+    def write(self, batch):
+        start = 0
+        while True:
+            end = batch.index(None, start) if None in batch[start:] else len(batch)
+            self.file.write(b"".join(batch[start:end]))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            if end == len(batch):
+                return
+            self.file.close()
+            self.file = open(self.segment_path(self.writing + 1), "ab")
+            fsync_directory(self.path)
+            with self.changed:
+                self.writing += 1
+            start = end + 1